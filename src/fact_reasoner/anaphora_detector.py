@@ -0,0 +1,181 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Detect atoms with unresolved references (pronouns, demonstratives, elided subjects)
+
+import re
+
+from typing import List, Optional
+
+# Pronouns that refer back to an entity mentioned elsewhere in the response
+PRONOUNS = set([
+    "he", "she", "it", "they", "him", "her", "them", "his", "hers", "its",
+    "their", "theirs", "himself", "herself", "itself", "themselves",
+    "i", "me", "my", "mine", "we", "us", "our", "ours", "you", "your", "yours",
+])
+
+DEMONSTRATIVES = set(["this", "that", "these", "those"])
+
+# Definite descriptions that usually stand for an entity named elsewhere
+VAGUE_REFERENCES = [
+    r"\bthe (former|latter|same|aforementioned|above)\b",
+    r"\bsuch an? [a-z]+\b",
+    r"\bthe (person|man|woman|individual|actor|actress|artist|author|writer|"
+    r"singer|musician|player|athlete|politician|scientist|inventor|company|"
+    r"firm|organization|organisation|group|band|team|club|film|movie|show|"
+    r"series|book|novel|album|song|game|device|product|city|town|country|"
+    r"region|university|school|building|project|study|event|character)\b",
+]
+
+# Verb forms that typically start an atom whose subject was elided
+ELIDED_SUBJECT_VERBS = set([
+    "is", "was", "are", "were", "has", "had", "have", "born", "known",
+    "appeared", "served", "worked", "won", "received", "became", "died",
+    "played", "starred", "wrote", "founded", "moved", "lived", "studied",
+    "graduated", "married", "released", "published", "created", "developed",
+])
+
+_WORD_RE = re.compile(r"[A-Za-z][A-Za-z\-']*")
+
+
+class AnaphoraDetector:
+    """
+    A cheap pre-pass that flags the atoms that need decontextualization, i.e.,
+    atoms containing unresolved pronouns, demonstratives, vague definite
+    references or elided subjects. Atoms that are already self-contained can
+    skip the (expensive) LLM based AtomReviser. Uses spaCy if the model can be
+    loaded, and falls back to rules otherwise.
+    """
+
+    def __init__(
+            self,
+            spacy_model: Optional[str] = "en_core_web_sm",
+    ):
+        """
+        Initialize the detector.
+
+        Args:
+            spacy_model: str
+                The name of the spaCy model. If None, or if the model cannot be
+                loaded, the rule based detector is used.
+        """
+
+        self.spacy_model = spacy_model
+        self.nlp = None
+        self.patterns = [re.compile(p, re.IGNORECASE) for p in VAGUE_REFERENCES]
+
+        if self.spacy_model is not None:
+            try:
+                import spacy
+                self.nlp = spacy.load(self.spacy_model, disable=["ner", "lemmatizer"])
+            except (ImportError, OSError) as e:
+                print(f"[AnaphoraDetector] Cannot load spaCy model {self.spacy_model}: {e}")
+
+        print(f"[AnaphoraDetector] Using detector: {'spacy' if self.nlp is not None else 'rules'}")
+
+    def needs_revision_rules(self, text: str) -> bool:
+        """
+        Rule based detection.
+        """
+
+        words = _WORD_RE.findall(text)
+        if len(words) == 0:
+            return False
+
+        lower = [w.lower() for w in words]
+        if any(w in PRONOUNS for w in lower):
+            return True
+
+        # Demonstratives: `that` is too often a conjunction, so only consider
+        # it at the beginning of the atom.
+        if lower[0] in DEMONSTRATIVES or any(w in ["this", "these", "those"] for w in lower[1:]):
+            return True
+
+        if any(p.search(text) for p in self.patterns):
+            return True
+
+        return lower[0] in ELIDED_SUBJECT_VERBS or not words[0][0].isupper()
+
+    def needs_revision_spacy(self, texts: List[str]) -> List[bool]:
+        """
+        spaCy based detection.
+        """
+
+        flags = []
+        for doc, text in zip(self.nlp.pipe(texts), texts):
+            flag = False
+            for token in doc:
+                lower = token.lower_
+                if lower in PRONOUNS and token.pos_ == "PRON":
+                    flag = True
+                elif lower in PRONOUNS and token.tag_ == "PRP$":
+                    flag = True
+                elif lower in DEMONSTRATIVES and token.tag_ == "DT":
+                    flag = True  # excludes relative (WDT) and complementizer (IN) `that`
+                if flag:
+                    break
+
+            if not flag and any(p.search(text) for p in self.patterns):
+                flag = True
+
+            # Elided subject: a verbal root without an explicit subject
+            if not flag:
+                for sent in doc.sents:
+                    root = sent.root
+                    if root.pos_ in ["VERB", "AUX"] and not any(
+                        child.dep_ in ["nsubj", "nsubjpass", "expl", "csubj"] for child in root.children
+                    ):
+                        flag = True
+                        break
+
+            flags.append(flag)
+
+        return flags
+
+    def run(self, atoms: List[str]) -> List[bool]:
+        """
+        Flag the atoms that need decontextualization.
+
+        Args:
+            atoms: List[str]
+                The list of atoms.
+
+        Returns:
+            List[bool]: True if the atom needs revision, False if it is self-contained.
+        """
+
+        if len(atoms) == 0:
+            return []
+        if self.nlp is not None:
+            return self.needs_revision_spacy(atoms)
+        return [self.needs_revision_rules(atom) for atom in atoms]
+
+
+if __name__ == "__main__":
+
+    atoms = [
+        "Lanny Flaherty was born in Pensacola, Florida.",
+        "He has appeared in numerous films.",
+        "His career began in the late 1970s.",
+        "Appeared in the film The Abyss.",
+        "The actor is known for his deep gravelly voice.",
+        "This device was invented in 1931.",
+        "Gerhard Fischer said that the metal detector was popular.",
+    ]
+
+    detector = AnaphoraDetector()
+    for atom, flag in zip(atoms, detector.run(atoms)):
+        print(f"{flag}: {atom}")
+    print("Done.")
@@ -15,8 +15,15 @@
 
 # Split the input text into atomic facts/claims (LLM based).
 
-from typing import Any, List
+import hashlib
+import json
+import re
+import nltk
+import sqlite3
+
+from typing import Any, Iterator, List, Tuple
 from tqdm import tqdm
+from nltk.tokenize import sent_tokenize
 
 # if not __package__:
 #     # Make CLI runnable from source tree with
@@ -30,6 +37,20 @@ from src.fact_reasoner.llm_handler import LLMHandler
 
 _ATOM = 'atom'
 _LABEL = 'label'
+MIN_MATCH_SCORE = 0.5  # fraction of a unit's words found in its sentence
+MIN_MATCH_MARGIN = 0.2  # score margin over the second best sentence
+
+def split_unit_and_label(full_unit: str) -> Tuple[str, str]:
+    """
+    Split a parsed unit into the atomic unit and its type. The format is either
+    `atomic unit: atomic unit type` or just `atomic unit` (a fact).
+    """
+
+    if ": " in full_unit:
+        unit, label = full_unit.rsplit(": ", 1)
+    else:
+        unit, label = full_unit.strip(), "Fact"
+    return unit.strip(), label.strip()
 
 def text_to_units(text: str, separator: str = '- ') -> List[str]:
     """
@@ -57,14 +78,9 @@ def text_to_units(text: str, separator: str = '- ') -> List[str]:
             if current_unit:
                 # Process the previous unit if it's completed
                 full_unit = "\n".join(current_unit).strip()
-                if ": " in full_unit: # the format is - atomic unit: atomic unit type
-                    unit, label = full_unit.rsplit(": ", 1)
-                    parsed_units.append(unit.strip())
-                    parsed_labels.append(label.strip())
-                else: # the format is just - atomic unit
-                    unit, label = full_unit.strip(), "Fact"
-                    parsed_units.append(unit.strip())
-                    parsed_labels.append(label.strip())
+                unit, label = split_unit_and_label(full_unit)
+                parsed_units.append(unit)
+                parsed_labels.append(label)
                 current_unit = []
             # Add the new line to the current unit (without leading '- ')
             current_unit.append(line[2:].strip())
@@ -77,17 +93,226 @@ def text_to_units(text: str, separator: str = '- ') -> List[str]:
     # Process the last unit
     if current_unit:
         full_unit = "\n".join(current_unit).strip()
-        if ": " in full_unit:
-            unit, label = full_unit.rsplit(": ", 1)
-            parsed_units.append(unit.strip())
-            parsed_labels.append(label.strip())
-        else:
-            unit, label = full_unit.strip(), "Fact"
-            parsed_units.append(unit.strip())
-            parsed_labels.append(label.strip())
+        unit, label = split_unit_and_label(full_unit)
+        parsed_units.append(unit)
+        parsed_labels.append(label)
     
     return parsed_units, parsed_labels
 
+class UnitStreamParser:
+    """
+    Incremental version of `text_to_units`. The generated text is fed in
+    pieces and a unit is returned as soon as it is complete, i.e., when the
+    next unit starts (continuation lines belong to the current unit).
+    """
+
+    def __init__(self, separator: str = '- '):
+        self.separator = separator
+        self.buffer = ""
+        self.current_unit = []
+        self.preamble = True
+
+    def _process_line(self, line: str) -> List[Tuple[str, str]]:
+        completed = []
+        line = line.strip()
+        if line.startswith(self.separator):
+            self.preamble = False
+            if self.current_unit:
+                completed.append(split_unit_and_label("\n".join(self.current_unit).strip()))
+            self.current_unit = [line[2:].strip()]
+        elif not self.preamble:
+            self.current_unit.append(line)
+        return completed
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        """
+        Add a piece of generated text and return the completed (unit, label) pairs.
+        """
+
+        self.buffer += text
+        completed = []
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            completed.extend(self._process_line(line))
+        return completed
+
+    def finish(self) -> List[Tuple[str, str]]:
+        """
+        Flush the remaining text and return the last (unit, label) pairs.
+        """
+
+        completed = self._process_line(self.buffer)
+        self.buffer = ""
+        if self.current_unit:
+            completed.append(split_unit_and_label("\n".join(self.current_unit).strip()))
+            self.current_unit = []
+        return completed
+
+def normalize_unit(unit: str) -> str:
+    """
+    Normalize an atomic unit for duplicate detection (lowercase, no punctuation,
+    single spaces).
+    """
+
+    return " ".join(re.sub(r"[^\w\s]", " ", unit.lower()).split())
+
+def split_into_chunks(text: str, chunk_size: int) -> List[str]:
+    """
+    Split a text into chunks of at most (approximately) `chunk_size` characters.
+    The text is split at paragraph boundaries first, and paragraphs that are
+    too long are split into groups of consecutive sentences. Consecutive pieces
+    are then packed together as long as they fit in a chunk.
+
+    Args:
+        text: str
+            The input text.
+        chunk_size: int
+            The maximum number of characters in a chunk.
+
+    Returns:
+        List[str]: The chunks (in text order).
+    """
+
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if len(paragraph) == 0:
+            continue
+        if len(paragraph) <= chunk_size:
+            pieces.append((paragraph, "\n\n"))
+        else:
+            sentences = [sent.strip() for sent in sent_tokenize(paragraph) if len(sent.strip()) > 0]
+            pieces.extend([(sent, "\n\n" if j == 0 else " ") for j, sent in enumerate(sentences)])
+
+    chunks = []
+    current = ""
+    for piece, separator in pieces:
+        if len(current) > 0 and len(current) + len(piece) + len(separator) > chunk_size:
+            chunks.append(current)
+            current = ""
+        current = piece if len(current) == 0 else current + separator + piece
+    if len(current) > 0:
+        chunks.append(current)
+
+    return chunks
+
+class SentenceAtomCache:
+    """
+    A cache of the atomic units extracted from a sentence, indexed by a key
+    derived from the normalized sentence (and the extraction model). The
+    cache is kept in memory and, optionally, in a SQLite database on disk so
+    that it is shared across runs.
+    """
+
+    def __init__(self, cache_file: str = None):
+        """
+        Initialize the cache.
+
+        Args:
+            cache_file: str
+                The path to the SQLite database. If None, the cache is in memory only.
+        """
+
+        self.cache_file = cache_file
+        self.memory = {}
+        self.num_hits = 0
+        self.num_misses = 0
+
+        if self.cache_file is not None:
+            with sqlite3.connect(self.cache_file) as conn:
+                cursor = conn.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL;")
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS sentence_atoms (
+                        key TEXT PRIMARY KEY, units TEXT
+                    )
+                """)
+                conn.commit()
+
+    def get(self, key: str):
+        """
+        Return the cached (units, labels) for the key or None.
+        """
+
+        value = self.memory.get(key, None)
+        if value is None and self.cache_file is not None:
+            with sqlite3.connect(self.cache_file) as conn:
+                row = conn.execute("SELECT units FROM sentence_atoms WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value = tuple(json.loads(row[0]))
+                self.memory[key] = value
+
+        if value is None:
+            self.num_misses += 1
+        else:
+            self.num_hits += 1
+        return value
+
+    def put(self, items: List[Tuple[str, Tuple[List[str], List[str]]]]):
+        """
+        Store a list of (key, (units, labels)) items.
+        """
+
+        for key, value in items:
+            self.memory[key] = value
+        if self.cache_file is not None and len(items) > 0:
+            with sqlite3.connect(self.cache_file) as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO sentence_atoms (key, units) VALUES (?, ?)",
+                    [(key, json.dumps(list(value))) for key, value in items]
+                )
+                conn.commit()
+
+def assign_units_to_sentences(
+        units: List[str],
+        sentences: List[str],
+        min_score: float = MIN_MATCH_SCORE,
+        min_margin: float = MIN_MATCH_MARGIN,
+) -> Tuple[List[int], List[bool]]:
+    """
+    Assign each atomic unit extracted from a group of sentences to the
+    sentence it most likely comes from, i.e., the sentence sharing the largest
+    fraction of the unit's words. Ties go to the earliest sentence not before
+    the previous unit's sentence (the units follow the text order). An
+    assignment is unambiguous if the best sentence shares at least `min_score`
+    of the unit's words and beats the second best by at least `min_margin`
+    (the units of a single sentence are always unambiguous).
+
+    Args:
+        units: List[str]
+            The atomic units extracted from the sentences.
+        sentences: List[str]
+            The sentences of the group, in text order.
+        min_score: float
+            The minimum fraction of the unit's words found in its sentence.
+        min_margin: float
+            The minimum score margin over the second best sentence.
+
+    Returns:
+        List[int]: The index of the sentence of each unit.
+        List[bool]: Whether the assignment of each unit is unambiguous.
+    """
+
+    sentence_words = [set(normalize_unit(sent).split()) for sent in sentences]
+    assignment = []
+    unambiguous = []
+    last = 0
+    for unit in units:
+        words = set(normalize_unit(unit).split())
+        best, best_score, second_score = last, -1.0, 0.0
+        for j in list(range(last, len(sentences))) + list(range(0, last)):
+            score = len(words & sentence_words[j]) / max(1, len(words))
+            if score > best_score:
+                best, best_score, second_score = j, score, max(second_score, best_score)
+            else:
+                second_score = max(second_score, score)
+        assignment.append(best)
+        unambiguous.append(
+            len(sentences) == 1 or (best_score >= min_score and best_score - second_score >= min_margin)
+        )
+        last = best
+    return assignment, unambiguous
+
 def convert_atomic_units_to_dicts_(labels: List[str], units: List[str]) -> List[dict[str, Any]]:
     """
     Convert atomic units and their labels into a list of dictionaries.
@@ -117,7 +342,10 @@ class AtomExtractor(object):
         self, 
         model_id: str = "llama-3.1-70b-instruct",
         prompt_version: str = "v1",
-        backend: str = "rits"
+        backend: str = "rits",
+        chunk_size: int = None,
+        sentence_cache: bool = False,
+        cache_file: str = None
     ):
         """
         Initialize the AtomExtractor.
@@ -129,12 +357,27 @@ class AtomExtractor(object):
                 The prompt version used for the model (v1 - original, v2 - newer)
             backend: str
                 The model's backend (rits, hf or wx).
+            chunk_size: int
+                If not None, responses longer than `chunk_size` characters are
+                split at paragraph (or sentence group) boundaries and the atoms
+                are extracted from the chunks concurrently. The atoms are merged
+                in chunk order and the duplicates across chunks are removed.
+            sentence_cache: bool
+                If True, the responses are split into sentences and the atoms
+                of each sentence are cached (keyed by the normalized sentence),
+                so only the novel sentences of a response are sent to the LLM,
+                together in one prompt (or one per `chunk_size` characters).
+                Takes precedence over `chunk_size` otherwise.
+            cache_file: str
+                The SQLite file used to persist the sentence cache (optional).
         """ 
         
         # Initialize the extractor
         self.model_id = model_id
         self.backend = backend
         self.prompt_version = prompt_version
+        self.chunk_size = chunk_size
+        self.sentence_cache = SentenceAtomCache(cache_file) if sentence_cache else None
         self.llm_handler = LLMHandler(self.model_id, backend=backend)
 
         # Set the prompt begin and end templates
@@ -143,6 +386,15 @@ class AtomExtractor(object):
         
         print(f"[AtomExtractor] Using LLM on {self.backend}: {self.model_id}")
         print(f"[AtomExtractor] Using prompt version: {self.prompt_version}")
+        print(f"[AtomExtractor] Using chunk size: {self.chunk_size}")
+        print(f"[AtomExtractor] Using sentence cache: {sentence_cache} (file: {cache_file})")
+
+        if self.chunk_size is not None or self.sentence_cache is not None:
+            try:
+                nltk.data.find('tokenizers/punkt')
+            except LookupError:
+                print("'punkt' not found. Downloading...")
+                nltk.download('punkt')
 
     def make_prompt(self, response: str) -> str:
         """
@@ -186,6 +438,11 @@ class AtomExtractor(object):
             List[str]: A list of labels corresponding to the atomic units.
         """
 
+        if self.sentence_cache is not None or \
+                (self.chunk_size is not None and len(response) > self.chunk_size):
+            all_units, all_labels = self.get_atoms_from_responses([response])
+            return all_units[0], all_labels[0]
+
         print(f"[AtomExtractor] Prompts created: 1")
         prompt = self.make_prompt(response)
         response = self.llm_handler.completion(prompt)
@@ -206,8 +463,19 @@ class AtomExtractor(object):
             List[List[str]]: A list of lists, where each inner list contains labels corresponding to the atomic units.
         """
 
+        if self.sentence_cache is not None:
+            return self.get_atoms_by_sentence(responses)
+
+        # Split the long responses into chunks (extracted concurrently)
+        chunks = []
+        for i, response in enumerate(responses):
+            if self.chunk_size is not None and len(response) > self.chunk_size:
+                chunks.extend([(i, chunk) for chunk in split_into_chunks(response, self.chunk_size)])
+            else:
+                chunks.append((i, response))
+
         results = []
-        prompts = [self.make_prompt(response) for response in responses]
+        prompts = [self.make_prompt(chunk) for _, chunk in chunks]
         print(f"[AtomExtractor] Prompts created: {len(prompts)}")
 
         for _, response in tqdm(
@@ -220,15 +488,164 @@ class AtomExtractor(object):
             ):
                 results.append(response.choices[0].message.content)
 
+        # Merge the chunks (in order) and remove the duplicates across chunks
+        all_units = [[] for _ in responses]
+        all_labels = [[] for _ in responses]
+        seen = [set() for _ in responses]
+        for (i, _), result in zip(chunks, results):
+            units, labels = text_to_units(result)
+            for unit, label in zip(units, labels):
+                key = normalize_unit(unit)
+                if key in seen[i]:
+                    continue
+                seen[i].add(key)
+                all_units[i].append(unit)
+                all_labels[i].append(label)
+        
+        return all_units, all_labels
+
+    def make_cache_key(self, sentence: str) -> str:
+        """
+        Return the cache key of a sentence, i.e., a hash of the model, prompt
+        version and normalized sentence. The atoms are extracted from the
+        sentence alone (the reviser makes them self-contained), so the
+        surrounding sentences are not part of the key.
+        """
+
+        key = "\n".join([self.model_id, self.prompt_version, normalize_unit(sentence)])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def group_sentences(self, sentences: List[str]) -> List[List[str]]:
+        """
+        Group consecutive sentences into prompts of at most `chunk_size`
+        characters (a single group if there is no chunk size).
+        """
+
+        groups = []
+        size = 0
+        for sentence in sentences:
+            if len(groups) == 0 or (self.chunk_size is not None and size + len(sentence) + 1 > self.chunk_size):
+                groups.append([])
+                size = 0
+            groups[-1].append(sentence)
+            size += len(sentence) + 1
+        return groups
+
+    def get_atoms_by_sentence(self, responses: List[str]):
+        """
+        Extract atomic units sentence by sentence using the sentence cache. The
+        novel sentences (cache misses) of each response are extracted together
+        in a single prompt (the prompts of all responses run concurrently), and
+        each extracted unit is cached with the sentence it comes from. The
+        atoms are merged in sentence order (duplicates are removed).
+
+        Args:
+            responses: List[str]
+                A list of responses from which to extract atomic units.
+
+        Returns:
+            List[List[str]]: A list of lists, where each inner list contains atomic units (facts or claims).
+            List[List[str]]: A list of lists, where each inner list contains labels corresponding to the atomic units.
+        """
+
+        keys = []
+        novel = {}  # key -> sentence (distinct novel sentences only)
+        groups = []  # the novel sentences (key, sentence) extracted together
+        cached = {}
+        for response in responses:
+            sentences = [sent.strip() for sent in sent_tokenize(response) if len(sent.strip()) > 0]
+            keys.append([self.make_cache_key(sentence) for sentence in sentences])
+            response_novel = []
+            for key, sentence in zip(keys[-1], sentences):
+                if key in novel or key in cached:
+                    continue
+                value = self.sentence_cache.get(key)
+                if value is None:
+                    novel[key] = sentence
+                    response_novel.append(sentence)
+                else:
+                    cached[key] = value
+            groups.extend(self.group_sentences(response_novel))
+
+        print(f"[AtomExtractor] Sentence cache hits: {len(cached)}, novel sentences: {len(novel)}")
+
+        if len(novel) > 0:
+            results = []
+            prompts = [self.make_prompt(" ".join(group)) for group in groups]
+            print(f"[AtomExtractor] Prompts created: {len(prompts)}")
+            for _, response in tqdm(
+                enumerate(
+                    self.llm_handler.batch_completion(prompts)
+                ),
+                total=len(prompts),
+                desc="Extractor",
+                unit="prompts",
+                ):
+                    results.append(response.choices[0].message.content)
+
+            # Split the units of each group among its sentences (only the
+            # groups whose units map unambiguously to a sentence are cached)
+            items = []
+            num_skipped = 0
+            for group, result in zip(groups, results):
+                units, labels = text_to_units(result)
+                per_sentence = [([], []) for _ in group]
+                cacheable = [True] * len(group)
+                assignment, unambiguous = assign_units_to_sentences(units, group)
+                for j, ok, unit, label in zip(assignment, unambiguous, units, labels):
+                    per_sentence[j][0].append(unit)
+                    per_sentence[j][1].append(label)
+                    cacheable[j] = cacheable[j] and ok
+                group_items = [(self.make_cache_key(sentence), value) for sentence, value in zip(group, per_sentence)]
+                if all(cacheable):
+                    items.extend(group_items)
+                else:
+                    # A misplaced unit would also be missing from its true sentence
+                    num_skipped += len(group)
+                cached.update(group_items)
+            if num_skipped > 0:
+                print(f"[AtomExtractor] Ambiguous units, sentences not cached: {num_skipped}")
+            self.sentence_cache.put(items)
+
         all_units = []
         all_labels = []
-        for result in results:
-            units, labels = text_to_units(result)
+        for response_keys in keys:
+            units, labels, seen = [], [], set()
+            for key in response_keys:
+                for unit, label in zip(*cached[key]):
+                    if normalize_unit(unit) in seen:
+                        continue
+                    seen.add(normalize_unit(unit))
+                    units.append(unit)
+                    labels.append(label)
             all_units.append(units)
             all_labels.append(labels)
-        
+
         return all_units, all_labels
 
+    def stream(self, response: str) -> Iterator[dict[str, Any]]:
+        """
+        Extract the atomic units from a single response while the LLM output is
+        being generated. Each unit is yielded as soon as it is complete, so the
+        downstream stages can start on the first units early.
+
+        Args:
+            response: str
+                The response from which to extract atomic units.
+
+        Returns:
+            Iterator[dict]: The atomic units as dictionaries (label, atom), in order.
+        """
+
+        print(f"[AtomExtractor] Streaming prompts created: 1")
+        prompt = self.make_prompt(response)
+        parser = UnitStreamParser()
+        for delta in self.llm_handler.stream_completion(prompt):
+            for unit, label in parser.feed(delta):
+                yield {_LABEL: label, _ATOM: unit}
+        for unit, label in parser.finish():
+            yield {_LABEL: label, _ATOM: unit}
+
     def run(self, response: str) -> dict[str, Any]:
         """ Extract atomic units from a single response.
         Args:
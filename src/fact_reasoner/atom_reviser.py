@@ -15,15 +15,60 @@
 
 # Atomic fact decontextualization using LLMs
 
+import re
+import nltk
 import string
+import threading
 
-from typing import List, Any
+from typing import Dict, List, Any
 from tqdm import tqdm
+from nltk.tokenize import sent_tokenize
+from thefuzz import fuzz
 
 # Local imports
 from src.fact_reasoner.utils import strip_string, extract_first_code_block, extract_last_wrapped_response
 from src.fact_reasoner.llm_handler import LLMHandler
-from src.fact_reasoner.prompts import ATOM_REVISER_PROMPT_V1, ATOM_REVISER_PROMPT_V2
+from src.fact_reasoner.anaphora_detector import AnaphoraDetector
+from src.fact_reasoner.prompts import (
+    ATOM_REVISER_PROMPT_V1,
+    ATOM_REVISER_PROMPT_V2,
+    ATOM_REVISER_BATCH_PROMPT_V1,
+    ATOM_REVISER_BATCH_PROMPT_V2
+)
+
+# Matches the index-tagged output of the batched prompt: <unit id="N">...</unit>
+UNIT_TAG_RE = re.compile(r'<unit\s+id\s*=\s*["\']?(\d+)["\']?\s*>(.*?)</unit>', re.DOTALL | re.IGNORECASE)
+
+def parse_batch_output(text: str, num_units: int) -> Dict[int, str]:
+    """
+    Parse the output of the batched reviser prompt.
+
+    Args:
+        text: str
+            The generated text containing lines like <unit id="N">revised unit</unit>.
+        num_units: int
+            The number of units in the prompt (ids are 1-based).
+
+    Returns:
+        Dict[int, str]: The revised units indexed by their (0-based) position.
+        Units that are missing, duplicated or empty are not included.
+    """
+
+    revised = {}
+    duplicates = set()
+    for match in UNIT_TAG_RE.finditer(text or ""):
+        index = int(match.group(1)) - 1
+        unit = strip_string(match.group(2)).strip('"')
+        if index < 0 or index >= num_units or len(unit) == 0:
+            continue
+        if index in revised:
+            duplicates.add(index)
+        revised[index] = unit
+
+    # An ambiguous (duplicated) index is treated as a parsing failure
+    for index in duplicates:
+        del revised[index]
+    return revised
 
 class AtomReviser:
     """
@@ -35,7 +80,10 @@ class AtomReviser:
             self,
             model_id: str = "llama-3.3-70b-instruct",
             prompt_version: str = "v1",
-            backend: str = "rits"
+            backend: str = "rits",
+            batch_size: int = 1,
+            context_window: int = None,
+            detect_anaphora: bool = False
     ):
         """
         Initialize the AtomReviser with the specified model and prompt version.
@@ -47,11 +95,31 @@ class AtomReviser:
                 The prompt version used. Allowed values are v1 - newer, v2 - original.
             backend: str
                 The model's backend.
+            batch_size: int
+                The number of atoms revised by a single prompt. If larger than 1,
+                the batched (index-tagged) prompt is used and the atoms whose
+                output cannot be parsed fall back to single-atom prompts.
+            context_window: int
+                If not None, the prompt contains only the first sentence of the
+                response (the topic anchor) and the `context_window` sentences
+                before and after the sentence the atom was extracted from. The
+                source sentence is located by fuzzy matching. If None, the
+                whole response is used.
+            detect_anaphora: bool
+                If True, a cheap anaphora detector flags the atoms with
+                unresolved references and only those are sent to the LLM. The
+                self-contained atoms are passed through unchanged.
         """
         
         self.model_id = model_id
         self.backend = backend
         self.prompt_version = prompt_version
+        self.batch_size = batch_size
+        self.context_window = context_window
+        self.detector = AnaphoraDetector() if detect_anaphora else None
+        self.num_hits = 0  # atoms sent to the LLM reviser
+        self.num_skipped = 0  # self-contained atoms passed through
+        self.lock = threading.Lock()  # the reviser may be shared by threads
         self.llm_handler = LLMHandler(model_id, backend)
 
         self.prompt_begin = self.llm_handler.get_prompt_begin()
@@ -59,6 +127,71 @@ class AtomReviser:
             
         print(f"[AtomReviser] Using LLM on {self.backend}: {self.model_id}")
         print(f"[AtomReviser] Using prompt version: {self.prompt_version}")
+        print(f"[AtomReviser] Using batch size: {self.batch_size}")
+        print(f"[AtomReviser] Using context window: {self.context_window}")
+
+        if self.context_window is not None:
+            try:
+                nltk.data.find('tokenizers/punkt')
+            except LookupError:
+                print("'punkt' not found. Downloading...")
+                nltk.download('punkt')
+
+    def find_source_sentence(self, unit: str, sentences: List[str]) -> int:
+        """
+        Return the index of the sentence most similar to the atomic unit.
+
+        Args:
+            unit: str
+                The atomic unit.
+            sentences: List[str]
+                The sentences of the response.
+        """
+
+        scores = [fuzz.token_set_ratio(unit, sentence) for sentence in sentences]
+        return max(range(len(sentences)), key=lambda i: (scores[i], -i))
+
+    def make_context(self, units: List[str], response: str) -> str:
+        """
+        Create the local context of the atomic units: the first sentence of the
+        response followed by the window of sentences around the source sentence
+        of each unit (in response order). Skipped sentences are marked by "...".
+
+        Args:
+            units: List[str]
+                The atomic units (extracted from the same response).
+            response: str
+                The response from which the atomic units are extracted.
+
+        Returns:
+            str: The local context (the whole response if no window is used).
+        """
+
+        if self.context_window is None:
+            return response
+
+        sentences = [sent.strip() for sent in sent_tokenize(response) if len(sent.strip()) > 0]
+        if len(sentences) <= 2 * self.context_window + 2:
+            return response
+
+        selected = set([0])  # the topic anchor
+        for unit in units:
+            i = self.find_source_sentence(unit, sentences)
+            start = max(0, i - self.context_window)
+            end = min(len(sentences), i + self.context_window + 1)
+            selected.update(range(start, end))
+
+        context = []
+        prev = -1
+        for i in sorted(selected):
+            if i > prev + 1:
+                context.append("...")
+            context.append(sentences[i])
+            prev = i
+        if prev < len(sentences) - 1:
+            context.append("...")
+
+        return " ".join(context)
 
     def make_prompt(self, unit: str, response: str):
         """
@@ -96,21 +229,49 @@ class AtomReviser:
         
         return prompt
         
-    def run(self, atoms: List[str], response: str):
+    def make_batch_prompt(self, units: List[str], response: str):
         """
-        Decontextualize a list of atomic units from a given response.
-        
+        Create a prompt for the LLM to decontextualize several atomic units.
+
         Args:
-            atoms: List[str]
-                A list of atomic units to be decontextualized.
+            units: List[str]
+                The atomic units to be decontextualized.
             response: str
-                The response from which the atomic units are decontextualized.
+                The context or response from which the atomic units are extracted.
+
+        Returns:
+            str: The formatted prompt for the LLM.
         """
-        
-        results = []
-        prompts = [self.make_prompt(atom, response) for atom in atoms]
-        print(f"[AtomReviser] Prompts created: {len(prompts)}")
 
+        units_str = "\n".join([f"{i + 1}. {unit}" for i, unit in enumerate(units)])
+        if self.prompt_version == "v1":
+            prompt = ATOM_REVISER_BATCH_PROMPT_V1.format(
+                _UNITS_PLACEHOLDER=units_str,
+                _RESPONSE_PLACEHOLDER=response,
+                _PROMPT_BEGIN_PLACEHOLDER=self.prompt_begin,
+                _PROMPT_END_PLACEHOLDER=self.prompt_end
+            )
+        elif self.prompt_version == "v2":
+            prompt = ATOM_REVISER_BATCH_PROMPT_V2.format(
+                _UNITS_PLACEHOLDER=units_str,
+                _RESPONSE_PLACEHOLDER=response,
+                _PROMPT_BEGIN_PLACEHOLDER=self.prompt_begin,
+                _PROMPT_END_PLACEHOLDER=self.prompt_end
+            )
+        else:
+            raise ValueError(f"Unknown prompt version: {self.prompt_version}. "
+                             f"Supported versions are: 'v1', 'v2'.")
+
+        prompt = strip_string(prompt)
+
+        return prompt
+
+    def _generate(self, prompts: List[str]) -> List[str]:
+        """
+        Generate the outputs for a list of prompts (in batch).
+        """
+
+        results = []
         for _, response in tqdm(
             enumerate(
                 self.llm_handler.batch_completion(
@@ -123,11 +284,127 @@ class AtomReviser:
             ):
                 results.append(response.choices[0].message.content)
 
+        return results
+
+    def _extract(self, outputs: List[str]) -> List[str]:
+        """
+        Extract the revised atoms from the outputs of the single-atom prompts.
+        """
+
         revised_atoms = []
         if self.prompt_version == "v1":
-            revised_atoms = [extract_first_code_block(output, ignore_language=True) for output in results]
+            revised_atoms = [extract_first_code_block(output, ignore_language=True) for output in outputs]
         elif self.prompt_version == "v2":
-            revised_atoms = [extract_last_wrapped_response(output) for output in results]
+            revised_atoms = [extract_last_wrapped_response(output) for output in outputs]
+
+        return revised_atoms
+
+    def revise_batched(self, atoms: List[str], responses: List[str]) -> List[str]:
+        """
+        Decontextualize the atomic units using `batch_size` units per prompt.
+        The units of a prompt must share the same response. The units whose
+        output fails to parse are revised with single-atom prompts.
+
+        Args:
+            atoms: List[str]
+                A list of atomic units to be decontextualized.
+            responses: List[str]
+                The response of each atomic unit.
+
+        Returns:
+            List[str]: The revised atomic units (empty string on failure).
+        """
+
+        # Group consecutive atoms sharing the same response into chunks of size K
+        chunks = []
+        for i in range(len(atoms)):
+            if len(chunks) > 0 and len(chunks[-1]) < self.batch_size \
+                    and responses[chunks[-1][0]] == responses[i]:
+                chunks[-1].append(i)
+            else:
+                chunks.append([i])
+
+        prompts = []
+        for chunk in chunks:
+            units = [atoms[i] for i in chunk]
+            prompts.append(self.make_batch_prompt(units, self.make_context(units, responses[chunk[0]])))
+        print(f"[AtomReviser] Batched prompts created: {len(prompts)}")
+        outputs = self._generate(prompts)
+
+        revised_atoms = [""] * len(atoms)
+        for chunk, output in zip(chunks, outputs):
+            revised = parse_batch_output(output, len(chunk))
+            for j, i in enumerate(chunk):
+                revised_atoms[i] = revised.get(j, "")
+
+        # Fall back to single-atom prompts for the atoms that failed to parse
+        failed = [i for i in range(len(atoms)) if len(revised_atoms[i]) == 0]
+        if len(failed) > 0:
+            print(f"[AtomReviser] Falling back to single-atom prompts for {len(failed)} atoms.")
+            prompts = [self.make_prompt(atoms[i], self.make_context([atoms[i]], responses[i])) for i in failed]
+            outputs = self._extract(self._generate(prompts))
+            for i, revised_atom in zip(failed, outputs):
+                revised_atoms[i] = revised_atom
+
+        return revised_atoms
+
+    def revise(self, atoms: List[str], responses: List[str]) -> List[str]:
+        """
+        Decontextualize the atomic units, each with its own response. If the
+        anaphora detector is enabled, only the flagged atoms are revised.
+
+        Args:
+            atoms: List[str]
+                A list of atomic units to be decontextualized.
+            responses: List[str]
+                The response of each atomic unit.
+
+        Returns:
+            List[str]: The revised atomic units (empty string on failure).
+        """
+
+        if self.detector is not None:
+            flags = self.detector.run(atoms)
+            selected = [i for i in range(len(atoms)) if flags[i]]
+            with self.lock:
+                self.num_hits += len(selected)
+                self.num_skipped += len(atoms) - len(selected)
+            print(f"[AtomReviser] Anaphora hits: {len(selected)}, skipped: {len(atoms) - len(selected)}")
+        else:
+            selected = list(range(len(atoms)))
+
+        revised_atoms = [atom for atom in atoms]
+        if len(selected) == 0:
+            return revised_atoms
+
+        sel_atoms = [atoms[i] for i in selected]
+        sel_responses = [responses[i] for i in selected]
+        if self.batch_size > 1:
+            outputs = self.revise_batched(sel_atoms, sel_responses)
+        else:
+            prompts = [
+                self.make_prompt(atom, self.make_context([atom], response))
+                for atom, response in zip(sel_atoms, sel_responses)
+            ]
+            print(f"[AtomReviser] Prompts created: {len(prompts)}")
+            outputs = self._extract(self._generate(prompts))
+
+        for i, revised_atom in zip(selected, outputs):
+            revised_atoms[i] = revised_atom
+        return revised_atoms
+
+    def run(self, atoms: List[str], response: str):
+        """
+        Decontextualize a list of atomic units from a given response.
+        
+        Args:
+            atoms: List[str]
+                A list of atomic units to be decontextualized.
+            response: str
+                The response from which the atomic units are decontextualized.
+        """
+        
+        revised_atoms = self.revise(atoms, [response] * len(atoms))
 
         for revised_atom in revised_atoms:
             if len(revised_atom) > 0:
@@ -158,27 +435,9 @@ class AtomReviser:
         """
 
         n = len(responses)
-        results = []
-        prompts = [self.make_prompt(atom, response) for i, response in enumerate(responses) for atom in atoms[i]]
-        print(f"[AtomReviser] Prompts created: {len(prompts)}")
-
-        for _, response in tqdm(
-            enumerate(
-                self.llm_handler.batch_completion(
-                    prompts
-                )
-            ),
-            total=len(prompts),
-            desc="Decontextualization",
-            unit="prompts",
-            ):
-                results.append(response.choices[0].message.content)
-
-        revised_atoms = []
-        if self.prompt_version == "v1":
-            revised_atoms = [extract_first_code_block(output, ignore_language=True) for output in results]
-        elif self.prompt_version == "v2":
-            revised_atoms = [extract_last_wrapped_response(output) for output in results]
+        flat_atoms = [atom for i in range(n) for atom in atoms[i]]
+        flat_responses = [responses[i] for i in range(n) for _ in atoms[i]]
+        revised_atoms = self.revise(flat_atoms, flat_responses)
 
         # TODO: need to fix the problematic revised atoms!!
         for revised_atom in revised_atoms:
@@ -0,0 +1,421 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline BM25 retrieval over a local passage corpus (persisted inverted index)
+
+import argparse
+import json
+import math
+import mmap
+import os
+import re
+import time
+import numpy as np
+
+from array import array
+from collections import Counter
+from typing import Iterator, List, Optional, Tuple
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+STOPWORDS = set([
+    "a", "an", "the", "and", "or", "but", "of", "in", "on", "at", "to", "for",
+    "from", "by", "with", "as", "into", "about", "than", "that", "which", "who",
+    "whom", "whose", "is", "are", "was", "were", "be", "been", "being", "has",
+    "have", "had", "do", "does", "did", "it", "its", "this", "these", "those",
+    "there", "s",
+])
+
+MAX_TF = np.iinfo(np.uint16).max
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens of the text, without stopwords.
+    """
+
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def read_corpus(corpus_file: str) -> Iterator[dict]:
+    """
+    Iterate over the passages of a JSONL corpus. Each line is a dict with a
+    `text` and, optionally, a `title` and a `link` (or `url`).
+    """
+
+    with open(corpus_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            doc = json.loads(line)
+            yield dict(
+                title=doc.get("title", ""),
+                text=doc.get("text", doc.get("contents", "")),
+                link=doc.get("link", doc.get("url", "")),
+            )
+
+
+def write_strings(strings: List[str], index_dir: str, data_file: str, offsets_file: str):
+    """
+    Write the strings (UTF-8) to `data_file` and their byte offsets to `offsets_file`.
+    """
+
+    offsets = array("Q", [0])
+    with open(os.path.join(index_dir, data_file), "wb") as f:
+        for string in strings:
+            data = string.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(index_dir, offsets_file), np.frombuffer(offsets, dtype=np.uint64))
+
+
+def bm25_scores(tfs: np.ndarray, lengths: np.ndarray, avgdl: float, k1: float, b: float) -> np.ndarray:
+    """
+    Return the BM25 term frequency scores (without the idf) of the postings.
+    """
+
+    tfs = np.asarray(tfs, dtype=np.float32)
+    norm = k1 * (1.0 - b + b * np.asarray(lengths, dtype=np.float32) / avgdl)
+    return tfs * (k1 + 1.0) / (tfs + norm)
+
+
+def build_bm25_index(
+        corpus_file: str,
+        index_dir: str,
+        k1: float = 1.5,
+        b: float = 0.75,
+        log_every: int = 100000,
+):
+    """
+    Build the BM25 inverted index of a JSONL passage corpus. The index
+    directory contains:
+        - docs.bin, doc_offsets.npy: the passages (JSON) and their offsets,
+        - doc_lengths.npy: the number of tokens of each passage,
+        - terms.bin, term_key_offsets.npy: the sorted terms (the term id is
+          the rank of the term),
+        - term_offsets.npy, postings_docs.npy, postings_tfs.npy: the postings
+          (passage ids and term frequencies) of each term,
+        - term_max_scores.npy: the maximum BM25 score of each term (used to
+          prune the search),
+        - meta.json: the corpus statistics and BM25 parameters.
+
+    Args:
+        corpus_file: str
+            Path to the JSONL corpus.
+        index_dir: str
+            The directory where the index is written.
+        k1: float
+            The BM25 term frequency saturation parameter.
+        b: float
+            The BM25 length normalization parameter.
+        log_every: int
+            Report progress every `log_every` passages.
+    """
+
+    os.makedirs(index_dir, exist_ok=True)
+    start = time.time()
+
+    vocab = {}
+    postings_docs = []  # per term: array of passage ids
+    postings_tfs = []  # per term: array of term frequencies
+    doc_offsets = array("Q", [0])
+    doc_lengths = array("I")
+
+    with open(os.path.join(index_dir, "docs.bin"), "wb") as f:
+        for doc_id, doc in enumerate(read_corpus(corpus_file)):
+            data = json.dumps(doc).encode("utf-8")
+            f.write(data)
+            doc_offsets.append(doc_offsets[-1] + len(data))
+
+            tokens = tokenize(doc["title"] + " " + doc["text"])
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_id = vocab.get(term, None)
+                if term_id is None:
+                    term_id = len(vocab)
+                    vocab[term] = term_id
+                    postings_docs.append(array("I"))
+                    postings_tfs.append(array("H"))
+                postings_docs[term_id].append(doc_id)
+                postings_tfs[term_id].append(min(tf, MAX_TF))
+
+            if (doc_id + 1) % log_every == 0:
+                print(f"[BM25Index] Indexed {doc_id + 1} passages ({time.time() - start:.1f}s)")
+
+    num_docs = len(doc_lengths)
+    assert num_docs > 0, f"The corpus {corpus_file} is empty."
+
+    # Term ids follow the sorted terms, so a term is found by binary search
+    terms = sorted(vocab.keys())  # code point order, i.e., UTF-8 byte order
+    order = [vocab[term] for term in terms]
+    del vocab
+    write_strings(terms, index_dir, "terms.bin", "term_key_offsets.npy")
+
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    term_offsets[1:] = np.cumsum([len(postings_docs[i]) for i in order], dtype=np.uint64)
+    docs = np.concatenate([np.frombuffer(postings_docs[i], dtype=np.uint32) for i in order])
+    del postings_docs
+    tfs = np.concatenate([np.frombuffer(postings_tfs[i], dtype=np.uint16) for i in order])
+    del postings_tfs
+
+    lengths = np.frombuffer(doc_lengths, dtype=np.uint32)
+    avgdl = float(np.mean(lengths))
+    scores = bm25_scores(tfs, lengths[docs], avgdl, k1, b)
+    dfs = np.diff(term_offsets).astype(np.float64)
+    idfs = np.log(1.0 + (num_docs - dfs + 0.5) / (dfs + 0.5))
+    max_scores = (np.maximum.reduceat(scores, term_offsets[:-1].astype(np.int64)) * idfs).astype(np.float32)
+    max_scores = np.nextafter(max_scores, np.float32(np.inf))  # an upper bound despite the rounding
+    del scores
+
+    np.save(os.path.join(index_dir, "term_offsets.npy"), term_offsets)
+    np.save(os.path.join(index_dir, "postings_docs.npy"), docs)
+    np.save(os.path.join(index_dir, "postings_tfs.npy"), tfs)
+    np.save(os.path.join(index_dir, "term_max_scores.npy"), max_scores)
+    np.save(os.path.join(index_dir, "doc_offsets.npy"), np.frombuffer(doc_offsets, dtype=np.uint64))
+    np.save(os.path.join(index_dir, "doc_lengths.npy"), lengths)
+
+    meta = dict(
+        num_docs=num_docs,
+        num_terms=len(terms),
+        avgdl=avgdl,
+        k1=k1,
+        b=b,
+    )
+    with open(os.path.join(index_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    print(f"[BM25Index] Built index of {num_docs} passages, {len(terms)} terms in {time.time() - start:.1f}s")
+
+
+class BM25Index:
+    """
+    Query a BM25 inverted index built by `build_bm25_index`. The terms,
+    postings and passages are memory-mapped (the terms are found by binary
+    search), so only the postings of the query terms and the top passages
+    are read. The search is pruned with the maximum score of each term
+    (MaxScore): once the terms left cannot lift a new passage into the top
+    k, their postings are only probed for the current candidates. Fully
+    offline.
+    """
+
+    def __init__(self, index_dir: str):
+        """
+        Open the index.
+
+        Args:
+            index_dir: str
+                The directory of the index.
+        """
+
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+
+        self.num_docs = meta["num_docs"]
+        self.num_terms = meta["num_terms"]
+        self.avgdl = meta["avgdl"]
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+
+        load = lambda name: np.load(os.path.join(index_dir, name), mmap_mode="r")
+        self.term_offsets = load("term_offsets.npy")
+        self.postings_docs = load("postings_docs.npy")
+        self.postings_tfs = load("postings_tfs.npy")
+        self.doc_offsets = load("doc_offsets.npy")
+        self.doc_lengths = load("doc_lengths.npy")
+        self.term_key_offsets = load("term_key_offsets.npy")
+        self.term_max_scores = load("term_max_scores.npy")
+
+        self.files = []
+        self.docs = self._map("docs.bin")
+        self.terms = self._map("terms.bin")
+
+        print(f"[BM25Index] Loaded index of {self.num_docs} passages from {index_dir}")
+
+    def _map(self, name: str) -> mmap.mmap:
+        f = open(os.path.join(self.index_dir, name), "rb")
+        self.files.append(f)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def idf(self, df: int) -> float:
+        return math.log(1.0 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def get_term(self, term_id: int) -> bytes:
+        return self.terms[int(self.term_key_offsets[term_id]):int(self.term_key_offsets[term_id + 1])]
+
+    def lookup(self, term: str) -> Optional[int]:
+        """
+        Return the id of the term, or None (binary search of the sorted terms).
+        """
+
+        key = term.encode("utf-8")
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_terms and self.get_term(lo) == key:
+            return lo
+        return None
+
+    def get_doc(self, doc_id: int) -> dict:
+        """
+        Return the passage (dict with title, text and link).
+        """
+
+        start, end = int(self.doc_offsets[doc_id]), int(self.doc_offsets[doc_id + 1])
+        return json.loads(self.docs[start:end].decode("utf-8"))
+
+    def _term_scores(self, term_id: int, positions: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the passage ids and BM25 scores of the term's postings (all of
+        them, or those at the given positions of the postings list).
+        """
+
+        start, end = int(self.term_offsets[term_id]), int(self.term_offsets[term_id + 1])
+        if positions is None:
+            positions = slice(0, end - start)
+        docs = np.asarray(self.postings_docs[start:end][positions])
+        tfs = self.postings_tfs[start:end][positions]
+        scores = self.idf(end - start) * bm25_scores(tfs, self.doc_lengths[docs], self.avgdl, self.k1, self.b)
+        return docs, scores.astype(np.float32)
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[int, float]]:
+        """
+        Return the ids and scores of the top k passages for the query.
+        """
+
+        term_ids = set(self.lookup(t) for t in tokenize(query))
+        term_ids = sorted([t for t in term_ids if t is not None], key=lambda t: -self.term_max_scores[t])
+        if len(term_ids) == 0 or k <= 0:
+            return []
+
+        # Terms with the highest maximum score first, while a passage that
+        # has none of them can still reach the top k
+        left = float(np.sum(self.term_max_scores[term_ids]))  # score bound of the terms left
+        docs = np.zeros(0, dtype=np.uint32)
+        scores = np.zeros(0, dtype=np.float32)
+        threshold = 0.0  # the k-th best score so far
+        num_full = 0
+        while num_full < len(term_ids) and (len(docs) < k or left >= threshold):
+            term_id = term_ids[num_full]
+            num_full += 1
+            left -= float(self.term_max_scores[term_id])
+            term_docs, term_scores = self._term_scores(term_id)
+            docs, inverse = np.unique(np.concatenate([docs, term_docs]), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate([scores, term_scores]), minlength=len(docs))
+            scores = scores.astype(np.float32)
+            if len(docs) >= k:
+                threshold = float(np.partition(scores, len(docs) - k)[len(docs) - k])
+
+        # The other terms only add to the scores of the candidates that can
+        # still reach the top k
+        for term_id in term_ids[num_full:]:
+            keep = scores + left >= threshold
+            docs, scores = docs[keep], scores[keep]
+            left -= float(self.term_max_scores[term_id])
+            start, end = int(self.term_offsets[term_id]), int(self.term_offsets[term_id + 1])
+            positions = np.searchsorted(self.postings_docs[start:end], docs)
+            found = positions < end - start
+            found[found] = self.postings_docs[start:end][positions[found]] == docs[found]
+            if np.any(found):
+                _, term_scores = self._term_scores(term_id, positions[found])
+                scores[found] += term_scores
+            threshold = max(threshold, float(np.partition(scores, len(docs) - k)[len(docs) - k]))
+
+        k = min(k, len(docs))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((docs[top], -scores[top]))]
+        return [(int(docs[i]), float(scores[i])) for i in top]
+
+    def search_many(self, queries: List[str], k: int = 5) -> List[List[dict]]:
+        """
+        Return the top k passages for each of the queries.
+
+        Args:
+            queries: List[str]
+                The query texts.
+            k: int
+                The number of passages retrieved per query.
+
+        Returns:
+            List[List[dict]]
+                The passages (dicts with title, text, link, doc_id and score) of
+                each query, where doc_id is the index of the passage in the corpus.
+        """
+
+        results = []
+        for query in queries:
+            results.append([dict(**self.get_doc(i), doc_id=i, score=s) for i, s in self.search(query, k)])
+        return results
+
+    def close(self):
+        self.docs.close()
+        self.terms.close()
+        for f in self.files:
+            f.close()
+
+
+if __name__ == "__main__":
+
+    # CLI arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--corpus_file',
+        type=str,
+        required=True,
+        help="Path to the JSONL passage corpus (title, text, link)."
+    )
+
+    parser.add_argument(
+        '--index_dir',
+        type=str,
+        required=True,
+        help="Directory where the BM25 index is written."
+    )
+
+    parser.add_argument(
+        '--k1',
+        type=float,
+        default=1.5,
+        help="BM25 k1 parameter."
+    )
+
+    parser.add_argument(
+        '--b',
+        type=float,
+        default=0.75,
+        help="BM25 b parameter."
+    )
+
+    parser.add_argument(
+        '--query',
+        type=str,
+        default=None,
+        help="Run a test query against the index after building it."
+    )
+
+    # Parse CLI arguments
+    args = parser.parse_args()
+
+    build_bm25_index(args.corpus_file, args.index_dir, k1=args.k1, b=args.b)
+    if args.query is not None:
+        index = BM25Index(args.index_dir)
+        for passage in index.search_many([args.query], k=5)[0]:
+            print(f"{passage['score']:.3f}: {passage['title']}")
+    print("Done.")
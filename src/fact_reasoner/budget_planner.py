@@ -0,0 +1,681 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Budgeted verification planner (retrieval, summarization and NLI across atoms)
+
+import math
+import time
+
+from typing import Dict, List, Tuple
+
+# Local imports
+from src.fact_reasoner.context_retriever import ContextRetriever
+from src.fact_reasoner.context_summarizer import ContextSummarizer
+from src.fact_reasoner.fact_utils import (
+    Atom,
+    Context,
+    Relation,
+    is_relevant_context,
+    predict_context_context_relationships,
+    predict_nli_relationships,
+)
+from src.fact_reasoner.llm_handler import LLMHandler
+from src.fact_reasoner.nli_extractor import NLIExtractor
+
+# Token estimate used before any LLM call has been observed
+DEFAULT_TOKENS_PER_CALL = 1000
+
+# The per-atom verification stages, in the order they are executed
+STAGE_RETRIEVE = "retrieve"
+STAGE_SUMMARIZE = "summarize"
+STAGE_RELATE = "relate"
+STAGE_DONE = "done"
+STAGE_RELATE_CONTEXTS = "relate_contexts"  # shared by all atoms, run last
+
+
+def binary_entropy(p: float) -> float:
+    """
+    Entropy (in bits) of a binary variable that is true with probability p.
+    """
+
+    p = min(max(p, 1e-6), 1.0 - 1e-6)
+    return -(p * math.log(p) + (1.0 - p) * math.log(1.0 - p)) / math.log(2.0)
+
+
+class VerificationBudget:
+    """
+    A hard budget on the work spent to verify a single response. The budget
+    may limit the number of LLM calls, the number of tokens (prompt and
+    completion) and the wall-clock time. A limit set to None is not enforced.
+    """
+
+    def __init__(
+            self,
+            max_llm_calls: int = None,
+            max_tokens: int = None,
+            max_seconds: float = None
+    ):
+        """
+        Initialize the budget.
+
+        Args:
+            max_llm_calls: int
+                Maximum number of LLM calls per response.
+            max_tokens: int
+                Maximum number of tokens (prompt and completion) per response.
+            max_seconds: float
+                Maximum wall-clock time (in seconds) per response.
+        """
+
+        self.max_llm_calls = max_llm_calls
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+
+        self.handlers = []
+        self.start_time = None
+        self.start_calls = 0
+        self.start_tokens = 0
+
+    def start(self, handlers: List[LLMHandler]):
+        """
+        Start tracking the budget over the given LLM handlers. The usage is
+        measured relative to the state of the handlers at this point.
+
+        Args:
+            handlers: List[LLMHandler]
+                The LLM handlers used by the pipeline components.
+        """
+
+        self.handlers = []
+        for handler in handlers:
+            if handler is not None and all(handler is not h for h in self.handlers):
+                self.handlers.append(handler)
+
+        self.start_time = time.time()
+        self.start_calls = sum(h.num_calls for h in self.handlers)
+        self.start_tokens = sum(h.get_num_tokens() for h in self.handlers)
+
+    def used_llm_calls(self) -> int:
+        return sum(h.num_calls for h in self.handlers) - self.start_calls
+
+    def used_tokens(self) -> int:
+        return sum(h.get_num_tokens() for h in self.handlers) - self.start_tokens
+
+    def elapsed_seconds(self) -> float:
+        return 0.0 if self.start_time is None else time.time() - self.start_time
+
+    def tokens_per_call(self) -> float:
+        """
+        Return the average number of tokens per LLM call observed so far.
+        """
+
+        num_calls = self.used_llm_calls()
+        if num_calls == 0 or self.used_tokens() == 0:
+            return DEFAULT_TOKENS_PER_CALL
+        return self.used_tokens() / num_calls
+
+    def can_afford(self, num_calls: int, num_seconds: float = 0.0) -> bool:
+        """
+        Check if a unit of work can be carried out within the remaining budget.
+
+        Args:
+            num_calls: int
+                The (estimated) number of LLM calls required by the work.
+            num_seconds: float
+                The (estimated) wall-clock time required by the work.
+        """
+
+        if self.max_llm_calls is not None \
+                and self.used_llm_calls() + num_calls > self.max_llm_calls:
+            return False
+        if self.max_tokens is not None \
+                and self.used_tokens() + num_calls * self.tokens_per_call() > self.max_tokens:
+            return False
+        if self.max_seconds is not None \
+                and self.elapsed_seconds() + num_seconds > self.max_seconds:
+            return False
+        return True
+
+    def is_exhausted(self) -> bool:
+        """
+        Check if any of the limits has been reached.
+        """
+
+        if self.max_llm_calls is not None and self.used_llm_calls() >= self.max_llm_calls:
+            return True
+        if self.max_tokens is not None and self.used_tokens() >= self.max_tokens:
+            return True
+        if self.max_seconds is not None and self.elapsed_seconds() >= self.max_seconds:
+            return True
+        return False
+
+    def report(self) -> dict:
+        """
+        Return a dict with the budget limits and the resources used so far.
+        """
+
+        return dict(
+            max_llm_calls=self.max_llm_calls,
+            max_tokens=self.max_tokens,
+            max_seconds=self.max_seconds,
+            used_llm_calls=self.used_llm_calls(),
+            used_tokens=self.used_tokens(),
+            used_seconds=self.elapsed_seconds(),
+        )
+
+
+class BudgetPlanner:
+    """
+    Allocate the retrieval, summarization and NLI work across the atoms of a
+    response. At each step, the planner advances the atom with the largest
+    expected information gain per LLM call still needed to verify it, where
+    the gain is approximated by the entropy of the atom's current probability
+    estimate.
+    A context is related to the atoms only once it is final, i.e., after it
+    has been summarized (if summarization is enabled), so that no relation
+    points to a context that is later dropped as irrelevant. The
+    context-context relations (if any) are built last, in batches of pairs
+    that fit in the remaining budget.
+    When the budget runs out, the planner stops and returns whatever contexts
+    and relations have been built so far (the contexts that were never
+    summarized are dropped).
+    """
+
+    def __init__(
+            self,
+            context_retriever: ContextRetriever,
+            nli_extractor: NLIExtractor,
+            context_summarizer: ContextSummarizer = None,
+            budget: VerificationBudget = None,
+            summarize_contexts: bool = False,
+            contexts_per_atom_only: bool = False,
+            rel_context_context: bool = False,
+            remove_duplicates: bool = False,
+            text_only: bool = True,
+            min_entropy: float = 0.5,
+            topic: str = None,
+    ):
+        """
+        Initialize the planner.
+
+        Args:
+            context_retriever: ContextRetriever
+                The service used for retrieving external contexts.
+            nli_extractor: NLIExtractor
+                The service used for NLI relationship extraction.
+            context_summarizer: ContextSummarizer
+                The service used for summarizing contexts.
+            budget: VerificationBudget
+                The budget. If None, all the work is carried out.
+            summarize_contexts: bool
+                Flag indicating if contexts are to be summarized.
+            contexts_per_atom_only: bool
+                Flag indicating that only the contexts retrieved per atom will be used.
+            rel_context_context: bool
+                Flag indicating the presence of context-to-context relationships.
+            remove_duplicates: bool
+                Flag indicating if duplicated contexts are to be removed.
+            text_only: bool
+                Flag indicating that contexts are text only.
+            min_entropy: float
+                Atoms whose estimated entropy drops below this value are considered
+                decided and are not related to additional (other atoms') contexts.
+            topic: str
+                The topic of the response (used for query generation).
+        """
+
+        self.context_retriever = context_retriever
+        self.nli_extractor = nli_extractor
+        self.context_summarizer = context_summarizer
+        self.budget = budget
+        self.summarize_contexts = summarize_contexts
+        self.contexts_per_atom_only = contexts_per_atom_only
+        self.rel_context_context = rel_context_context
+        self.remove_duplicates = remove_duplicates
+        self.text_only = text_only
+        self.min_entropy = min_entropy
+        self.topic = topic
+
+        if self.summarize_contexts:
+            assert self.context_summarizer is not None, f"Context summarizer must be created."
+
+        self.atoms = {}
+        self.contexts = {}
+        self.relations = []
+        self.stages = {}  # indexed by atom id
+        self.paired = {}  # context ids already related to each atom
+        self.ready = set()  # ids of the final (summarized) contexts
+        self.paired_contexts = set()  # context id pairs already related
+        self.durations = {}  # average duration (seconds) of each stage
+        self.query_calls = {}  # LLM calls of the query generation, by (text, topic)
+
+    def estimate_probability(self, atom: Atom) -> float:
+        """
+        Cheap estimate of the probability of the atom being true given the
+        relations found so far. Each entailment (contradiction) relation adds
+        (subtracts) its log-odds to the atom's prior log-odds. This is only
+        used for planning; the final marginals are computed by merlin.
+        """
+
+        prior = min(max(atom.probability, 1e-6), 1.0 - 1e-6)
+        logit = math.log(prior / (1.0 - prior))
+        for rel in self.relations:
+            if rel.target is not atom:
+                continue
+            p = min(max(rel.get_probability(), 0.5), 1.0 - 1e-3)
+            if rel.get_type() == "entailment":
+                logit += math.log(p / (1.0 - p))
+            elif rel.get_type() == "contradiction":
+                logit -= math.log(p / (1.0 - p))
+
+        logit = min(max(logit, -30.0), 30.0)
+        return 1.0 / (1.0 + math.exp(-logit))
+
+    def _unpaired_contexts(self, atom: Atom) -> List[Context]:
+        """
+        Return the final contexts that are not yet related to the atom.
+        """
+
+        if self.contexts_per_atom_only:
+            candidates = [c for cid, c in atom.get_contexts().items() if cid in self.contexts]
+        else:
+            candidates = list(self.contexts.values())
+        return [c for c in candidates if c.id in self.ready and c.id not in self.paired[atom.id]]
+
+    def _unpaired_context_pairs(self) -> List[Tuple[Context, Context]]:
+        """
+        Return the pairs of final contexts that are not yet related.
+        """
+
+        cids = sorted([cid for cid in self.contexts.keys() if cid in self.ready])
+        pairs = []
+        for i, ci in enumerate(cids):
+            for cj in cids[i + 1:]:
+                if (ci, cj) not in self.paired_contexts:
+                    pairs.append((self.contexts[ci], self.contexts[cj]))
+        return pairs
+
+    def _retrieval_calls(self, text: str, topic: str = None) -> int:
+        """
+        Return the number of LLM calls needed to retrieve the contexts of the
+        text: one if its search query is generated by an LLM (google, with
+        the llm generator or, with the auto generator, if the rule based query
+        is escalated), none otherwise.
+        """
+
+        query_builder = self.context_retriever.query_builder
+        if self.context_retriever.service_type != "google" or query_builder is None:
+            return 0
+        if (text, topic) not in self.query_calls:
+            self.query_calls[(text, topic)] = 1 if query_builder.needs_llm(text, topic) else 0
+        return self.query_calls[(text, topic)]
+
+    def _unsummarized_contexts(self, contexts: List[Context]) -> List[Context]:
+        """
+        Return the contexts that are summarized next (i.e., not final yet).
+        """
+
+        return [c for c in contexts if c.id in self.contexts and c.id not in self.ready]
+
+    def _summary_calls(self, contexts: List[Context]) -> int:
+        """
+        Return the number of LLM calls needed to summarize the contexts (the
+        empty ones are not sent to the summarizer).
+        """
+
+        return len([c for c in self._unsummarized_contexts(contexts) if c.get_snippet_and_text() != ""])
+
+    def _num_calls(self, atom: Atom, stage: str) -> int:
+        """
+        Estimate the number of LLM calls required by the atom's next stage.
+        """
+
+        if stage == STAGE_RETRIEVE:
+            return self._retrieval_calls(atom.text, self.topic)
+        elif stage == STAGE_SUMMARIZE:
+            return self._summary_calls(list(atom.get_contexts().values()))
+        elif stage == STAGE_RELATE:
+            return len(self._unpaired_contexts(atom))
+        return 0
+
+    def _remaining_calls(self, atom: Atom, stage: str) -> int:
+        """
+        Estimate the number of LLM calls required to complete the atom's
+        verification starting from the given stage.
+        """
+
+        if stage == STAGE_RETRIEVE:
+            num_contexts = getattr(self.context_retriever, "top_k", 1)
+            if not self.contexts_per_atom_only:
+                num_contexts += len(self.contexts)
+            num_calls = self._num_calls(atom, stage) + num_contexts
+            if self.summarize_contexts:
+                num_calls += getattr(self.context_retriever, "top_k", 1)
+            return num_calls
+        elif stage == STAGE_SUMMARIZE:
+            return self._num_calls(atom, stage) + len(self._unpaired_contexts(atom))
+        return self._num_calls(atom, stage)
+
+    def _pending_stage(self, atom: Atom) -> str:
+        """
+        Return the next stage to be executed for the atom (if any).
+        """
+
+        stage = self.stages[atom.id]
+        if stage == STAGE_DONE and len(self._unpaired_contexts(atom)) > 0 \
+                and binary_entropy(self.estimate_probability(atom)) >= self.min_entropy:
+            return STAGE_RELATE  # relate the atom to newly retrieved contexts
+        return stage
+
+    def _time_stage(self, stage: str, start: float):
+        """
+        Keep a running average of the wall-clock time of each stage.
+        """
+
+        duration = time.time() - start
+        if stage in self.durations:
+            self.durations[stage] = 0.5 * (self.durations[stage] + duration)
+        else:
+            self.durations[stage] = duration
+
+    def _add_contexts(self, contexts: List[Context]) -> List[Context]:
+        """
+        Add the new contexts to the planner (skipping duplicates if needed).
+        """
+
+        added = []
+        texts = set([c.get_text(text_only=False) for c in self.contexts.values()])
+        for context in contexts:
+            text = context.get_text(text_only=False)
+            if self.remove_duplicates and text in texts:
+                continue
+            if not self.summarize_contexts:
+                context.set_synthetic_summary(context.get_snippet_and_text())
+                self.ready.add(context.id)
+            self.contexts[context.id] = context
+            texts.add(text)
+            added.append(context)
+        return added
+
+    def retrieve(self, atom: Atom) -> List[Context]:
+        """
+        Retrieve the contexts for the atom.
+        """
+
+        retrieved_contexts = self.context_retriever.query(text=atom.text, topic=self.topic)
+        contexts = [
+            Context(
+                id="c_" + atom.id + "_" + str(j),
+                atom=atom,
+                text=context["text"],
+                title=context["title"],
+                link=context["link"],
+                snippet=context["snippet"]
+            ) for j, context in enumerate(retrieved_contexts)
+        ]
+
+        contexts = self._add_contexts(contexts)
+        atom.add_contexts(contexts)
+        return contexts
+
+    def retrieve_question(self, question: str) -> List[Context]:
+        """
+        Retrieve the contexts for the question (shared by all atoms).
+        """
+
+        retrieved_contexts = self.context_retriever.query(text=question)
+        contexts = [
+            Context(
+                id="c_q_" + str(j),
+                atom=None,
+                text=context["text"],
+                title=context["title"],
+                link=context["link"],
+                snippet=context["snippet"]
+            ) for j, context in enumerate(retrieved_contexts)
+        ]
+
+        return self._add_contexts(contexts)
+
+    def _summarize_contexts(self, contexts: List[Context], text: str):
+        """
+        Summarize the contexts given the text (atom or question). The relevant
+        contexts become final, the irrelevant ones are removed together with
+        their relations.
+        """
+
+        if len(contexts) == 0:
+            return
+
+        results = self.context_summarizer.run([context.get_snippet_and_text() for context in contexts], text)
+        for context, result in zip(contexts, results):
+            if result["summary"] != "" and is_relevant_context(result["summary"]):
+                context.set_synthetic_summary(result["summary"])
+                context.set_probability(result["probability"] * context.get_probability())
+                self.ready.add(context.id)
+            else:
+                # we remove the context because it is not related to the atom
+                self._remove_context(context)
+
+    def _remove_context(self, context: Context):
+        """
+        Remove the context and the relations pointing to it.
+        """
+
+        self.contexts.pop(context.id, None)
+        self.ready.discard(context.id)
+        if context.atom is not None:
+            context.atom.contexts.pop(context.id, None)
+        self.relations = [
+            rel for rel in self.relations if rel.source is not context and rel.target is not context
+        ]
+
+    def summarize(self, atom: Atom):
+        """
+        Summarize the atom's contexts given the atom and remove the irrelevant ones.
+        """
+
+        self._summarize_contexts(self._unsummarized_contexts(list(atom.contexts.values())), atom.text)
+
+    def summarize_question(self, question: str):
+        """
+        Summarize the question contexts given the question (as the unbudgeted
+        pipeline does) and remove the irrelevant ones.
+        """
+
+        contexts = [c for cid, c in self.contexts.items() if cid.startswith("c_q") and cid not in self.ready]
+        self._summarize_contexts(contexts, question)
+
+    def relate(self, atom: Atom) -> List[Relation]:
+        """
+        Predict the NLI relationships between the atom and its unpaired contexts.
+        """
+
+        contexts = self._unpaired_contexts(atom)
+        if len(contexts) == 0:
+            return []
+
+        all_rels = predict_nli_relationships(
+            [(context, atom) for context in contexts],
+            nli_extractor=self.nli_extractor,
+            links_type="context_atom",
+            text_only=self.text_only
+        )
+
+        for context in contexts:
+            self.paired[atom.id].add(context.id)
+
+        relations = [rel for rel in all_rels if rel.get_type() != "neutral"]
+        self.relations.extend(relations)
+        return relations
+
+    def relate_contexts(self):
+        """
+        Predict the relationships between the pairs of final contexts, in
+        batches of pairs that fit in the remaining budget (2 NLI calls per pair).
+        """
+
+        pairs = self._unpaired_context_pairs()
+        while len(pairs) > 0:
+            num_pairs = len(pairs)
+            while num_pairs > 0 and not self._affordable(2 * num_pairs, STAGE_RELATE_CONTEXTS):
+                num_pairs //= 2
+            if num_pairs == 0:
+                print(f"[BudgetPlanner] Skipping {len(pairs)} context-context pairs (not enough budget).")
+                return
+
+            start = time.time()
+            batch, pairs = pairs[:num_pairs], pairs[num_pairs:]
+            self.relations.extend(predict_context_context_relationships(
+                batch,
+                nli_extractor=self.nli_extractor,
+                text_only=self.text_only
+            ))
+            for context_i, context_j in batch:
+                self.paired_contexts.add((context_i.id, context_j.id))
+            self._time_stage(STAGE_RELATE_CONTEXTS, start)
+
+    def step(self, atom: Atom, stage: str):
+        """
+        Execute the given stage for the atom and advance the atom's state.
+        """
+
+        start = time.time()
+        if stage == STAGE_RETRIEVE:
+            self.retrieve(atom)
+            self.stages[atom.id] = STAGE_SUMMARIZE if self.summarize_contexts else STAGE_RELATE
+        elif stage == STAGE_SUMMARIZE:
+            self.summarize(atom)
+            self.stages[atom.id] = STAGE_RELATE
+        elif stage == STAGE_RELATE:
+            self.relate(atom)
+            self.stages[atom.id] = STAGE_DONE
+        self._time_stage(stage, start)
+
+    def _affordable(self, num_calls: int, stage: str) -> bool:
+        if self.budget is None:
+            return True
+        return self.budget.can_afford(num_calls, self.durations.get(stage, 0.0))
+
+    def run(
+            self,
+            atoms: Dict[str, Atom],
+            contexts: Dict[str, Context] = None,
+            question: str = None,
+    ) -> Tuple[Dict[str, Context], List[Relation]]:
+        """
+        Run the planner over the atoms until all the work is done or the
+        budget is exhausted.
+
+        Args:
+            atoms: dict
+                A dict containing the atoms in the response.
+            contexts: dict
+                A dict containing previously retrieved contexts (if any). If not
+                empty, then no retrieval is performed.
+            question: str
+                If it is not None, it is used to retrieve additional contexts.
+
+        Returns:
+            A tuple containing the dict of contexts and the list of relations.
+        """
+
+        self.atoms = atoms
+        self.contexts = {}
+        self.relations = []
+        self.durations = {}
+        self.paired = {aid: set() for aid in atoms.keys()}
+        self.ready = set()
+        self.paired_contexts = set()
+        self.query_calls = {}
+
+        has_contexts = contexts is not None and len(contexts) > 0
+        if has_contexts:
+            self._add_contexts(list(contexts.values()))
+        first_stage = STAGE_RETRIEVE
+        if has_contexts:
+            first_stage = STAGE_SUMMARIZE if self.summarize_contexts else STAGE_RELATE
+        self.stages = {aid: first_stage for aid in atoms.keys()}
+
+        print(f"[BudgetPlanner] Planning the verification of {len(atoms)} atoms ...")
+
+        # The question contexts are shared by all atoms, so retrieve them first
+        if not has_contexts and question and not self.contexts_per_atom_only:
+            if self._affordable(self._retrieval_calls(question), STAGE_RETRIEVE):
+                self.retrieve_question(question)
+        question_contexts = [c for cid, c in self.contexts.items() if cid.startswith("c_q")]
+        if self.summarize_contexts and question is None:
+            for context in question_contexts:  # nothing to summarize them against
+                context.set_synthetic_summary(context.get_snippet_and_text())
+                self.ready.add(context.id)
+        elif self.summarize_contexts and len(question_contexts) > 0:
+            if self._affordable(self._summary_calls(question_contexts), STAGE_SUMMARIZE):
+                self.summarize_question(question)
+
+        num_steps = 0
+        while True:
+            if self.budget is not None and self.budget.is_exhausted():
+                print(f"[BudgetPlanner] Budget exhausted after {num_steps} steps.")
+                break
+
+            # Pick the atom with the largest expected gain per remaining LLM call
+            best = None
+            for aid, atom in self.atoms.items():
+                stage = self._pending_stage(atom)
+                if stage == STAGE_DONE:
+                    continue
+                num_calls = self._num_calls(atom, stage)
+                if not self._affordable(num_calls, stage):
+                    continue
+                gain = binary_entropy(self.estimate_probability(atom))
+                priority = gain / max(1, self._remaining_calls(atom, stage))
+                if best is None or priority > best[0]:
+                    best = (priority, atom, stage)
+
+            if best is None:
+                break
+
+            _, atom, stage = best
+            self.step(atom, stage)
+            num_steps += 1
+
+        if self.rel_context_context:
+            self.relate_contexts()
+
+        # The contexts that were never summarized are dropped
+        for context in [c for cid, c in self.contexts.items() if cid not in self.ready]:
+            self._remove_context(context)
+
+        num_verified = len([aid for aid, stage in self.stages.items() if stage == STAGE_DONE])
+        print(f"[BudgetPlanner] Atoms fully processed: {num_verified}/{len(self.atoms)}")
+        print(f"[BudgetPlanner] Contexts: {len(self.contexts)}, relations: {len(self.relations)}")
+        if self.budget is not None:
+            print(f"[BudgetPlanner] Budget usage: {self.budget.report()}")
+
+        return self.contexts, self.relations
+
+    def report(self) -> dict:
+        """
+        Return a dict summarizing the work carried out by the planner.
+        """
+
+        result = dict(
+            num_atoms=len(self.atoms),
+            num_atoms_processed=len([s for s in self.stages.values() if s == STAGE_DONE]),
+            atoms_unprocessed=sorted([aid for aid, s in self.stages.items() if s != STAGE_DONE]),
+        )
+        if self.budget is not None:
+            result.update(self.budget.report())
+        return result
@@ -0,0 +1,314 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Build the chromadb collection read by ChromaReader from a passage corpus
+# (chunking and embedding in worker processes, bulk upserts, checkpoints)
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+from src.fact_reasoner.bm25_index import read_corpus
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # same as ContextRetriever
+DEFAULT_BATCH_SIZE = 2048  # chunks embedded per task
+DEFAULT_MAX_UPSERT_SIZE = 5000  # records per upsert if the client has no limit
+
+# The embedding function of a worker process (see `init_worker`)
+_worker_embedding_function = None
+
+
+def init_worker(embedding_model: str, device: str):
+    """
+    Load the embedding model once per worker process.
+    """
+
+    global _worker_embedding_function
+    from chromadb.utils import embedding_functions
+
+    _worker_embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name=embedding_model,
+        device=device,
+    )
+
+
+def embed_docs(docs: List[Tuple[int, dict]]) -> Tuple[List[str], List[str], List[dict], np.ndarray]:
+    """
+    Chunk the passages (CHARACTER_SPLITTER) and embed the chunks in a single
+    batch. A chunk is stored as "title\\nchunk" (see `get_title`) with the id
+    "<passage index>:<chunk index>", so re-ingesting a passage overwrites it.
+    The passage index (`doc_id`) is also kept in the metadata, as the BM25
+    index of the same corpus uses it to identify the passage.
+
+    Args:
+        docs: List[Tuple[int, dict]]
+            The passages (dicts with title, text and link) and their index in the corpus.
+
+    Returns:
+        A tuple (ids, documents, metadatas, embeddings).
+    """
+
+    from src.fact_reasoner.text_processor import CHARACTER_SPLITTER
+
+    ids, documents, metadatas = [], [], []
+    for doc_id, doc in docs:
+        for i, chunk in enumerate(CHARACTER_SPLITTER.split_text(doc["text"])):
+            ids.append(f"{doc_id}:{i}")
+            documents.append(f"{doc['title']}\n{chunk}")
+            metadatas.append(dict(title=doc["title"], link=doc["link"], doc_id=doc_id))
+
+    if len(documents) == 0:
+        return ids, documents, metadatas, np.zeros((0, 0), dtype=np.float32)
+    embeddings = np.asarray(_worker_embedding_function(documents), dtype=np.float32)
+    return ids, documents, metadatas, embeddings
+
+
+def make_batches(
+        corpus_file: str,
+        batch_size: int,
+        skip_docs: int = 0,
+        chunk_size: int = 1000,
+) -> Iterator[Tuple[int, List[Tuple[int, dict]]]]:
+    """
+    Stream the corpus in batches of whole passages of about `batch_size`
+    chunks (estimated from the text length). Yields (number of passages read
+    so far, batch), skipping the first `skip_docs` passages.
+    """
+
+    batch, num_chunks, doc_id = [], 0, 0
+    for doc_id, doc in enumerate(read_corpus(corpus_file)):
+        if doc_id < skip_docs:
+            continue
+        batch.append((doc_id, doc))
+        num_chunks += len(doc["text"]) // chunk_size + 1
+        if num_chunks >= batch_size:
+            yield doc_id + 1, batch
+            batch, num_chunks = [], 0
+    if len(batch) > 0:
+        yield doc_id + 1, batch
+
+
+def load_checkpoint(checkpoint_file: str, corpus_file: str) -> dict:
+    """
+    Return the checkpoint of a previous ingestion of the corpus (or an empty one).
+    """
+
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, "r") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("corpus_file") == os.path.abspath(corpus_file):
+            return checkpoint
+        print(f"[ChromaIngest] Ignoring the checkpoint of another corpus: {checkpoint_file}")
+    return dict(corpus_file=os.path.abspath(corpus_file), num_docs=0, num_chunks=0)
+
+
+def save_checkpoint(checkpoint_file: str, checkpoint: dict):
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_file, checkpoint_file)  # atomic
+
+
+def ingest_corpus(
+        corpus_file: str,
+        collection_name: str = "wikipedia_en",
+        persist_directory: str = "/tmp/wiki_db",
+        embedding_model: str = EMBEDDING_MODEL,
+        num_workers: int = 2,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        device: str = None,
+        resume: bool = True,
+        log_every: int = 10,
+):
+    """
+    Ingest a JSONL passage corpus (title, text, link) into a chromadb
+    collection. The corpus is streamed and split into batches of passages,
+    which are chunked and embedded by `num_workers` worker processes (each
+    loading the embedding model once), while the main process upserts the
+    finished batches in bulk, in corpus order. After every upsert, the number
+    of ingested passages is saved in a checkpoint, so an interrupted
+    ingestion resumes where it stopped (chunk ids are deterministic, so
+    replayed chunks are overwritten, not duplicated).
+
+    Args:
+        corpus_file: str
+            Path to the JSONL corpus.
+        collection_name: str
+            The collection name in the vector database.
+        persist_directory: str
+            The directory used for persisting the vector database.
+        embedding_model: str
+            The embedding model (must be the one used for the queries).
+        num_workers: int
+            The number of embedding worker processes.
+        batch_size: int
+            The (approximate) number of chunks embedded per batch.
+        device: str
+            The device of the embedding model (default is cuda if available).
+        resume: bool
+            Flag indicating that a previous ingestion is resumed from its checkpoint.
+        log_every: int
+            Report the throughput every `log_every` batches.
+    """
+
+    import chromadb
+    import torch
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    assert num_workers > 0, f"At least one worker process is needed."
+
+    client = chromadb.PersistentClient(path=persist_directory)
+    # The embeddings are computed by the workers only (no model in this process)
+    collection = client.get_or_create_collection(
+        name=collection_name,
+        embedding_function=None,
+        metadata={"hnsw:space": "cosine"},
+    )
+    max_upsert_size = DEFAULT_MAX_UPSERT_SIZE
+    if hasattr(client, "get_max_batch_size"):
+        max_upsert_size = client.get_max_batch_size()
+
+    checkpoint_file = os.path.join(persist_directory, f"{collection_name}.checkpoint.json")
+    checkpoint = load_checkpoint(checkpoint_file, corpus_file) if resume else \
+        dict(corpus_file=os.path.abspath(corpus_file), num_docs=0, num_chunks=0)
+    if checkpoint["num_docs"] > 0:
+        print(f"[ChromaIngest] Resuming after {checkpoint['num_docs']} passages ({checkpoint['num_chunks']} chunks)")
+
+    start = time.time()
+    num_docs, num_chunks = 0, 0  # ingested in this run
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(embedding_model, device),
+    )
+    print(f"[ChromaIngest] Ingesting {corpus_file} into {collection_name} with {num_workers} workers on {device}")
+
+    def upsert(docs_read: int, future):
+        nonlocal num_docs, num_chunks
+        ids, documents, metadatas, embeddings = future.result()
+        for i in range(0, len(ids), max_upsert_size):
+            j = i + max_upsert_size
+            collection.upsert(
+                ids=ids[i:j],
+                documents=documents[i:j],
+                metadatas=metadatas[i:j],
+                embeddings=embeddings[i:j].tolist(),
+            )
+        num_docs += docs_read - checkpoint["num_docs"]
+        num_chunks += len(ids)
+        checkpoint["num_docs"] = docs_read
+        checkpoint["num_chunks"] += len(ids)
+        save_checkpoint(checkpoint_file, checkpoint)
+
+    def report():
+        elapsed = max(time.time() - start, 1e-6)
+        print(f"[ChromaIngest] {checkpoint['num_docs']} passages, {checkpoint['num_chunks']} chunks "
+              f"({num_docs / elapsed:.1f} passages/s, {num_chunks / elapsed:.1f} chunks/s)")
+
+    # Keep the workers busy: at most 2 batches in flight per worker
+    pending = deque()
+    num_batches = 0
+    try:
+        for docs_read, batch in make_batches(corpus_file, batch_size, skip_docs=checkpoint["num_docs"]):
+            pending.append((docs_read, executor.submit(embed_docs, batch)))
+            while len(pending) >= 2 * num_workers:
+                upsert(*pending.popleft())
+                num_batches += 1
+                if num_batches % log_every == 0:
+                    report()
+        while len(pending) > 0:
+            upsert(*pending.popleft())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    report()
+    print(f"[ChromaIngest] Done in {time.time() - start:.1f}s, the collection has {collection.count()} chunks")
+
+
+if __name__ == "__main__":
+
+    # CLI arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--corpus_file',
+        type=str,
+        required=True,
+        help="Path to the JSONL passage corpus (title, text, link)."
+    )
+
+    parser.add_argument(
+        '--collection_name',
+        type=str,
+        default="wikipedia_en",
+        help="Name of the chromadb collection."
+    )
+
+    parser.add_argument(
+        '--persist_directory',
+        type=str,
+        default="/tmp/wiki_db",
+        help="Directory of the chromadb store."
+    )
+
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=2,
+        help="Number of embedding worker processes."
+    )
+
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of chunks embedded per batch."
+    )
+
+    parser.add_argument(
+        '--device',
+        type=str,
+        default=None,
+        help="Device of the embedding model (cpu, cuda)."
+    )
+
+    parser.add_argument(
+        '--restart',
+        default=False,
+        action='store_true',
+        help="Ignore the checkpoint of a previous ingestion."
+    )
+
+    # Parse CLI arguments
+    args = parser.parse_args()
+
+    ingest_corpus(
+        args.corpus_file,
+        collection_name=args.collection_name,
+        persist_directory=args.persist_directory,
+        num_workers=args.num_workers,
+        batch_size=args.batch_size,
+        device=args.device,
+        resume=not args.restart,
+    )
+    print("Done.")
@@ -0,0 +1,92 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Scoped similarity search over the chunks of a page with cached embeddings
+
+import numpy as np
+
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from src.fact_reasoner.embedding_cache import EmbeddingCache
+
+
+class ChunkIndex:
+    """
+    Retrieve the chunks of a single page (or any small set of chunks) that are
+    the most similar to a query. Unlike a shared vector store, the search is
+    scoped to the given chunks, so its cost does not grow with the number of
+    pages fetched so far and chunks of other pages never leak into the
+    results. The chunk and query embeddings are kept in an embedding cache
+    (the one of the retriever), so a page fetched again for another atom is
+    not re-embedded.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        """
+        Initialize the index.
+
+        Args:
+            embeddings: Embeddings
+                The (langchain) embedding model of the chunks and queries.
+            cache: EmbeddingCache
+                The cache of the chunk and query embeddings.
+        """
+
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def _normalize(self, vectors: List[np.ndarray]) -> np.ndarray:
+        vectors = np.stack(vectors).astype(np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def embed_chunks(self, chunks: List[str]) -> np.ndarray:
+        """
+        Return the (normalized) embeddings of the chunks, embedding only the
+        chunks that are not in the cache.
+        """
+
+        return self._normalize(self.cache.embed(chunks, self.embeddings.embed_documents))
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """
+        Return the (normalized) embedding of the query (cached as well).
+        """
+
+        # sentence-transformers models (no query prompt) embed queries as documents
+        vectors = self.cache.embed([query], lambda texts: [self.embeddings.embed_query(texts[0])])
+        return self._normalize(vectors)[0]
+
+    def search(self, query: str, chunks: List[str], k: int = 3) -> List[str]:
+        """
+        Return the (at most) k chunks most similar to the query (cosine
+        similarity), in decreasing order of similarity.
+
+        Args:
+            query: str
+                The query text.
+            chunks: List[str]
+                The chunks searched (e.g., the chunks of a page).
+            k: int
+                The number of chunks returned.
+        """
+
+        if len(chunks) == 0:
+            return []
+
+        scores = self.embed_chunks(chunks) @ self.embed_query(query)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [chunks[i] for i in top]
@@ -13,53 +13,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import io
+import os
 import re
 import chromadb
 import html2text
 import requests
+import tempfile
+import time
 import torch
 
-from typing import Callable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
 from bs4 import BeautifulSoup
 from bs4.element import Tag
 from chromadb.utils import embedding_functions
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.retrievers import WikipediaRetriever
-from langchain_community.vectorstores import InMemoryVectorStore
-from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
-from pypdf import PdfReader
 
 # Local
+from src.fact_reasoner.bm25_index import BM25Index
+from src.fact_reasoner.chunk_index import ChunkIndex
+from src.fact_reasoner.domain_health import DomainHealth
+from src.fact_reasoner.embedding_cache import CachedEmbeddingFunction, EmbeddingCache
+from src.fact_reasoner.page_cache import PageCache
+from src.fact_reasoner.page_fetcher import PageFetcher
 from src.fact_reasoner.query_builder import QueryBuilder
 from src.fact_reasoner.search_api import SearchAPI
+from src.fact_reasoner.text_processor import (
+    CHARACTER_SPLITTER,
+    TextProcessor,
+    compose_fns,
+    html_to_text,
+    make_uniform,
+    process_page,
+    remove_citation,
+    remove_new_line,
+    stream_html_to_text,
+)
+from src.fact_reasoner.wiki_dump import WikiDump
 
 EMBEDDING_MODEL = "all-MiniLM-L6-v2"
 NEWLINES_RE = re.compile(r"\n{2,}")  # two or more "\n" characters
-
-CHARACTER_SPLITTER = RecursiveCharacterTextSplitter(
-    separators=["\n\n", "\n", ". ", " ", ""],
-    #keep_separator=False,
-    chunk_size=1000,
-    chunk_overlap=0
-)
-
-def remove_citation(paragraph: str) -> str:
-    """Remove all citations (numbers in side square brackets) in paragraph"""
-    return re.sub(r'\[\d+\]', '', paragraph)
-
-def remove_new_line(paragraph: str) -> str:
-    return paragraph.replace("\n", "")
-
-def compose_fns(functions: List[Callable]) -> Callable:
-    def ret(input):
-        for fn in functions:
-            input = fn(input)
-
-        return input
-
-    return ret
+HTML_CHUNK_SIZE = 1 << 14  # 16 KB read at a time from the response body
+MAX_HTML_BYTES = 5 << 20  # 5 MB, stop downloading an HTML page beyond this
+MAX_PDF_BYTES = 20 << 20  # 20 MB, larger PDF files are not downloaded
 
 def html_to_text2(html_text: str) -> str:
     text_maker = html2text.HTML2Text()
@@ -71,61 +68,192 @@ def html_to_text2(html_text: str) -> str:
     text = text_maker.handle(html_text).replace('\n', '').strip()
     return text
 
-def html_to_text(html_text: str) -> str:
-    soup = BeautifulSoup(html_text, 'html.parser')
+def iter_response_content(r: requests.Response, max_bytes: int = MAX_HTML_BYTES) -> Iterable[bytes]:
+    """
+    Iterate over the body of a (streamed) response, up to `max_bytes` bytes.
+    """
 
-    preprocess_fn = compose_fns([remove_citation, remove_new_line])
-    paragraphs = list(map(lambda p: preprocess_fn(p.getText()), soup.find_all('p')))
-    return "\n".join(paragraphs)
+    num_bytes = 0
+    for chunk in r.iter_content(chunk_size=HTML_CHUNK_SIZE):
+        yield chunk
+        num_bytes += len(chunk)
+        if num_bytes >= max_bytes:
+            break
 
-def fetch_text_from_link(link: str, max_size: int = None) -> str:
-    print(f"Fetching text from link: {link}")
-    try:
-        if link.endswith('.pdf'): # pdf page
-            r = requests.get(link, timeout=10)
-            f = io.BytesIO(r.content)
+def download_to_tempfile(r: requests.Response, max_bytes: int = MAX_PDF_BYTES, suffix: str = ".pdf") -> str:
+    """
+    Stream the body of a response to a temporary file and return its path.
+    Raises a ValueError if the body is larger than `max_bytes` bytes.
+    """
 
-            reader = PdfReader(f)
-            pdf_texts = [p.extract_text().strip() for p in reader.pages]
+    length = r.headers.get("content-length", "")
+    if length.isdigit() and int(length) > max_bytes:
+        raise ValueError(f"File too large: {length} bytes")
+
+    num_bytes = 0
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        try:
+            for chunk in r.iter_content(chunk_size=HTML_CHUNK_SIZE):
+                num_bytes += len(chunk)
+                if num_bytes > max_bytes:
+                    raise ValueError(f"File too large: more than {max_bytes} bytes")
+                f.write(chunk)
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name
+
+def get_response_encoding(r: requests.Response) -> Optional[str]:
+    """
+    Return the encoding declared in the Content-Type header (if any). Otherwise,
+    the encoding is left to the HTML parser (e.g., a <meta charset> tag).
+    """
 
-            # Filter the empty strings
-            pdf_texts = [text for text in pdf_texts if text]
-            contents = "\n".join(pdf_texts)
+    if "charset" in r.headers.get("content-type", "").lower():
+        return r.encoding
+    return None
+
+def fetch_text_from_link(
+        link: str,
+        max_size: int = None,
+        fetcher: PageFetcher = None,
+        cache: PageCache = None,
+        health: DomainHealth = None,
+        processor: TextProcessor = None,
+        split: bool = False
+) -> Tuple[str, List[str]]:
+    """
+    Fetch a page and return its text (uniform representation, see
+    `process_text`) and, if `split` is True, its chunks. With a text
+    processor, the raw page (HTML bytes or PDF file) is extracted and
+    post-processed by a worker process. Otherwise, an HTML page is parsed
+    while it is downloaded, stopping at `max_size`. The extracted text is
+    cached and the download outcome is recorded in the domain health. A
+    failure of the local processing (e.g., a timeout of the text processor)
+    is neither cached nor counted against the domain, as the page itself may
+    be fine.
+
+    Returns:
+        A tuple (text, chunks). The text is empty on failure.
+    """
 
+    # Pages whose extraction stopped at `max_size` are cached under their own key
+    truncated_key = f"{link}#max_size={max_size}"
+    kind, payload, encoding = "text", None, None
+    if cache is not None:
+        hit, contents = cache.get(link)
+        if not hit and max_size is not None:
+            hit, contents = cache.get(truncated_key)
+        if hit:
+            payload = contents or ""  # a cached failure
+
+    downloaded = payload is None
+    truncated = False
+    if downloaded:
+        print(f"Fetching text from link: {link}")
+        start = time.time()
+        get = fetcher.get if fetcher is not None else lambda url, **kwargs: requests.get(url, timeout=10, **kwargs)
+        try:
+            r = get(link, stream=True)
+            try:
+                if r.status_code >= 400:
+                    raise ValueError(f"HTTP {r.status_code}")
+                encoding = get_response_encoding(r)
+                if link.endswith('.pdf'): # pdf page (streamed to a file)
+                    kind, payload = "pdf", download_to_tempfile(r)
+                elif processor is not None: # html page (raw bytes, parsed by the text processor)
+                    kind, payload = "html", b"".join(iter_response_content(r))
+                else: # html page (read incrementally, stop at max_size)
+                    payload, truncated = stream_html_to_text(
+                        iter_response_content(r),
+                        max_size=max_size,
+                        encoding=encoding
+                    )
+            finally:
+                r.close()
+        except Exception as e:
+            if cache is not None:
+                cache.put_failure(link, f"{type(e).__name__}: {e}")
+            if health is not None:
+                health.update(link, 0, time.time() - start)
+            return "", []
+        elapsed = time.time() - start
 
-        else: # html page
-            html = requests.get(link, timeout=10).text
-            contents = html_to_text(html)
-    
-        if max_size is not None and len(contents) > max_size:
-            contents = contents[:max_size]
-    except Exception as _:
-        contents = ""
-    return contents
-
-def get_title(text: str) -> str:
+    try:
+        if processor is not None:
+            contents, page_truncated, uniform, chunks = processor.process_page(kind, payload, max_size, encoding, split)
+        else:
+            contents, page_truncated, uniform, chunks = process_page(kind, payload, max_size, encoding, split)
+    except Exception as e:  # e.g., a timeout or a broken worker pool
+        print(f"[ContextRetriever] Could not process the text of {link}: {type(e).__name__}: {e}")
+        return "", []
+    finally:
+        if kind == "pdf":
+            os.remove(payload)
+
+    if downloaded:
+        truncated = truncated or page_truncated
+        if cache is not None:
+            cache.put(truncated_key if truncated else link, contents)
+        if health is not None:
+            health.update(link, len(contents), elapsed)
+    return uniform, chunks
+
+def get_passage_key(passage: dict) -> tuple:
     """
-    Get the title of the retrived document. By definition, the first line in the
-    document is the title (we embedded them like that).
+    Return the identity of a retrieved passage: its corpus id if known, else
+    its link and title, else its normalized text.
     """
-    return text[:text.find("\n")]
 
-def make_uniform(text: str) -> str:
+    if passage.get("doc_id", None) is not None:
+        return ("doc", passage["doc_id"])
+    if passage.get("link", "") != "" or passage.get("title", "") != "":
+        return ("link", passage.get("link", ""), passage.get("title", ""))
+    return ("text", " ".join(passage["text"].lower().split()))
+
+def reciprocal_rank_fusion(rankings: List[List[dict]], top_k: int, k: int = 60) -> List[dict]:
     """
-    Return a uniform representation of the text using the langchain textsplitter
-    and tokensplitter tools.
+    Fuse several ranked lists of passages with reciprocal rank fusion: the
+    score of a passage is the sum of 1 / (k + rank) over the lists where it
+    appears. A passage is identified by its corpus `doc_id` if any (so the
+    chunks of a passage in the dense store and the whole passage in the BM25
+    index are the same passage), otherwise by its link and title, and is
+    counted once per list (at its best rank).
+
+    Args:
+        rankings: List[List[dict]]
+            The ranked lists of passages (best first).
+        top_k: int
+            The number of passages returned.
+        k: int
+            The RRF constant (dampens the weight of the top ranks).
+
+    Returns:
+        List[dict]: The top_k fused passages (best first).
     """
 
-    character_split_texts = CHARACTER_SPLITTER.split_text(text)
-    # torch.cuda.empty_cache()
-    return " ".join(character_split_texts)
+    scores = {}
+    passages = {}
+    for ranking in rankings:
+        seen = set()
+        for rank, passage in enumerate(ranking):
+            key = get_passage_key(passage)
+            if key in seen:
+                continue
+            seen.add(key)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            passages.setdefault(key, passage)
+
+    keys = sorted(scores.keys(), key=lambda key: scores[key], reverse=True)
+    return [passages[key] for key in keys[:top_k]]
 
-    # token_split_texts = []
-    # for text in character_split_texts:
-    #     token_split_texts += TOKEN_SPLITTER.split_text(text)
-    # torch.cuda.empty_cache()
-
-    # return " ".join(token_split_texts)
+def get_title(text: str) -> str:
+    """
+    Get the title of the retrived document. By definition, the first line in the
+    document is the title (we embedded them like that).
+    """
+    return text[:text.find("\n")]
 
 class ChromaReader:
     def __init__(
@@ -134,6 +262,7 @@ class ChromaReader:
         persist_directory: str,
         embedding_model: str,
         collection_metadata: dict = None,
+        embedding_cache: EmbeddingCache = None,
     ):
         """
         Initialize the ChromaDB.
@@ -147,6 +276,8 @@ class ChromaReader:
                 The embedding model.
             collection_metadata: dict
                 A dict containing the collection metadata.
+            embedding_cache: EmbeddingCache
+                The cache of the query embeddings (optional).
         """
         
         self.device = "cpu"
@@ -166,23 +297,30 @@ class ChromaReader:
             embedding_function=self.embedding_function,
             metadata=collection_metadata,
         )
+        self.query_embedding_function = None
+        if embedding_cache is not None:
+            self.query_embedding_function = CachedEmbeddingFunction(self.embedding_function, embedding_cache)
 
     def is_empty(self):
         return self.collection.count() == 0
 
-    def query(self, query_texts: str, n_results: int = 5):
+    def query(self, query_texts: List[str], n_results: int = 5):
         """
-        Returns the closests vector to the question vector
+        Returns the closests vector to the question vector. Several query
+        texts are embedded in a single batch and searched at once.
         
         Args:
-            query_texts: str
-                The user query text.
+            query_texts: List[str]
+                The user query texts.
             n_results: int
                 The number of results to generate.
 
         Returns
             The closest result to the given question.
         """
+        if self.query_embedding_function is not None:
+            query_embeddings = [vector.tolist() for vector in self.query_embedding_function(query_texts)]
+            return self.collection.query(query_embeddings=query_embeddings, n_results=n_results)
         return self.collection.query(query_texts=query_texts, n_results=n_results)
   
 
@@ -203,14 +341,25 @@ class ContextRetriever:
             debug: bool = False,
             fetch_text: bool = False,
             use_in_memory_vectorstore: bool = False,
-            query_builder: QueryBuilder = None
+            query_builder: QueryBuilder = None,
+            fetch_workers: int = 8,
+            fetch_per_host: int = 2,
+            fetch_spare: int = 2,
+            page_cache_file: Optional[str] = None,
+            domain_stats_file: Optional[str] = None,
+            parse_workers: int = 2,
+            embedding_cache_dir: Optional[str] = None,
+            bm25_index_dir: Optional[str] = None,
+            hybrid_candidates: int = 20,
+            rrf_k: int = 60,
+            wiki_store_dir: Optional[str] = None
     ):
         """
         Initialize the context retriever component.
 
         Args:
             service_type: str
-                The type of the context retriever (chromadb, langchain, google)
+                The type of the context retriever (chromadb, langchain, google, bm25, hybrid, wikidump)
             collection_name: str
                 Name of the collection of documents stored in the vectorstore
             persist_directory: str
@@ -226,52 +375,129 @@ class ContextRetriever:
             use_in_memory_vectorstore: bool
                 Flag to use an in memory vectorstore over chunks of retrieved texts when using Google retriever.
                 Use in cases where the search results contain long documents so that they can be broken up
-                into smaller chunks, which will be retrieved using the query text. When disbaled (default)
+                into smaller chunks, which will be retrieved using the query text. The search is scoped
+                to the chunks of each page and the chunk embeddings are cached. When disbaled (default)
                 the input will be truncated to a `max_size`.
             query_builder: QueryBuilder
                 An instance of QueryBuilder to generate search queries.
+            fetch_workers: int
+                The number of threads fetching pages (google with `fetch_text`).
+            fetch_per_host: int
+                The maximum number of concurrent requests to the same host.
+            fetch_spare: int
+                The number of links fetched speculatively (in parallel) beyond
+                `top_k`, in case some of the pages turn out to be empty.
+            page_cache_file: str
+                Path to the SQLite database caching the text of the fetched
+                pages (compressed). If None, the pages are not cached.
+            domain_stats_file: str
+                Path to the JSON file persisting the per-domain fetch statistics.
+                The links from domains that rarely yield any text are moved to
+                the end of the search results and are not fetched.
+            parse_workers: int
+                The number of processes post-processing the fetched pages (PDF
+                and full-page HTML extraction, uniform text and chunking). If 0,
+                the pages are processed by the fetching threads.
+            embedding_cache_dir: str
+                Path to the directory persisting the embeddings of the queries
+                (chromadb) and of the page chunks (in memory vectorstore). If
+                None, the embeddings are cached in memory only.
+            bm25_index_dir: str
+                The directory of the BM25 index of a local passage corpus (bm25,
+                hybrid), built with `python -m src.fact_reasoner.bm25_index`.
+            hybrid_candidates: int
+                The number of passages retrieved by each of BM25 and chromadb
+                before the fusion (hybrid).
+            rrf_k: int
+                The reciprocal rank fusion constant (hybrid).
+            wiki_store_dir: str
+                The directory of the local Wikipedia article store (wikidump),
+                built with `python -m src.fact_reasoner.wiki_dump`.
         """
         
         self.top_k = top_k
         self.service_type = service_type
         self.chromadb_retriever = None
+        self.bm25_retriever = None
+        self.wikidump_retriever = None
         self.langchain_retriever = None
         self.google_retriever = None
-        self.in_memory_vectorstore = None
+        self.chunk_index = None
         self.debug = debug
         self.cache_dir = cache_dir
         self.fetch_text = fetch_text
         self.use_in_memory_vectorstore = use_in_memory_vectorstore
         self.query_builder = query_builder
+        self.rule_query_builder = None
+        self.page_fetcher = None
+        self.page_cache = None
+        self.domain_health = None
+        self.text_processor = None
+        self.fetch_spare = fetch_spare
         self.collection_name = collection_name
         self.persist_directory = persist_directory
+        self.embedding_cache = None
+        self.hybrid_candidates = hybrid_candidates
+        self.rrf_k = rrf_k
 
-        assert self.service_type in ["chromadb", "langchain", "google"]
+        assert self.service_type in ["chromadb", "langchain", "google", "bm25", "hybrid", "wikidump"]
 
-        if self.service_type == "chromadb":
+        if self.service_type in ["chromadb", "hybrid"] or self.use_in_memory_vectorstore:
+            self.embedding_cache = EmbeddingCache(EMBEDDING_MODEL, cache_dir=embedding_cache_dir)
+
+        if self.service_type in ["chromadb", "hybrid"]:
             self.chromadb_retriever = ChromaReader(
                 collection_name=self.collection_name, 
                 persist_directory=self.persist_directory, 
                 embedding_model=EMBEDDING_MODEL, 
-                collection_metadata={"hnsw:space": "cosine"}
+                collection_metadata={"hnsw:space": "cosine"},
+                embedding_cache=self.embedding_cache
             )
+        if self.service_type in ["bm25", "hybrid"]:
+            assert bm25_index_dir is not None, f"The BM25 index directory must be given."
+            self.bm25_retriever = BM25Index(bm25_index_dir)
+
+        if self.service_type == "wikidump":
+            assert wiki_store_dir is not None, f"The Wikipedia article store directory must be given."
+            self.wikidump_retriever = WikiDump(wiki_store_dir)
         elif self.service_type == "langchain":
             # Create the Wikipedia retriever. Note that page content is capped
             # at 4000 chars. The metadata has a `title` and a `summary` of the page.
             self.langchain_retriever = WikipediaRetriever(lang="en", top_k_results=top_k)
         elif self.service_type == "google":
             self.google_retriever = SearchAPI(cache_dir=self.cache_dir)
+            if self.fetch_text:
+                self.page_fetcher = PageFetcher(max_workers=fetch_workers, max_per_host=fetch_per_host)
+                if page_cache_file is not None:
+                    self.page_cache = PageCache(page_cache_file)
+                self.domain_health = DomainHealth(stats_file=domain_stats_file)
+                self.text_processor = TextProcessor(num_workers=parse_workers)
             if self.use_in_memory_vectorstore:
-                self.in_memory_vectorstore = InMemoryVectorStore(
-                    HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+                self.chunk_index = ChunkIndex(
+                    HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL), self.embedding_cache
                 )
 
     def set_query_builder(self, query_builder: QueryBuilder = None):
         self.query_builder = query_builder
+
+    def get_query_builder(self, query_generator: str = None) -> QueryBuilder:
+        """
+        Return the query builder for the given query generator. If there is no
+        query builder, a rule based one is created on demand for the `rules`
+        and `auto` generators (the latter then never escalates to an LLM).
+        """
+
+        if self.query_builder is not None or query_generator in [None, "llm"]:
+            return self.query_builder
+        if self.rule_query_builder is None:
+            self.rule_query_builder = QueryBuilder(model_id=None, generator="rules")
+        return self.rule_query_builder
     
     def query(
             self, 
             text: str,
+            topic: str = None,
+            query_generator: str = None,
     ) -> List[str]:
         """
         Retrieve a number of contexts relevant to the input text.
@@ -279,6 +505,12 @@ class ContextRetriever:
         Args:
             text: str
                 The input query text.
+            topic: str
+                The topic of the input text (used by the rule based query generator).
+            query_generator: str
+                The query generator used for this call (llm, rules, auto). If None,
+                the query builder's default generator is used. The rule based
+                generator is also available without a query builder.
 
         Returns:
             List[dict]
@@ -286,25 +518,286 @@ class ContextRetriever:
                 is a dict with 4 keys: title, text, snippet and link.
         """
 
-        results = []
+        return self.query_many([text], topic=topic, query_generator=query_generator)[0]
+
+    def fetch_page(self, link: str, max_size: int = None, split: bool = False) -> Tuple[str, List[str]]:
+        """
+        Fetch the text of a page and post-process it (uniform representation
+        and, if `split` is True, chunks), see `fetch_text_from_link`.
+
+        Args:
+            link: str
+                The link of the page.
+            max_size: int
+                The maximum size (characters) of the text of the page.
+            split: bool
+                Flag indicating that the text is also split into chunks.
+
+        Returns:
+            A tuple (text, chunks). The text is empty on failure.
+        """
+
+        return fetch_text_from_link(
+            link, max_size, self.page_fetcher, self.page_cache, self.domain_health, self.text_processor, split
+        )
+
+    def fetch_pages(self, links: List[str], max_size: int = 4000) -> List[str]:
+        """
+        Fetch the text of the given pages (concurrently, if there is a page
+        fetcher). Pages with AI-generated or dataset related content are
+        discarded (empty text), as in the google retrieval loop.
+
+        Args:
+            links: List[str]
+                The links of the pages.
+            max_size: int
+                The maximum size (characters) of the text of a page.
+
+        Returns:
+            List[str]: The text of each page (empty on failure).
+        """
+
+        if self.page_fetcher is not None:
+            futures = [self.page_fetcher.submit(link, self.fetch_page, link, max_size) for link in links]
+            pages = [future.result() for future in futures]
+        else:
+            pages = [self.fetch_page(link, max_size) for link in links]
+
+        texts = []
+        for doc_content, _ in pages:
+            if ("chatgpt" in doc_content.lower()) or ("factscore" in doc_content.lower()) or ("dataset viewer" in doc_content.lower()):
+                doc_content = ""
+            texts.append(doc_content)
+        return texts
+
+    def make_queries(
+            self,
+            texts: List[str],
+            topic: str = None,
+            query_generator: str = None,
+    ) -> List[str]:
+        """
+        Generate the search queries for a list of input texts in one batch
+        (google only, if there is a query builder). Otherwise, the queries are
+        the input texts.
+        """
+
+        query_builder = self.get_query_builder(query_generator)
+        if self.service_type != "google" or query_builder is None:
+            return list(texts)
+
+        queries = list(texts)
+        indices = [i for i, text in enumerate(texts) if text]
+        if len(indices) > 0:
+            results = query_builder.runall(
+                [texts[i] for i in indices],
+                [""] * len(indices),
+                topics=[topic] * len(indices),
+                generator=query_generator
+            )
+            for i, result in zip(indices, results):
+                queries[i] = result.get("query", texts[i]) or texts[i]
+        return queries
+
+    def query_many(
+            self,
+            texts: List[str],
+            topic: str = None,
+            query_generator: str = None,
+    ) -> List[List[dict]]:
+        """
+        Retrieve the contexts relevant to each of the input texts. The search
+        queries are generated in a single batch (QueryBuilder.runall) and the
+        searches are issued afterwards.
+
+        Args:
+            texts: List[str]
+                The input query texts.
+            topic: str
+                The topic of the input texts (used by the rule based query generator).
+            query_generator: str
+                The query generator used for these calls (llm, rules, auto).
+
+        Returns:
+            List[List[dict]]
+                The list of retrieved contexts for each input text.
+        """
+
         if self.service_type == "chromadb":
+            return self.retrieve_chromadb(texts)
+        elif self.service_type == "bm25":
+            return self.retrieve_bm25(texts)
+        elif self.service_type == "hybrid":
+            return self.retrieve_hybrid(texts)
+        elif self.service_type == "wikidump":
+            return self.retrieve_wikidump(texts, topic=topic)
+
+        queries = self.make_queries(texts, topic=topic, query_generator=query_generator)
+        return [self.retrieve(text, query_text) for text, query_text in zip(texts, queries)]
+
+    def retrieve_chromadb(self, texts: List[str], k: int = None) -> List[List[dict]]:
+        """
+        Retrieve the contexts relevant to each of the input texts from the
+        chromadb store. All the texts are embedded in one encoder batch and
+        searched with a single multi-query call.
+
+        Args:
+            texts: List[str]
+                The input query texts.
+            k: int
+                The number of contexts retrieved per text (default is top_k).
+
+        Returns:
+            List[List[dict]]
+                The list of retrieved contexts for each input text.
+        """
+
+        k = k or self.top_k
+        if len(texts) == 0:
+            return []
+        if self.debug:
+            print(f"Retrieving {k} relevant documents for {len(texts)} queries: {texts}")
+            print(f"Using chromadb")
+
+        # Retrieve the relevant chunks from the vector store
+        relevant_chunks = self.chromadb_retriever.query(
+            query_texts=texts,
+            n_results=k,
+        )
+
+        # Get the chunks (documents) of each query
+        results = []
+        all_metadatas = relevant_chunks.get("metadatas", None) or [None] * len(relevant_chunks["documents"])
+        for docs, metadatas in zip(relevant_chunks["documents"], all_metadatas):
+            passages = []
+            for i, doc in enumerate(docs):
+                metadata = (metadatas[i] if metadatas is not None else None) or {}
+                passages.append(dict(
+                    title=metadata.get("title", get_title(doc)),
+                    text=make_uniform(doc),
+                    snippet="",
+                    link=metadata.get("link", ""),
+                    doc_id=metadata.get("doc_id", None),
+                ))
+            results.append(passages[:k]) # a passage is a dict with title and text as keys
+        return results
+
+    def retrieve_bm25(self, texts: List[str], k: int = None) -> List[List[dict]]:
+        """
+        Retrieve the contexts relevant to each of the input texts from the
+        local BM25 index (offline).
+
+        Args:
+            texts: List[str]
+                The input query texts.
+            k: int
+                The number of contexts retrieved per text (default is top_k).
+
+        Returns:
+            List[List[dict]]
+                The list of retrieved contexts for each input text.
+        """
+
+        k = k or self.top_k
+        if self.debug:
+            print(f"Retrieving {k} relevant documents for {len(texts)} queries: {texts}")
+            print(f"Using BM25 index")
+
+        results = []
+        for docs in self.bm25_retriever.search_many(texts, k=k):
+            passages = [
+                dict(title=doc["title"], text=make_uniform(doc["text"]), snippet="", link=doc["link"], doc_id=doc["doc_id"])
+                for doc in docs
+            ]
+            results.append(passages)
+        return results
+
+    def retrieve_hybrid(self, texts: List[str]) -> List[List[dict]]:
+        """
+        Retrieve the contexts relevant to each of the input texts from both the
+        BM25 index and the chromadb store (concurrently), and fuse the two
+        rankings with reciprocal rank fusion. Both should be built from the
+        same corpus (`bm25_index` and `chroma_ingest`), so that a passage has
+        the same `doc_id` in the two rankings.
+
+        Args:
+            texts: List[str]
+                The input query texts.
+
+        Returns:
+            List[List[dict]]
+                The list of retrieved contexts for each input text.
+        """
+
+        if len(texts) == 0:
+            return []
+
+        k = max(self.hybrid_candidates, self.top_k)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            lexical = executor.submit(self.retrieve_bm25, texts, k)
+            dense = executor.submit(self.retrieve_chromadb, texts, k)
+            lexical_results, dense_results = lexical.result(), dense.result()
+
+        return [
+            reciprocal_rank_fusion([lexical_passages, dense_passages], top_k=self.top_k, k=self.rrf_k)
+            for lexical_passages, dense_passages in zip(lexical_results, dense_results)
+        ]
+
+    def retrieve_wikidump(self, texts: List[str], topic: str = None) -> List[List[dict]]:
+        """
+        Retrieve the contexts relevant to each of the input texts from the
+        local Wikipedia article store (offline): the articles whose titles
+        (or redirects) appear in the text or match the topic.
+
+        Args:
+            texts: List[str]
+                The input query texts.
+            topic: str
+                The topic of the input texts (optional).
+
+        Returns:
+            List[List[dict]]
+                The list of retrieved contexts for each input text.
+        """
+
+        results = []
+        for text in texts:
             if self.debug:
                 print(f"Retrieving {self.top_k} relevant documents for query: {text}")
-                print(f"Using chromadb")
+                print(f"Using local Wikipedia dump")
 
-            # Retrieve the relevant chunks from the vector store
-            relevant_chunks = self.chromadb_retriever.query(
-                query_texts=[text],
-                n_results=self.top_k,
-            )
+            passages = self.wikidump_retriever.search(text, k=self.top_k, topic=topic)
+            for passage in passages:
+                passage["text"] = make_uniform(passage["text"])
+            results.append(passages)
+        return results
 
-            # Get the chunks (documents)
-            docs = relevant_chunks["documents"][0]
-            passages = [dict(title=get_title(doc), text=make_uniform(doc), snippet="", link="") for doc in docs]
+    def retrieve(self, text: str, query_text: str) -> List[dict]:
+        """
+        Retrieve a number of contexts relevant to the input text, given the
+        search query generated for it (google only).
 
-            n = min(self.top_k, len(passages))
-            for i in range(n):
-                results.append(passages[i]) # a passage is a dict with title and text as keys
+        Args:
+            text: str
+                The input query text.
+            query_text: str
+                The search query.
+
+        Returns:
+            List[dict]
+                The list of retrieved contexts for the input reference. A context
+                is a dict with 4 keys: title, text, snippet and link.
+        """
+
+        results = []
+        if self.service_type == "chromadb":
+            results = self.retrieve_chromadb([text])[0]
+        elif self.service_type == "bm25":
+            results = self.retrieve_bm25([text])[0]
+        elif self.service_type == "hybrid":
+            results = self.retrieve_hybrid([text])[0]
+        elif self.service_type == "wikidump":
+            results = self.retrieve_wikidump([text])[0]
         elif self.service_type == "langchain":
             if self.debug:
                 print(f"Retrieving {self.top_k} relevant documents for query: {text}")
@@ -330,13 +823,6 @@ class ContextRetriever:
             if not text:
                 return results
 
-            # Generate the query text if there is a query builder
-            if self.query_builder is not None:
-                result = self.query_builder.run(text)
-                query_text = result.get("query", text)
-            else:
-                query_text = text
-            
             # Truncate the text if too long (for Google)
             query_text = query_text if len(query_text) < 2048 else query_text[:2048]
             print(f"Using query text: {query_text}")
@@ -355,10 +841,36 @@ class ContextRetriever:
 
             n = len(search_results[query_text])
 
+            # Move the links of the unhealthy domains to the end (not fetched)
+            unhealthy = set()
+            if self.fetch_text and self.domain_health is not None:
+                items = search_results[query_text]
+                unhealthy = set(res['link'] for res in items if not self.domain_health.is_healthy(res['link']))
+                if len(unhealthy) > 0:
+                    print(f"Skipping {len(unhealthy)} links from unhealthy domains.")
+                    search_results[query_text] = \
+                        [res for res in items if res['link'] not in unhealthy] + \
+                        [res for res in items if res['link'] in unhealthy]
+
             i = 0
             cont_content = 0
             index_available = []
 
+            # Fetch the first `top_k + spare` pages in parallel, and the next
+            # ones as the selection loop moves past them
+            max_size = None if self.use_in_memory_vectorstore else 4000
+            pages = {}
+            def prefetch(upto: int):
+                for j in range(min(upto, n)):
+                    link = search_results[query_text][j]['link']
+                    if j not in pages and link not in unhealthy:
+                        pages[j] = self.page_fetcher.submit(
+                            link, self.fetch_page, link, max_size, self.use_in_memory_vectorstore
+                        )
+
+            if self.fetch_text and self.page_fetcher is not None:
+                prefetch(self.top_k + self.fetch_spare)
+
             while ((i < n) and (cont_content < self.top_k)):
                 # we retrieve content from the link
                 if self.fetch_text:
@@ -371,19 +883,19 @@ class ContextRetriever:
 
                         # if using in memory vector store, do not set a max size initially on the page text
                         # it will be determined by the splitter chunk size and number of chunks.
-                        page_text = fetch_text_from_link(link, max_size=None if self.use_in_memory_vectorstore else 4000)
-                        doc_content = make_uniform(page_text) if len(page_text) > 0 else ""
+                        # the text is made uniform (and chunked) in the text processor
+                        if link in unhealthy:
+                            doc_content, split_doc_content = "", []
+                        elif self.page_fetcher is not None:
+                            prefetch(i + 1 + self.fetch_spare)
+                            doc_content, split_doc_content = pages[i].result()
+                        else:
+                            doc_content, split_doc_content = self.fetch_page(link, max_size, self.use_in_memory_vectorstore)
                         
                         if self.use_in_memory_vectorstore:
-                            # make documents for vectorstore
-                            split_doc_content = CHARACTER_SPLITTER.split_text(doc_content)
-                            documents = [Document(id=f"{doc_id}", page_content=text, metadata={"source": link})
-                                for doc_id, text in enumerate(split_doc_content)
-                            ]
-                            self.in_memory_vectorstore.add_documents(documents=documents)
-                            retriever = self.in_memory_vectorstore.as_retriever(search_kwargs={"k": 3})
-                            retrieved_docs = retriever.invoke(query_text)
-                            doc_content = "\n\n".join([doc.page_content for doc in retrieved_docs])
+                            # search the chunks of this page only (embeddings cached by chunk hash)
+                            retrieved_docs = self.chunk_index.search(query_text, split_doc_content, k=3)
+                            doc_content = "\n\n".join(retrieved_docs)
          
                         # no content from the link
                         # or the content may be AI-generated or talking about a dataset used to test LLMs                      
@@ -0,0 +1,152 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per-domain page fetching statistics (success rate, text length, latency)
+
+import atexit
+import json
+import os
+import threading
+import time
+
+from typing import Dict
+
+from src.fact_reasoner.page_fetcher import get_host
+
+
+class DomainHealth:
+    """
+    Rolling (exponentially weighted) statistics of the pages fetched from each
+    domain: the success rate (non-empty text extracted), the extracted text
+    length and the latency. The statistics are persisted to a JSON file so
+    they carry over across runs. A domain with enough requests whose success
+    rate is below `min_success_rate` is considered unhealthy; its links are
+    then moved to the end of the search results and are not fetched. An
+    unhealthy domain is probed again (one link is let through) every
+    `retry_after` seconds, so a domain that recovers from an outage regains
+    its health instead of staying blacklisted.
+    """
+
+    def __init__(
+            self,
+            stats_file: str = None,
+            alpha: float = 0.2,
+            min_requests: int = 5,
+            min_success_rate: float = 0.2,
+            retry_after: float = 3600.0,
+            save_every: int = 20,
+    ):
+        """
+        Initialize the statistics.
+
+        Args:
+            stats_file: str
+                The JSON file where the statistics are persisted (optional).
+            alpha: float
+                The weight of the latest observation in the moving averages.
+            min_requests: int
+                The minimum number of requests before a domain can be deemed unhealthy.
+            min_success_rate: float
+                The success rate below which a domain is unhealthy.
+            retry_after: float
+                The time (seconds) after which an unhealthy domain is probed again.
+            save_every: int
+                Save the statistics to the file every `save_every` updates.
+        """
+
+        self.stats_file = stats_file
+        self.alpha = alpha
+        self.min_requests = min_requests
+        self.min_success_rate = min_success_rate
+        self.retry_after = retry_after
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.num_updates = 0
+        self.stats: Dict[str, dict] = {}
+
+        if self.stats_file is not None and os.path.exists(self.stats_file):
+            with open(self.stats_file, "r") as f:
+                self.stats = json.load(f)
+            print(f"[DomainHealth] Loaded statistics for {len(self.stats)} domains from {self.stats_file}")
+        if self.stats_file is not None:
+            atexit.register(self.save)
+
+    def update(self, link: str, length: int, latency: float):
+        """
+        Record a fetch of the link.
+
+        Args:
+            link: str
+                The link fetched.
+            length: int
+                The length of the extracted text (0 on failure).
+            latency: float
+                The duration (seconds) of the fetch.
+        """
+
+        domain = get_host(link)
+        success = 1.0 if length > 0 else 0.0
+        with self.lock:
+            stats = self.stats.get(domain, None)
+            if stats is None:
+                stats = dict(requests=0, success_rate=success, length=float(length), latency=latency)
+                self.stats[domain] = stats
+            else:
+                a = self.alpha
+                stats["success_rate"] = (1 - a) * stats["success_rate"] + a * success
+                stats["length"] = (1 - a) * stats["length"] + a * length
+                stats["latency"] = (1 - a) * stats["latency"] + a * latency
+            stats["requests"] += 1
+            stats["last_update"] = time.time()
+            self.num_updates += 1
+            save = self.num_updates % self.save_every == 0
+
+        if save:
+            self.save()
+
+    def is_healthy(self, link: str) -> bool:
+        """
+        Return False if the link's domain is known to rarely yield any text,
+        unless the domain is due for a probe (at most one every `retry_after`
+        seconds).
+        """
+
+        with self.lock:
+            stats = self.stats.get(get_host(link), None)
+            if stats is None or stats["requests"] < self.min_requests:
+                return True
+            if stats["success_rate"] >= self.min_success_rate:
+                return True
+
+            now = time.time()
+            last_seen = max(stats.get("last_update", 0.0), stats.get("last_probe", 0.0))
+            if now - last_seen >= self.retry_after:
+                stats["last_probe"] = now
+                return True
+            return False
+
+    def save(self):
+        """
+        Save the statistics to the JSON file (if any).
+        """
+
+        if self.stats_file is None:
+            return
+        with self.lock:
+            data = json.dumps(self.stats, indent=2)
+        tmp_file = self.stats_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(data)
+        os.replace(tmp_file, self.stats_file)
@@ -0,0 +1,236 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Embedding cache (in memory LRU and on disk memory-mapped matrix)
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+DEFAULT_MAX_ITEMS = 10000  # embeddings kept in memory
+INITIAL_CAPACITY = 4096  # rows of the on disk matrix (doubled when full)
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+
+def make_embedding_key(model_name: str, text: str) -> str:
+    """
+    Return the cache key of the text's embedding: a hash of the model name and
+    the normalized text.
+    """
+
+    return hashlib.sha256(f"{model_name}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A cache of text embeddings keyed by (model name, normalized text). The
+    embeddings are kept in memory (LRU) and, optionally, on disk as a memory
+    mapped float16 matrix (grown by doubling) with a SQLite index mapping the
+    keys to rows, so they are shared across runs. The disk cache is meant to
+    be used by a single process at a time.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            cache_dir: str = None,
+            max_items: int = DEFAULT_MAX_ITEMS,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            model_name: str
+                The name of the embedding model.
+            cache_dir: str
+                The directory of the on disk cache. If None, the cache is in memory only.
+            max_items: int
+                The maximum number of embeddings kept in memory.
+        """
+
+        self.model_name = model_name
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+        # On disk cache (created when the dimension is known)
+        self.cache_dir = None
+        self.index_file = None
+        self.matrix_file = None
+        self.matrix = None
+        self.rows = {}
+        self.dim = None
+        self.capacity = 0
+
+        if cache_dir is not None:
+            self.cache_dir = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.index_file = os.path.join(self.cache_dir, "index.sqlite")
+            self.matrix_file = os.path.join(self.cache_dir, "embeddings.f16")
+            with sqlite3.connect(self.index_file) as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+                conn.execute("CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, row INTEGER)")
+                conn.commit()
+                meta = dict(conn.execute("SELECT name, value FROM meta").fetchall())
+                self.rows = dict(conn.execute("SELECT key, row FROM rows").fetchall())
+            if "dim" in meta and os.path.exists(self.matrix_file):
+                self._open_matrix(meta["dim"], meta["capacity"])
+            else:
+                # The rows of a lost matrix would be reused for other embeddings
+                self.rows = {}
+                with sqlite3.connect(self.index_file) as conn:
+                    conn.execute("DELETE FROM rows")
+                    conn.execute("DELETE FROM meta")
+                    conn.commit()
+            print(f"[EmbeddingCache] Loaded {len(self.rows)} embeddings from {self.cache_dir}")
+
+    def _open_matrix(self, dim: int, capacity: int):
+        """
+        Open the on disk matrix with the given shape (the file is extended if needed).
+        """
+
+        size = capacity * dim * 2  # float16
+        with open(self.matrix_file, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.matrix = np.memmap(self.matrix_file, dtype=np.float16, mode="r+", shape=(capacity, dim))
+        self.dim = dim
+        self.capacity = capacity
+        with sqlite3.connect(self.index_file) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                [("dim", dim), ("capacity", capacity)]
+            )
+            conn.commit()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Return the cached embedding for the key or None.
+        """
+
+        with self.lock:
+            vector = self.memory.get(key, None)
+            if vector is None and key in self.rows:
+                vector = np.asarray(self.matrix[self.rows[key]], dtype=np.float32)
+            if vector is not None:
+                self._remember(key, vector)
+        return vector
+
+    def put(self, keys: List[str], vectors: List[np.ndarray]):
+        """
+        Store the embeddings of the given keys.
+        """
+
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self.cache_dir is None:
+                return
+
+            new_keys = [(key, vector) for key, vector in zip(keys, vectors) if key not in self.rows]
+            if len(new_keys) == 0:
+                return
+            if self.matrix is None:
+                self._open_matrix(len(new_keys[0][1]), INITIAL_CAPACITY)
+            needed = len(self.rows) + len(new_keys)
+            if needed > self.capacity:
+                capacity = self.capacity
+                while capacity < needed:
+                    capacity *= 2
+                self.matrix.flush()
+                del self.matrix
+                self._open_matrix(self.dim, capacity)
+
+            items = []
+            for key, vector in new_keys:
+                row = len(self.rows)
+                self.matrix[row] = vector
+                self.rows[key] = row
+                items.append((key, row))
+            self.matrix.flush()
+            with sqlite3.connect(self.index_file) as conn:
+                conn.executemany("INSERT OR REPLACE INTO rows (key, row) VALUES (?, ?)", items)
+                conn.commit()
+
+    def embed(self, texts: List[str], embed_fn: Callable[[List[str]], List[List[float]]]) -> List[np.ndarray]:
+        """
+        Return the embeddings of the texts, computing only the missing ones
+        (deduplicated) with `embed_fn` in a single batch.
+
+        Args:
+            texts: List[str]
+                The input texts.
+            embed_fn: Callable
+                The function embedding a list of texts.
+
+        Returns:
+            List[np.ndarray]: The embeddings of the texts (float32).
+        """
+
+        keys = [make_embedding_key(self.model_name, text) for text in texts]
+        found = {}
+        for key in set(keys):
+            vector = self.get(key)
+            if vector is not None:
+                found[key] = vector
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+
+        if len(missing) > 0:
+            vectors = [np.asarray(v, dtype=np.float32) for v in embed_fn(list(missing.values()))]
+            self.put(list(missing.keys()), vectors)
+            found.update(zip(missing.keys(), vectors))
+
+        return [found[key] for key in keys]
+
+
+class CachedEmbeddingFunction:
+    """
+    Wrap a chromadb embedding function (e.g., SentenceTransformerEmbeddingFunction)
+    with an embedding cache. The call returns a list of embeddings, as the
+    wrapped function does.
+    """
+
+    def __init__(self, embedding_function: Callable, cache: EmbeddingCache):
+        self.embedding_function = embedding_function
+        self.cache = cache
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        return self.cache.embed(list(input), self.embedding_function)
+
@@ -39,7 +39,8 @@ class Atom:
             self,
             id: str,
             text: str,
-            label: str = None
+            label: str = None,
+            unit_type: str = None
     ):
         """
         Atom constructor.
@@ -50,12 +51,15 @@ class Atom:
                 The text associated with the atom.
             label: str
                 The gold label associated with the atom (S or NS).
+            unit_type: str
+                The unit type assigned by the atom extractor (e.g., Fact, Claim).
         """
 
         self.id = id
         self.text = text
         self.original = text  # keeps around the original atom
         self.label = label
+        self.unit_type = unit_type
         self.contexts = {}
         self.search_results = []
         self.probability = PRIOR_PROB_ATOM  # prior probability of the atom being true
@@ -81,6 +85,9 @@ class Atom:
     def get_label(self):
         return self.label
 
+    def get_unit_type(self):
+        return self.unit_type
+
     def add_context(
             self,
             context
@@ -402,7 +409,7 @@ def get_nli_relations_prompting(
     return relations
 
 
-def build_atoms(response: str, atom_extractor: AtomExtractor) -> dict:
+def build_atoms(response: str, atom_extractor: AtomExtractor, all_units: bool = False) -> dict:
     """
     Decompose the given response into atomic units (i.e., atoms).
 
@@ -411,6 +418,9 @@ def build_atoms(response: str, atom_extractor: AtomExtractor) -> dict:
             The string representing the LLM response.
         atom_extractor: AtomExtractor 
             The model based atom extractor.
+        all_units: bool
+            Flag indicating that all the extracted units are kept, regardless
+            of their unit type. By default, only the facts and claims are kept.
     Returns:
         A dict containing the atoms of the response.
     """
@@ -423,8 +433,9 @@ def build_atoms(response: str, atom_extractor: AtomExtractor) -> dict:
     candidates = [
         Atom(
             id="a" + str(i),
-            text=elem["atom"]
-        ) for i, elem in enumerate(result["all_facts"])
+            text=elem["atom"],
+            unit_type=elem["label"]
+        ) for i, elem in enumerate(result["all_atoms" if all_units else "all_facts"])
     ]
 
     atoms = {}
@@ -437,10 +448,88 @@ def build_atoms(response: str, atom_extractor: AtomExtractor) -> dict:
     return atoms
 
 
+def retrieve_atom_contexts(atom: Atom, retriever: ContextRetriever, topic: str = None) -> List[Context]:
+    """
+    Retrieve the relevant contexts for a single atom.
+
+    Args:
+        atom: Atom
+            The atom.
+        retriever: ContextRetriever
+            The context retriever (chromadb, langchain, google).
+        topic: str
+            The topic of the response (used for query generation).
+    """
+
+    retrieved_contexts = retriever.query(
+        text=atom.text,
+        topic=topic,
+    )
+
+    return make_atom_contexts(atom, retrieved_contexts)
+
+
+def make_atom_contexts(atom: Atom, retrieved_contexts: List[dict]) -> List[Context]:
+    """
+    Create the contexts of an atom from the retrieved contexts (dicts).
+    """
+
+    return [
+        Context(
+            id="c_" + atom.id + "_" + str(j),
+            atom=atom,
+            text=context["text"],
+            title=context["title"],
+            link=context["link"],
+            snippet=context["snippet"]
+            # An empty summary means that the context is not relevant, therefore we do not add it to the list of contexts for the pipeline
+        ) for j, context in enumerate(retrieved_contexts) 
+    ]
+
+
+def retrieve_question_contexts(question: str, retriever: ContextRetriever) -> List[Context]:
+    """
+    Retrieve the relevant contexts for the question.
+
+    Args:
+        question: str
+            The question (or the input prompt).
+        retriever: ContextRetriever
+            The context retriever (chromadb, langchain, google).
+    """
+
+    if question is None or len(question.strip()) == 0:
+        return []
+
+    retrieved_contexts = retriever.query(
+        text=question,
+    )
+
+    return make_question_contexts(retrieved_contexts)
+
+
+def make_question_contexts(retrieved_contexts: List[dict]) -> List[Context]:
+    """
+    Create the contexts of the question from the retrieved contexts (dicts).
+    """
+
+    return [
+        Context(
+            id="c_q_" + str(j),
+            atom=None,
+            text=context["text"],
+            title=context["title"],
+            link=context["link"],
+            snippet=context["snippet"]
+        ) for j, context in enumerate(retrieved_contexts) 
+    ]
+
+
 def build_contexts(
         atoms: dict = {},
         question: str = None,
         retriever: ContextRetriever = None,
+        topic: str = None,
 ):
     """
     Retrieve the relevant contexts for the input atoms.
@@ -448,8 +537,12 @@ def build_contexts(
     Args:
         atoms: dict
             A dict containing the atoms in the response.
+        question: str
+            The question (optional). If given, contexts are also retrieved for it.
         retriever: ContextRetriever 
             The context retriever (chromadb, langchain, google).
+        topic: str
+            The topic of the response (used for query generation).
     """
 
     assert (len(atoms) > 0), \
@@ -461,48 +554,24 @@ def build_contexts(
     print(f"[Building contexts...]")
     contexts = {}
 
-    for aid, atom in atoms.items():
-        
-        retrieved_contexts = retriever.query(
-            text=atom.text,
-        )
-        
-        if len(retrieved_contexts) > 0:
-            contexts_per_atom = [
-                Context(
-                    id="c_" + aid + "_" + str(j),
-                    atom=atom,
-                    text=context["text"],
-                    title=context["title"],
-                    link=context["link"],
-                    snippet=context["snippet"]
-                    # An empty summary means that the context is not relevant, therefore we do not add it to the list of contexts for the pipeline
-                ) for j, context in enumerate(retrieved_contexts) 
-            ]
-
+    # the queries for all atoms and the question (if any) are generated in one batch
+    atom_ids = list(atoms.keys())
+    texts = [atoms[aid].text for aid in atom_ids]
+    has_question = question is not None and len(question.strip()) > 0
+    if has_question:
+        texts.append(question)
+    results = retriever.query_many(texts, topic=topic)
+
+    for aid, retrieved_contexts in zip(atom_ids, results[:len(atom_ids)]):
+        contexts_per_atom = make_atom_contexts(atoms[aid], retrieved_contexts)
+        if len(contexts_per_atom) > 0:
             for ctxt in contexts_per_atom:
                 contexts[ctxt.id] = ctxt
             atoms[aid].add_contexts(contexts_per_atom)
 
     # we retrieve the contexts for the question
-    retrieved_contexts = retriever.query(
-        text=question,
-    )
-    
-    if len(retrieved_contexts) > 0:
-        contexts_per_atom = [
-            Context(
-                id="c_q_" + str(j),
-                atom=None,
-                text=context["text"],
-                title=context["title"],
-                link=context["link"],
-                snippet=context["snippet"]
-                # An empty summary means that the context is not relevant, therefore we do not add it to the list of contexts for the pipeline
-            ) for j, context in enumerate(retrieved_contexts) 
-        ]
-
-        for ctxt in contexts_per_atom:
+    if has_question:
+        for ctxt in make_question_contexts(results[-1]):
             contexts[ctxt.id] = ctxt
     
     print(f"[Contexts built: {len(contexts)}]")
@@ -615,6 +684,65 @@ def is_relevant_context(context: str) -> dict:
     return True
 
 
+def predict_context_context_relationships(
+        context_pairs: List[Tuple[Context, Context]],
+        nli_extractor: NLIExtractor,
+        text_only: bool = True
+) -> List[Relation]:
+    """
+    Predict the relationships between pairs of contexts. Each pair is scored
+    in both directions and the most probable direction is kept (a pair that
+    entails both ways is an equivalence). The neutral relations are dropped.
+
+    Args:
+        context_pairs: List[Tuple[Context, Context]]
+            The (context, context) pairs.
+        nli_extractor: NLIExtractor
+            The NLI model used for predicting the relationships.
+        text_only: bool
+            Flag indicating that contexts are text only.
+    Returns:
+        A list of Relations.
+    """
+
+    if len(context_pairs) == 0:
+        return []
+
+    context_context_pairs1 = list(context_pairs)
+    context_context_pairs2 = [(context_j, context_i) for context_i, context_j in context_pairs]
+
+    # Get relationships (c_i, c_j)
+    relations1 = predict_nli_relationships(
+        context_context_pairs1,
+        nli_extractor=nli_extractor,
+        links_type="context_context",
+        text_only=text_only
+    )
+
+    # Get relationships (c_j, c_i)
+    relations2 = predict_nli_relationships(
+        context_context_pairs2,
+        nli_extractor=nli_extractor,
+        links_type="context_context",
+        text_only=text_only
+    )
+
+    relations_tmp = [pair[0] if pair[0].get_probability()>pair[1].get_probability() else pair[1] for pair in zip(relations1,relations2)]
+    assert len(relations_tmp) == len(relations1) # safety checks
+
+    for rel_ind in range(len(relations_tmp)):
+        if not (relations1[rel_ind].get_type() == "entailment" and relations2[
+            rel_ind].get_type() == "entailment"): continue
+        relations_tmp[rel_ind].type = "equivalence"
+
+    relations = []
+    for rel in relations_tmp:
+        if rel.get_type() != "neutral":
+            print(rel)
+            relations.append(rel)
+    return relations
+
+
 def build_relations(
         atoms: dict = {},
         contexts: dict = {},
@@ -656,8 +784,6 @@ def build_relations(
     assert (nli_extractor is not None), f"The NLI extractor must exist!"
     
     atom_context_pairs = []
-    context_context_pairs1 = []
-    context_context_pairs2 = []
 
     relations = []
 
@@ -696,40 +822,11 @@ def build_relations(
         print(f"[Building context-context relations...]")
         clist = [ci for ci in sorted(contexts.keys())]
         all_pairs = list(combinations(clist, 2))
-        # Create all (context, context) pairs
-        for ci, cj in all_pairs:
-            context_i = contexts[ci]
-            context_j = contexts[cj]
-            context_context_pairs1.append((context_i, context_j))
-            context_context_pairs2.append((context_j, context_i))
-
-        # Get relationships (c_i, c_j)
-        relations1 = predict_nli_relationships(
-            context_context_pairs1,
+        relations.extend(predict_context_context_relationships(
+            [(contexts[ci], contexts[cj]) for ci, cj in all_pairs],
             nli_extractor=nli_extractor,
-            links_type="context_context",
             text_only=text_only
-        )
-
-        # Get relationships (c_j, c_i)
-        relations2 = predict_nli_relationships(
-            context_context_pairs2,
-            nli_extractor=nli_extractor,
-            links_type="context_context",
-            text_only=text_only
-        )
-
-        relations_tmp = [pair[0] if pair[0].get_probability()>pair[1].get_probability() else pair[1] for pair in zip(relations1,relations2)]
-        assert len(relations_tmp) == len(relations1) # safety checks
-
-        for rel_ind in range(len(relations_tmp)):
-            if not (relations1[rel_ind].get_type() == "entailment" and relations2[
-                rel_ind].get_type() == "entailment"): continue
-            relations_tmp[rel_ind].type = "equivalence"
-        for rel in relations_tmp:
-            if rel.get_type() != "neutral":
-                print(rel)
-                relations.append(rel)
+        ))
 
     print(f"[Relations built: {len(relations)}]")
     return relations
@@ -23,6 +23,10 @@ import os
 import subprocess
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from typing import List
+
 from pgmpy.factors.discrete import DiscreteFactor
 from pgmpy.global_vars import logger
 from pgmpy.models import MarkovNetwork
@@ -31,6 +35,7 @@ from pgmpy.readwrite import UAIWriter
 # Local imports
 from src.fact_reasoner.atom_extractor import AtomExtractor
 from src.fact_reasoner.atom_reviser import AtomReviser
+from src.fact_reasoner.budget_planner import BudgetPlanner, VerificationBudget
 from src.fact_reasoner.context_retriever import ContextRetriever
 from src.fact_reasoner.context_summarizer import ContextSummarizer
 from src.fact_reasoner.fact_graph import FactGraph
@@ -44,11 +49,21 @@ from src.fact_reasoner.fact_utils import (
     build_contexts,
     build_relations,
     is_relevant_context,
+    predict_context_context_relationships,
     remove_duplicated_atoms,
     remove_duplicated_contexts,
+    retrieve_atom_contexts,
+    retrieve_question_contexts,
 )
 from src.fact_reasoner.nli_extractor import NLIExtractor
 from src.fact_reasoner.query_builder import QueryBuilder
+from src.fact_reasoner.verifiability_filter import VerifiabilityFilter
+from src.fact_reasoner.score_estimator import (
+    make_strata,
+    sample_order,
+    stratified_interval,
+    wilson_interval,
+)
 
 # Set logging levels 
 # pgmpy set the root logger to INFO -- changed it to WARNING
@@ -69,6 +84,7 @@ class FactReasoner:
             atom_reviser: AtomReviser = None,
             nli_extractor: NLIExtractor = None,
             query_builder: QueryBuilder = None,
+            verifiability_filter: VerifiabilityFilter = None,
             merlin_path: str = None,
             debug_mode: bool = False,
             use_priors: bool = True,
@@ -89,6 +105,9 @@ class FactReasoner:
                 The service used for NLI relationship extraction.
             query_builder: QueryBuilder
                 The query builder used to generating search queries for atoms.
+            verifiability_filter: VerifiabilityFilter
+                The filter used for dropping subjective or unverifiable atoms
+                before the revision, retrieval and NLI stages (optional).
             merlin_path: str
                 Path to the Merlin probabilistic reasoning engine (c++ implementation).
             debug_mode: bool
@@ -110,6 +129,7 @@ class FactReasoner:
         self.nli_extractor = nli_extractor
         self.merlin_path = merlin_path
         self.query_builder = query_builder
+        self.verifiability_filter = verifiability_filter
 
         # Inject the query builder into the context retriever
         if self.context_retriever is not None:
@@ -124,9 +144,11 @@ class FactReasoner:
         self.atoms = {}  # indexed by atom id
         self.contexts = {}  # indexed by context id
         self.relations = []
+        self.unverifiable_atoms = {}  # indexed by atom id
 
         self.num_retrieved_contexts = 0
         self.num_summarized_contexts = 0
+        self.budget_report = None
 
         # The fact graph and probabilistic model (Markov Network)
         self.fact_graph = None
@@ -220,8 +242,9 @@ class FactReasoner:
             text = atom_dict["text"]
             original = atom_dict["original"]
             label = atom_dict.get("label", None)
+            unit_type = atom_dict.get("unit_type", None)
             contexts = atom_dict["contexts"]
-            a = Atom(id=aid, text=text, label=label)
+            a = Atom(id=aid, text=text, label=label, unit_type=unit_type)
             a.set_original(original)
             atom_ids.append(aid)
             gold_labels.append(label)
@@ -266,7 +289,12 @@ class FactReasoner:
             rel_atom_context: bool = True,
             rel_context_context: bool = True,
             question: str = None,
-            text_only: bool = True
+            text_only: bool = True,
+            budget: VerificationBudget = None,
+            stream_atoms: bool = False,
+            num_workers: int = 4,
+            tiered_evidence: bool = False,
+            min_evidence_probability: float = 0.7
     ):
         """
         Build the atoms and contexts using the retrieval service.
@@ -297,6 +325,30 @@ class FactReasoner:
             text_only: bool (default is True)
                 Flag indicating that contexts are text only. If False, then the
                 contexts are (Title, Snippet, Link, Text).
+            budget: VerificationBudget (default is None)
+                If it is not None, a hard budget (LLM calls, tokens, seconds) for
+                the response. The retrieval, summarization and NLI work is then
+                allocated across atoms by the BudgetPlanner and the pipeline
+                stops when the budget runs out. The context-context relations
+                are built last, with the budget left. If the budget runs out
+                before any context is retrieved, the atoms are scored by their
+                priors.
+            stream_atoms: bool (default is False)
+                If True, the atoms are streamed from the atom extractor and each
+                atom is revised and its contexts retrieved as soon as it is
+                extracted (overlapping the three stages). Only used when both
+                the atoms and contexts are built here and there is no budget.
+            num_workers: int (default is 4)
+                The number of threads revising atoms and retrieving contexts
+                while the atoms are streamed.
+            tiered_evidence: bool (default is False)
+                If True (google retriever with `fetch_text`), the contexts are
+                first retrieved as search snippets only. The full pages are then
+                fetched only for the atoms whose snippet evidence is inconclusive,
+                and the relations of those atoms are re-scored.
+            min_evidence_probability: float (default is 0.7)
+                An atom's evidence is conclusive if it has an entailment or a
+                contradiction relation with at least this probability.
         """
 
         if not self.query:
@@ -307,6 +359,7 @@ class FactReasoner:
         self.markov_network = None
         self.debug_mode = debug_mode
         self.response = response
+        self.budget_report = None
 
         # Safety checks
         assert self.atom_extractor is not None, f"Atom extractor must be created."
@@ -316,21 +369,37 @@ class FactReasoner:
         # Output some info
         print(f"[FactReasoner] Building the pipeline instance ...")
         print(f"[FactReasoner] Using text only contexts: {text_only}")
+
+        if budget is not None:
+            budget.start(self._get_llm_handlers())
+
+        # Stages 1, 2 and 3 overlapped (streaming Atomizer, Reviser, ContextRetriever)
+        streamed = stream_atoms and not has_atoms and not has_contexts and budget is None
+        if streamed:
+            assert self.response is not None, f"Response cannot be None for decomposition!"
+            self._stream_atoms_and_contexts(revise_atoms, question, num_workers)
         
         # Stage 1: decompose the response into atomic units (Atomizer)
-        if has_atoms == False:
+        if has_atoms == False and not streamed:
             assert self.response is not None, f"Response cannot be None for decomposition!"
             self.atoms = build_atoms(
                 response=self.response,
-                atom_extractor=self.atom_extractor
+                atom_extractor=self.atom_extractor,
+                all_units=self.verifiability_filter is not None
             )
 
         # Safety checks
         assert (len(self.atoms.keys()) > 0 or not has_atoms), \
             f"Atoms must be initialized if `has_atoms` is True!"
 
+        # Drop the subjective or unverifiable atoms (VerifiabilityFilter)
+        if not streamed:
+            self._filter_atoms()
+
         # Stage 2: revise the atomic units to be self-contained (Reviser)
-        if revise_atoms:
+        if revise_atoms and budget is not None and not budget.can_afford(len(self.atoms)):
+            print(f"[FactReasoner] Skipping the atom revision (not enough budget).")
+        elif revise_atoms and not streamed:
             print(f"[FactReasoner] Revise the atoms ...")
             atom_ids = [aid for aid in sorted(self.atoms.keys())]
             old_atoms = [self.atoms[aid].get_text() for aid in atom_ids]
@@ -341,14 +410,64 @@ class FactReasoner:
                 print(self.atoms[aid])
 
         self.atoms = remove_duplicated_atoms(self.atoms)
-        
-        # Stage 3: Build contexts (ContextRtriever)
-        if not has_contexts:
-            self.contexts = build_contexts(
+        if streamed:  # drop the contexts retrieved for the duplicated atoms
+            self.contexts = {
+                cid: c for cid, c in self.contexts.items() if c.atom is None or c.atom.id in self.atoms
+            }
+
+        # Stages 3 and 4 under a budget (BudgetPlanner)
+        if budget is not None:
+            assert rel_atom_context, f"The budgeted pipeline requires atom-context relations."
+            planner = BudgetPlanner(
+                context_retriever=self.context_retriever,
+                nli_extractor=self.nli_extractor,
+                context_summarizer=self.context_summarizer,
+                budget=budget,
+                summarize_contexts=summarize_contexts,
+                contexts_per_atom_only=contexts_per_atom_only,
+                rel_context_context=rel_context_context,
+                remove_duplicates=remove_duplicates,
+                text_only=text_only,
+                topic=self.topic,
+            )
+            self.contexts, self.relations = planner.run(
                 atoms=self.atoms,
-                question=question,
-                retriever=self.context_retriever
+                contexts=self.contexts if has_contexts else None,
+                question=question
             )
+            self.num_retrieved_contexts = len(self.contexts.keys())
+            self.num_summarized_contexts = len(self.contexts.keys())
+            self.budget_report = planner.report()
+
+            # Score with whatever relations exist (atom priors only if none)
+            if len(self.atoms.keys()) > 0:
+                if len(self.contexts.keys()) == 0:
+                    print(f"[FactReasoner] No relevant contexts were retrieved within the budget, using the atom priors.")
+                print(f"[FactReasoner] Building the graphical model ...")
+                self._build_fact_graph()
+                self._build_markov_network()
+                print(f"[FactReasoner] Pipeline instance created.")
+            else:
+                print(f"[FactReasoner] Could not create fact graph because no atoms are available.")
+            return
+        
+        # Stage 3: Build contexts (ContextRtriever)
+        tiered = tiered_evidence and not has_contexts and not streamed
+        if tiered:
+            assert self.context_retriever.service_type == "google" and self.context_retriever.fetch_text, \
+                f"Tiered evidence requires the google retriever with `fetch_text`."
+            self.context_retriever.fetch_text = False  # snippets only (first tier)
+        if not has_contexts and not streamed:
+            try:
+                self.contexts = build_contexts(
+                    atoms=self.atoms,
+                    question=question,
+                    retriever=self.context_retriever,
+                    topic=self.topic
+                )
+            finally:
+                if tiered:
+                    self.context_retriever.fetch_text = True
 
         # for tracking purposes
         self.num_retrieved_contexts = len(self.contexts.keys()) 
@@ -430,6 +549,17 @@ class FactReasoner:
                 text_only=text_only,
             )
 
+            # Second tier: fetch the full pages for the inconclusive atoms
+            if tiered and rel_atom_context:
+                self._upgrade_evidence(
+                    question=question,
+                    min_evidence_probability=min_evidence_probability,
+                    summarize_contexts=summarize_contexts,
+                    rel_context_context=rel_context_context,
+                    contexts_per_atom_only=contexts_per_atom_only,
+                    text_only=text_only,
+                )
+
             # Build the fact graph and Markov network
             print(f"[FactReasoner] Building the graphical model ...")
             self._build_fact_graph()
@@ -444,6 +574,219 @@ class FactReasoner:
             print(f"[FactReasoner] Could not create fact graph because no atoms are available.")
 
 
+    def _upgrade_evidence(
+            self,
+            question: str,
+            min_evidence_probability: float,
+            summarize_contexts: bool,
+            rel_context_context: bool,
+            contexts_per_atom_only: bool,
+            text_only: bool
+    ):
+        """
+        Fetch the full pages of the (snippet only) contexts of the atoms whose
+        evidence is inconclusive, i.e., atoms without an entailment or a
+        contradiction relation of high enough probability. The upgraded
+        contexts are summarized again (in a single batch) and, as in `build`,
+        removed if the page is not relevant. The atom-context relations of the
+        inconclusive atoms and the context-context relations of the upgraded
+        contexts are then re-scored.
+        """
+
+        conclusive = set()
+        for rel in self.relations:
+            if rel.link == "context_atom" and rel.get_type() in ["entailment", "contradiction"] \
+                    and rel.get_probability() >= min_evidence_probability:
+                conclusive.add(rel.target.id)
+
+        inconclusive = {aid: atom for aid, atom in self.atoms.items() if aid not in conclusive}
+        if contexts_per_atom_only:
+            candidates = [c for atom in inconclusive.values() for c in atom.get_contexts().values()]
+        else:
+            candidates = list(self.contexts.values()) if len(inconclusive) > 0 else []
+        candidates = [c for c in candidates if c.id in self.contexts and c.link and c.text == ""]
+        print(f"[FactReasoner] Inconclusive atoms: {len(inconclusive)}, pages to fetch: {len(candidates)}")
+        if len(candidates) == 0:
+            return
+
+        texts = self.context_retriever.fetch_pages([c.link for c in candidates])
+        upgraded = [c for c, text in zip(candidates, texts) if len(text) > 0]
+        for context, text in zip(candidates, texts):
+            context.text = text
+        print(f"[FactReasoner] Upgraded contexts: {len(upgraded)}")
+        if len(upgraded) == 0:
+            return
+
+        # The relations of the upgraded contexts were scored on their snippets
+        upgraded_ids = set(c.id for c in upgraded)
+        self.relations = [
+            rel for rel in self.relations
+            if not (rel.link == "context_atom" and rel.target.id in inconclusive)
+            and not (rel.link == "context_context" and (rel.source.id in upgraded_ids or rel.target.id in upgraded_ids))
+        ]
+
+        if summarize_contexts:
+            # One batch for all the upgraded contexts, grouped by atom (or question)
+            groups = {}
+            for context in upgraded:
+                target = context.atom.text if context.atom is not None else question
+                groups.setdefault(target, []).append(context)
+            targets = list(groups.keys())
+            results = self.context_summarizer.runall(
+                [[c.get_snippet_and_text() for c in groups[target]] for target in targets], targets
+            )
+            for target, group_results in zip(targets, results):
+                for context, result in zip(groups[target], group_results):
+                    if result["summary"] != "" and is_relevant_context(result["summary"]):
+                        context.set_synthetic_summary(result["summary"])
+                    else:
+                        # the page is not related to the atom (as in `build`)
+                        self._remove_context(context)
+            upgraded = [c for c in upgraded if c.id in self.contexts]
+            self.num_summarized_contexts = len(self.contexts)
+        else:
+            for context in upgraded:
+                context.set_synthetic_summary(context.get_snippet_and_text())
+
+        if len(self.contexts) == 0:
+            return
+
+        # Re-score the atom-context relations of the inconclusive atoms
+        if len(inconclusive) > 0:
+            self.relations.extend(build_relations(
+                atoms=inconclusive,
+                contexts=self.contexts,
+                rel_atom_context=True,
+                rel_context_context=False,
+                contexts_per_atom_only=contexts_per_atom_only,
+                nli_extractor=self.nli_extractor,
+                text_only=text_only,
+            ))
+
+        # Re-score the context-context relations of the upgraded contexts
+        if rel_context_context and len(upgraded) > 0:
+            clist = sorted(self.contexts.keys())
+            upgraded_ids = set(c.id for c in upgraded)
+            pairs = [
+                (self.contexts[ci], self.contexts[cj]) for ci, cj in combinations(clist, 2)
+                if ci in upgraded_ids or cj in upgraded_ids
+            ]
+            self.relations.extend(predict_context_context_relationships(
+                pairs,
+                nli_extractor=self.nli_extractor,
+                text_only=text_only
+            ))
+
+    def _remove_context(self, context: Context):
+        """
+        Remove the context from the pipeline, its atom and the relations.
+        """
+
+        self.contexts.pop(context.id, None)
+        for atom in self.atoms.values():
+            atom.contexts.pop(context.id, None)
+        self.relations = [
+            rel for rel in self.relations if rel.source is not context and rel.target is not context
+        ]
+
+    def _stream_atoms_and_contexts(self, revise_atoms: bool, question: str, num_workers: int):
+        """
+        Stream the atoms from the atom extractor and, as soon as a micro-batch
+        of atoms (the reviser's batch size) is extracted, revise it in a
+        single reviser call and retrieve the contexts of its atoms in a thread
+        pool. The atoms keep the order (and ids) of the extraction.
+
+        Args:
+            revise_atoms: bool
+                Flag indicating that the atoms will be revised (decontextualized).
+            question: str
+                If it is not None, the contexts for the question are also retrieved.
+            num_workers: int
+                The number of worker threads.
+        """
+
+        def process(atoms: List[Atom]) -> List[List[Context]]:
+            if revise_atoms:
+                results = self.atom_reviser.run([atom.get_text() for atom in atoms], self.response)
+                for atom, result in zip(atoms, results):
+                    atom.set_text(result["revised_atom"])
+            return [retrieve_atom_contexts(atom, self.context_retriever, self.topic) for atom in atoms]
+
+        print(f"[FactReasoner] Streaming the atoms (workers: {num_workers}) ...")
+        all_units = self.verifiability_filter is not None
+        batch_size = max(1, self.atom_reviser.batch_size) if revise_atoms else 1
+        self.atoms = {}
+        self.contexts = {}
+        self.unverifiable_atoms = {}
+        batch = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            question_future = executor.submit(retrieve_question_contexts, question, self.context_retriever)
+            for elem in self.atom_extractor.stream(self.response):
+                if not all_units and elem["label"].lower() not in ["fact", "claim", "data format"]:
+                    continue
+
+                aid = "a" + str(len(self.atoms) + len(self.unverifiable_atoms))
+                atom = Atom(id=aid, text=elem["atom"], unit_type=elem["label"])
+                if self.verifiability_filter is not None:
+                    verifiable, unverifiable = self.verifiability_filter.split({aid: atom})
+                    if len(unverifiable) > 0:
+                        self.unverifiable_atoms.update(unverifiable)
+                        print(f"[FactReasoner] Skipping unverifiable atom {aid} ({unverifiable[aid]['reason']}): {unverifiable[aid]['text']}")
+                        continue
+
+                self.atoms[aid] = atom
+                batch.append(atom)
+                if len(batch) >= batch_size:
+                    futures.append((batch, executor.submit(process, batch)))
+                    batch = []
+
+            if len(batch) > 0:
+                futures.append((batch, executor.submit(process, batch)))
+
+            for atoms, future in futures:
+                for atom, contexts_per_atom in zip(atoms, future.result()):
+                    print(atom)
+                    if len(contexts_per_atom) > 0:
+                        for ctxt in contexts_per_atom:
+                            self.contexts[ctxt.id] = ctxt
+                        atom.add_contexts(contexts_per_atom)
+
+            for ctxt in question_future.result():
+                self.contexts[ctxt.id] = ctxt
+
+        if self.labels_human is not None and self.verifiability_filter is not None:
+            self.labels_human = {k: v for k, v in self.labels_human.items() if k in self.atoms}
+
+        print(f"[FactReasoner] Atoms streamed: {len(self.atoms)}, contexts retrieved: {len(self.contexts)}")
+
+    def _filter_atoms(self):
+        """
+        Split the atoms into verifiable and unverifiable ones (if a filter exists).
+        """
+
+        self.unverifiable_atoms = {}
+        if self.verifiability_filter is not None:
+            self.atoms, self.unverifiable_atoms = self.verifiability_filter.split(self.atoms)
+            for aid, elem in self.unverifiable_atoms.items():
+                print(f"[FactReasoner] Skipping unverifiable atom {aid} ({elem['reason']}): {elem['text']}")
+            if self.labels_human is not None:
+                self.labels_human = {k: v for k, v in self.labels_human.items() if k in self.atoms}
+
+    def _get_llm_handlers(self) -> list:
+        """
+        Return the LLM handlers used by the pipeline components.
+        """
+
+        components = [
+            self.atom_extractor,
+            self.atom_reviser,
+            self.context_summarizer,
+            self.nli_extractor,
+            self.query_builder,
+        ]
+        return [c.llm_handler for c in components if getattr(c, "llm_handler", None) is not None]
+
     def pipeline_to_json(self, json_file_path: str = None):
         """
         Save the pipeline instance to a JSON file.
@@ -462,6 +805,8 @@ class FactReasoner:
             )
             if atom.get_label() is not None:
                 atom_data["label"] = atom.get_label()
+            if atom.get_unit_type() is not None:
+                atom_data["unit_type"] = atom.get_unit_type()
             data["atoms"].append(atom_data)
 
         data["contexts"] = [context.context_to_json() for context in self.contexts.values()]
@@ -827,9 +1172,195 @@ class FactReasoner:
         #     results["topic"] = self.topic
         results["input"] = self.query
         results["marginals"] = marginals
+        if self.budget_report is not None:
+            results["budget"] = self.budget_report
+        if self.verifiability_filter is not None:
+            results["num_unverifiable_atoms"] = len(self.unverifiable_atoms)
+            results["unverifiable_atoms"] = [dict(id=aid, **elem) for aid, elem in self.unverifiable_atoms.items()]
 
         return results, marginals
 
+    def estimate_score(
+            self,
+            response: str = None,
+            has_atoms: bool = False,
+            revise_atoms: bool = True,
+            summarize_contexts: bool = False,
+            text_only: bool = True,
+            strategy: str = "random",
+            num_strata: int = 4,
+            width: float = 0.1,
+            confidence: float = 0.95,
+            batch_size: int = 5,
+            min_atoms: int = 10,
+            max_atoms: int = None,
+            seed: int = 42,
+    ):
+        """
+        Estimate the factuality score (# atoms(true) / # atoms) by verifying
+        a random or stratified sample of the atoms. The atoms are verified
+        sequentially, in batches, and the process stops once the confidence
+        interval of the estimate is narrower than `width`. Each sampled atom
+        is verified against its own contexts only (i.e., FR1 style).
+
+        Args:
+            response: str
+                The input LLM generated long-form response.
+            has_atoms: bool
+                Flag indicating if the atoms were previously initialized.
+            revise_atoms: bool
+                Flag indicating that the sampled atoms will be revised (decontextualized).
+            summarize_contexts: bool
+                Flag indicating if contexts are to be summarized.
+            text_only: bool
+                Flag indicating that contexts are text only.
+            strategy: str
+                The sampling strategy: `random` or `stratified` (by position in the response).
+            num_strata: int
+                The number of strata used by the stratified sampling.
+            width: float
+                The requested width of the confidence interval.
+            confidence: float
+                The confidence level of the interval (e.g., 0.95).
+            batch_size: int
+                The number of atoms verified before the interval is re-evaluated.
+            min_atoms: int
+                The minimum number of atoms verified before stopping.
+            max_atoms: int
+                The maximum number of atoms verified (None means all atoms).
+            seed: int
+                The random seed used for sampling.
+
+        Returns:
+            dict
+                The results dictionary containing the estimated factuality
+                score, its confidence interval and the sampled atoms' marginals.
+        """
+
+        # Safety checks
+        assert self.nli_extractor is not None, f"NLI extractor must be created."
+        assert self.context_retriever is not None, f"Context retriever must be created."
+        assert batch_size > 0, f"The batch size must be positive."
+
+        if response is not None:
+            self.response = response
+        if not has_atoms:
+            assert self.atom_extractor is not None, f"Atom extractor must be created."
+            assert self.response is not None, f"Response cannot be None for decomposition!"
+            self.atoms = build_atoms(
+                response=self.response,
+                atom_extractor=self.atom_extractor,
+                all_units=self.verifiability_filter is not None
+            )
+        self._filter_atoms()
+
+        all_atoms = self.atoms
+        atom_ids = list(all_atoms.keys())  # in response order
+        population = len(atom_ids)
+        assert population > 0, f"No atoms available for estimation."
+
+        order = sample_order(atom_ids, strategy=strategy, num_strata=num_strata, seed=seed)
+        if max_atoms is not None:
+            order = order[:max_atoms]
+        strata = make_strata(atom_ids, num_strata) if strategy == "stratified" else [atom_ids]
+        stratum_of = {aid: i for i, stratum in enumerate(strata) for aid in stratum}
+
+        planner = BudgetPlanner(
+            context_retriever=self.context_retriever,
+            nli_extractor=self.nli_extractor,
+            context_summarizer=self.context_summarizer,
+            summarize_contexts=summarize_contexts,
+            contexts_per_atom_only=True,
+            text_only=text_only,
+        )
+
+        print(f"[FactReasoner] Estimating the factuality score from a {strategy} sample of {population} atoms ...")
+        sampled_contexts = {}
+        sampled_relations = []
+        labels = {}
+        probabilities = {}
+        estimate, lower, upper = 0.0, 0.0, 1.0
+        for start in range(0, len(order), batch_size):
+            batch_ids = order[start:start + batch_size]
+            batch_atoms = {aid: all_atoms[aid] for aid in batch_ids}
+
+            if revise_atoms:
+                assert self.atom_reviser is not None, f"Atom reviser must be created."
+                result = self.atom_reviser.run([batch_atoms[aid].get_text() for aid in batch_ids], self.response)
+                for i, aid in enumerate(batch_ids):
+                    batch_atoms[aid].set_text(result[i]["revised_atom"])
+
+            # Verify the batch (retrieval, summarization, NLI)
+            contexts, relations = planner.run(atoms=batch_atoms)
+            sampled_contexts.update(contexts)
+            sampled_relations.extend(relations)
+
+            if len(relations) > 0:
+                self.atoms = batch_atoms
+                self.contexts = contexts
+                self.relations = relations
+                self._build_fact_graph()
+                self._build_markov_network()
+                marginals = self.run_merlin()
+            else:  # no evidence: the atoms keep their prior probability
+                marginals = [
+                    dict(variable=aid, probabilities=[1.0 - atom.probability, atom.probability])
+                    for aid, atom in batch_atoms.items()
+                ]
+
+            for marginal in marginals:
+                var = marginal["variable"]
+                probs = marginal["probabilities"]
+                probabilities[var] = probs[1]
+                labels[var] = "S" if probs[1] > probs[0] else "NS"
+
+            # Update the estimate and its confidence interval
+            num_sampled = len(labels)
+            num_true = len([l for l in labels.values() if l == "S"])
+            if strategy == "stratified":
+                stats = [
+                    dict(
+                        size=len(stratum),
+                        num_sampled=len([aid for aid in labels if stratum_of[aid] == i]),
+                        num_true=len([aid for aid in labels if stratum_of[aid] == i and labels[aid] == "S"]),
+                    ) for i, stratum in enumerate(strata)
+                ]
+                estimate, lower, upper = stratified_interval(stats, confidence=confidence)
+            else:
+                estimate = num_true / num_sampled
+                lower, upper = wilson_interval(num_true, num_sampled, confidence=confidence, population=population)
+
+            print(f"[FactReasoner] Sampled atoms: {num_sampled}/{population}, estimate: {estimate:.4f} [{lower:.4f}, {upper:.4f}]")
+            if upper - lower <= width and num_sampled >= min(min_atoms, population):
+                break
+
+        # Keep the sampled sub-problem around (e.g., for `score()` or `dump()`)
+        self.atoms = {aid: all_atoms[aid] for aid in labels.keys()}
+        self.contexts = sampled_contexts
+        self.relations = sampled_relations
+        if len(self.relations) > 0:
+            self._build_fact_graph()
+            self._build_markov_network()
+
+        results = {}
+        results["factuality_score"] = estimate
+        results["factuality_score_ci"] = [lower, upper]
+        results["confidence"] = confidence
+        results["sampling_strategy"] = strategy
+        results["num_atoms"] = population
+        results["num_sampled_atoms"] = len(labels)
+        results["num_true_sampled_atoms"] = len([l for l in labels.values() if l == "S"])
+        results["num_contexts"] = len(sampled_contexts)
+        results["factuality_score_per_atom"] = [
+            {aid: {"score": probabilities[aid], "support": labels[aid]}} for aid in labels.keys()
+        ]
+        if self.verifiability_filter is not None:
+            results["num_unverifiable_atoms"] = len(self.unverifiable_atoms)
+            results["unverifiable_atoms"] = [dict(id=aid, **elem) for aid, elem in self.unverifiable_atoms.items()]
+        results["input"] = self.query
+
+        return results
+
 
 if __name__ == "__main__":
 
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import threading
 
 import litellm
 import torch
@@ -60,6 +61,13 @@ class LLMHandler:
 
         self.backend = backend  # The model's backend: one of [rits, hf, wx]
         self.default_kwargs = default_kwargs  # Store common parameters for completions
+
+        # Usage counters (number of LLM calls and tokens consumed so far),
+        # updated under a lock as the handler may be shared by threads
+        self.usage_lock = threading.Lock()
+        self.num_calls = 0
+        self.num_prompt_tokens = 0
+        self.num_completion_tokens = 0
         assert backend in ["rits", "hf", "wx"], \
             f"Model backend {backend} is not supported yet. Use `rits`, `hf` or `wx` only."
         
@@ -154,6 +162,84 @@ class LLMHandler:
         """
         return self._call_model(prompts, **kwargs)
 
+    def stream_completion(self, prompt, num_retries=5, **kwargs):
+        """
+        Generate a response and yield the generated text incrementally. With
+        the API backends (rits, wx) the text is streamed as it is decoded,
+        whereas the local model (hf) yields the whole text at once.
+
+        Args:
+            prompt: str
+                The prompt to generate a response for.
+            num_retries: int
+                Number of retries for the API call in case of failure.
+            kwargs: dict
+                Additional parameters for completion (e.g., temperature, max_tokens).
+        """
+
+        if self.backend == "hf":
+            response = self._call_model(prompt, **kwargs)
+            yield response.choices[0].message.content
+            return
+
+        params = {
+            "temperature": 0,
+            "seed": 42,
+            **self.default_kwargs,
+            **kwargs
+        }
+
+        stream = litellm.completion(
+            model=self.model_id,
+            api_base=self.api_base,
+            messages=[{"role": "user", "content": prompt}],
+            api_key=self.api_key,
+            num_retries=num_retries,
+            extra_headers=self.extra_headers,
+            stream=True,
+            stream_options={"include_usage": True},
+            **params
+        )
+
+        self._add_usage(1, None)
+        for chunk in stream:
+            # The last chunk carries the usage (if the provider reports it)
+            self._add_usage(0, getattr(chunk, "usage", None))
+            if len(chunk.choices) > 0:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+
+    def get_num_tokens(self) -> int:
+        """
+        Returns the total number of tokens (prompt and completion) consumed so far.
+        """
+
+        return self.num_prompt_tokens + self.num_completion_tokens
+
+    def _update_usage(self, responses):
+        """
+        Update the usage counters given the responses returned by the model.
+
+        Args:
+            responses: list
+                The list of responses (litellm format) returned by the model.
+        """
+
+        for response in responses:
+            self._add_usage(1, getattr(response, "usage", None))
+
+    def _add_usage(self, num_calls: int, usage):
+        """
+        Add the number of calls and the token usage (if any) to the counters.
+        """
+
+        with self.usage_lock:
+            self.num_calls += num_calls
+            if usage is not None:
+                self.num_prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+                self.num_completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
     def _call_model(self, prompts, num_retries=5, **kwargs):
         """
         Handles both single and batch generation.
@@ -180,7 +266,7 @@ class LLMHandler:
         if self.backend in ["rits", "wx"]:
             # Ensure we always send a list to batch_completion
             if isinstance(prompts, str):
-                return litellm.completion(
+                response = litellm.completion(
                     model=self.model_id,
                     api_base=self.api_base,
                     messages=[{"role": "user", "content": prompts}],  # Wrap prompt for compatibility
@@ -189,7 +275,9 @@ class LLMHandler:
                     extra_headers=self.extra_headers,
                     **params
                 )
-            return litellm.batch_completion(
+                self._update_usage([response])
+                return response
+            responses = litellm.batch_completion(
                 model=self.model_id,
                 api_base=self.api_base,
                 messages=[[{"role": "user", "content": p}] for p in prompts],  # Wrap each prompt
@@ -198,6 +286,8 @@ class LLMHandler:
                 extra_headers=self.extra_headers,
                 **params
             )
+            self._update_usage(responses)
+            return responses
 
         elif self.backend == "hf":
             # Ensure prompts is always a list for vLLM
@@ -216,6 +306,7 @@ class LLMHandler:
 
             # Convert vLLM outputs to match litellm format
             responses = [self.transform_vllm_response(output) for output in outputs]
+            self._update_usage(responses)
             
             return responses if len(prompts) > 1 else responses[0]
             #return [output.outputs[0].text for output in outputs] #TODO: make output consistent with that of RITS
@@ -245,7 +336,11 @@ class LLMHandler:
                     "message": dotdict({"content": text}),
                     "logprobs": {"content": logprobs}
                 })
-            ]
+            ],
+            "usage": dotdict({
+                "prompt_tokens": len(response_obj.prompt_token_ids or []),
+                "completion_tokens": len(output_obj.token_ids or [])
+            })
         })
 
         return transformed_response
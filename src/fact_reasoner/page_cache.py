@@ -0,0 +1,169 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Persistent (SQLite) cache of the text extracted from web pages
+
+import sqlite3
+import threading
+import time
+import zlib
+
+from typing import Optional, Tuple
+
+DEFAULT_TTL = 30 * 24 * 3600  # 30 days
+DEFAULT_NEGATIVE_TTL = 24 * 3600  # 1 day
+DEFAULT_MAX_SIZE = 1 << 30  # 1 GB (compressed)
+
+
+class PageCache:
+    """
+    A disk cache of the text extracted from web pages (HTML or PDF), keyed by
+    URL. The text is stored zlib compressed. Entries expire after `ttl`
+    seconds, and the least recently used entries are evicted when the total
+    (compressed) size exceeds `max_size` bytes. Failed fetches (e.g., 403s,
+    timeouts) are cached as well (negative caching) for `negative_ttl` seconds.
+    """
+
+    def __init__(
+            self,
+            cache_file: str,
+            ttl: float = DEFAULT_TTL,
+            negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+            max_size: int = DEFAULT_MAX_SIZE,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            cache_file: str
+                The path to the SQLite database.
+            ttl: float
+                The time to live (seconds) of the cached pages.
+            negative_ttl: float
+                The time to live (seconds) of the cached failures.
+            max_size: int
+                The maximum total size (bytes) of the compressed pages.
+        """
+
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+        with sqlite3.connect(self.cache_file) as conn:
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL;")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    content BLOB,
+                    error TEXT,
+                    size INTEGER,
+                    created REAL,
+                    accessed REAL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)")
+            conn.commit()
+
+        print(f"[PageCache] Using page cache: {self.cache_file}")
+
+    def get(self, url: str) -> Tuple[bool, Optional[str]]:
+        """
+        Look up the url.
+
+        Returns:
+            A tuple (hit, text). On a hit, the text is the cached page text or
+            None if the cached entry is a failure.
+        """
+
+        now = time.time()
+        with sqlite3.connect(self.cache_file) as conn:
+            row = conn.execute(
+                "SELECT content, error, created FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+            if row is not None:
+                content, error, created = row
+                ttl = self.negative_ttl if error is not None else self.ttl
+                if now - created <= ttl:
+                    with self.lock:
+                        conn.execute("UPDATE pages SET accessed = ? WHERE url = ?", (now, url))
+                        conn.commit()
+                    self.num_hits += 1
+                    if error is not None:
+                        return True, None
+                    return True, zlib.decompress(content).decode("utf-8")
+
+        self.num_misses += 1
+        return False, None
+
+    def put(self, url: str, text: str):
+        """
+        Store the text extracted from the url.
+        """
+
+        content = zlib.compress(text.encode("utf-8"))
+        self._store(url, content, None, len(content))
+
+    def put_failure(self, url: str, error: str):
+        """
+        Store a failed fetch of the url (negative caching).
+        """
+
+        self._store(url, None, error, 0)
+
+    def _store(self, url: str, content: bytes, error: str, size: int):
+        now = time.time()
+        with self.lock:
+            with sqlite3.connect(self.cache_file) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO pages (url, content, error, size, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, content, error, size, now, now)
+                )
+                conn.commit()
+                if size > 0:
+                    self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """
+        Delete the expired entries and then the least recently used ones until
+        the total size is below 90% of the cap.
+        """
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        now = time.time()
+        conn.execute(
+            "DELETE FROM pages WHERE (error IS NULL AND created < ?) OR (error IS NOT NULL AND created < ?)",
+            (now - self.ttl, now - self.negative_ttl)
+        )
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        target = int(0.9 * self.max_size)
+        cursor = conn.execute("SELECT url, size FROM pages ORDER BY accessed ASC")
+        evicted = []
+        for url, size in cursor:
+            if total <= target:
+                break
+            evicted.append((url,))
+            total -= size
+        conn.executemany("DELETE FROM pages WHERE url = ?", evicted)
+        conn.commit()
+        print(f"[PageCache] Evicted {len(evicted)} pages.")
@@ -0,0 +1,164 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Concurrent page fetching with a pooled HTTP session and per-host limits
+
+import threading
+import requests
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 10  # seconds
+DEFAULT_USER_AGENT = "Mozilla/5.0 (compatible; FactReasoner/0.3)"
+
+
+def get_host(link: str) -> str:
+    """
+    Return the host name of the link (lowercase, without a leading `www.`).
+    """
+
+    host = urlparse(link).netloc.lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+class PageFetcher:
+    """
+    Fetch web pages concurrently. All requests share a pooled HTTP session
+    (keep-alive connections), run on a single worker pool and at most
+    `max_per_host` requests are in flight for the same host at any time. The
+    requests exceeding a host's limit wait in a per-host queue (not on a
+    worker), so the workers stay available for the other hosts.
+    """
+
+    def __init__(
+            self,
+            max_workers: int = 8,
+            max_per_host: int = 2,
+            timeout: float = DEFAULT_TIMEOUT,
+            user_agent: str = DEFAULT_USER_AGENT,
+    ):
+        """
+        Initialize the fetcher.
+
+        Args:
+            max_workers: int
+                The number of worker threads (shared by all requests).
+            max_per_host: int
+                The maximum number of concurrent requests to the same host.
+            timeout: float
+                The timeout (seconds) of a request.
+            user_agent: str
+                The User-Agent header sent with every request.
+        """
+
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"User-Agent": user_agent})
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.active: Dict[str, int] = {}  # requests in flight per host
+        self.pending: Dict[str, deque] = {}  # requests waiting per host
+
+        print(f"[PageFetcher] Using {max_workers} workers, {max_per_host} requests per host.")
+
+    def get(self, link: str, **kwargs) -> requests.Response:
+        """
+        GET the link using the pooled session (blocking).
+        """
+
+        return self.session.get(link, timeout=kwargs.pop("timeout", self.timeout), **kwargs)
+
+    def _dispatch(self, host: str, task: tuple):
+        """
+        Run the task on the worker pool (the host's slot is already taken).
+        """
+
+        future = task[0]
+        try:
+            inner = self.executor.submit(self._run, host, *task)
+        except RuntimeError:  # the pool is shut down
+            future.cancel()
+            self._release(host)
+            return
+        inner.add_done_callback(lambda f: future.cancel() if f.cancelled() else None)
+
+    def _release(self, host: str):
+        """
+        Free the host's slot, handing it over to the next waiting request.
+        """
+
+        with self.lock:
+            queue = self.pending.get(host, None)
+            task = queue.popleft() if queue else None
+            if task is None:
+                self.active[host] -= 1
+                if self.active[host] == 0:
+                    del self.active[host]
+                    self.pending.pop(host, None)
+        if task is not None:
+            self._dispatch(host, task)
+
+    def _run(self, host: str, future: Future, fn: Callable, args: tuple, kwargs: dict):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            self._release(host)
+
+    def submit(self, link: str, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Schedule `fn(*args, **kwargs)`, which fetches the link, on the worker
+        pool as soon as the link's host has a free slot.
+
+        Returns:
+            Future: The future holding the result of the call.
+        """
+
+        host = get_host(link)
+        task = (Future(), fn, args, kwargs)
+        with self.lock:
+            if self.active.get(host, 0) >= self.max_per_host:
+                self.pending.setdefault(host, deque()).append(task)
+                return task[0]
+            self.active[host] = self.active.get(host, 0) + 1
+        self._dispatch(host, task)
+        return task[0]
+
+    def close(self):
+        """
+        Shut down the worker pool and close the session.
+        """
+
+        with self.lock:
+            tasks = [task for queue in self.pending.values() for task in queue]
+            self.pending = {}
+        for task in tasks:
+            task[0].cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
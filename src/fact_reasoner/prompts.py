@@ -333,6 +333,79 @@ Statement: {_UNIT_PLACEHOLDER}
 Standalone:{_PROMPT_END_PLACEHOLDER}        
 """
 
+# Batched version: several units are decontextualized with a single prompt
+ATOM_REVISER_BATCH_PROMPT_V1 = """{_PROMPT_BEGIN_PLACEHOLDER}
+Instructions:
+1. You are given a RESPONSE and a numbered list of UNITS extracted from the RESPONSE. Your task is to \
+decontextualize each UNIT so that it is standalone.
+2. Replace the vague references in each UNIT (pronouns such as "he", "she", "they", "it", demonstratives \
+such as "this", "that", unknown entities such as "the company" and incomplete names) with the specific \
+subjects they refer to in the RESPONSE.
+3. Minimally revise each UNIT by ONLY resolving vague references. No additional information must be added. \
+If a UNIT requires no changes, return it as-is.
+4. Return exactly one line per UNIT, in the same order, using the format: <unit id="N">revised unit</unit>, \
+where N is the number of the UNIT in the list.
+5. Do not include any explanation or any additional formatting including any lead-in or sign-off text.
+
+Example:
+RESPONSE:
+Lanny Flaherty is an American actor born on December 18, 1949, in Pensacola, Florida. He has appeared in \
+numerous films, television shows, and theater productions throughout his career, which began in the late 1970s.
+
+UNITS:
+1. He has appeared in numerous films.
+2. His career began in the late 1970s.
+3. Lanny Flaherty was born in Pensacola, Florida.
+
+REVISED UNITS:
+<unit id="1">Lanny Flaherty has appeared in numerous films.</unit>
+<unit id="2">Lanny Flaherty's career began in the late 1970s.</unit>
+<unit id="3">Lanny Flaherty was born in Pensacola, Florida.</unit>
+
+YOUR TASK:
+RESPONSE:
+{_RESPONSE_PLACEHOLDER}
+
+UNITS:
+{_UNITS_PLACEHOLDER}
+
+REVISED UNITS:{_PROMPT_END_PLACEHOLDER}
+"""
+
+ATOM_REVISER_BATCH_PROMPT_V2 = """{_PROMPT_BEGIN_PLACEHOLDER}\
+Instructions:
+1. You are given a context and a numbered list of statements that belong to the context. Your task is to modify \
+each statement so that any pronouns or anaphora (words like "it," "they," "this") are replaced with the noun \
+or proper noun that they refer to, such that the statement remains clear without referring to the \
+original context.
+2. Return only the revised, standalone version of each statement without adding any information that is not \
+already contained within the original statement.
+3. If a statement requires no changes, return the original statement as-is without any explanation.
+4. Return exactly one line per statement, in the same order, as follows: <unit id="N">statement</unit>, \
+where N is the number of the statement in the list.
+5. Do not include any explanation or any additional formatting including any lead-in or sign-off text.
+6. Learn from the provided example below and use that knowledge to amend the last example yourself.
+
+Example:
+Context: Maria Sanchez is a renowned marine biologist known for her groundbreaking research on coral reef ecosystems. \
+Her work has contributed to the preservation of many endangered coral species, and she is often invited to speak at \
+international conferences on environmental conservation.
+Statements:
+1. She presented her findings at the conference last year.
+2. Her work has contributed to the preservation of many endangered coral species.
+3. Maria Sanchez is a marine biologist.
+Standalone:
+<unit id="1">Maria Sanchez presented her findings at the conference last year.</unit>
+<unit id="2">Maria Sanchez's work has contributed to the preservation of many endangered coral species.</unit>
+<unit id="3">Maria Sanchez is a marine biologist.</unit>
+
+Now perform the task for the following example:
+Context: {_RESPONSE_PLACEHOLDER}
+Statements:
+{_UNITS_PLACEHOLDER}
+Standalone:{_PROMPT_END_PLACEHOLDER}
+"""
+
 # v1: Single turn version
 QUERY_BUILDER_PROMPT_V1 = """{_PROMPT_BEGIN_PLACEHOLDER}
 Instructions:
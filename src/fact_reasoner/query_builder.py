@@ -15,43 +15,139 @@
 
 # Query builder for atoms to retrieve results from Google and/or Wikipedia
 
+import re
+
 from tqdm import tqdm
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 # Local imports
 from src.fact_reasoner.utils import extract_last_square_brackets
 from src.fact_reasoner.llm_handler import LLMHandler
 from src.fact_reasoner.prompts import QUERY_BUILDER_PROMPT_V1, QUERY_BUILDER_PROMPT_V2
 
+# Query generators: `llm` (prompt v1/v2), `rules` (entities and noun phrases),
+# `auto` (rules, escalated to the LLM when the confidence is low)
+QUERY_GENERATORS = ["llm", "rules", "auto"]
+
+# Named entity types kept in the rule based queries
+ENTITY_TYPES = [
+    "PERSON", "NORP", "FAC", "ORG", "GPE", "LOC", "PRODUCT", "EVENT",
+    "WORK_OF_ART", "LAW", "LANGUAGE", "DATE",
+]
+
+# Named entity types that anchor a query (unlike dates and numbers, they
+# identify what the statement is about)
+ANCHOR_TYPES = [
+    "PERSON", "NORP", "FAC", "ORG", "GPE", "LOC", "PRODUCT", "EVENT",
+    "WORK_OF_ART", "LAW", "LANGUAGE",
+]
+
+# Determiners of a definite description (e.g., "The film ...") whose referent
+# the statement alone does not identify
+DEFINITE_DETERMINERS = set(["the", "this", "that", "these", "those"])
+
+# Auxiliary verbs ending the subject of a statement (without spaCy)
+AUXILIARY_WORDS = set([
+    "is", "are", "was", "were", "has", "have", "had", "will", "would", "can",
+    "could", "did", "does", "do", "may", "might", "should", "must",
+])
+
+MONTHS = set([
+    "january", "february", "march", "april", "may", "june", "july", "august",
+    "september", "october", "november", "december",
+])
+
+# Pronouns and demonstratives that a rule based query cannot resolve
+UNRESOLVED_PRONOUNS = set([
+    "he", "she", "it", "they", "him", "them", "his", "her", "hers", "its",
+    "their", "theirs", "this", "these", "those",
+])
+
+# Words that are capitalized only because they start the statement
+INITIAL_WORDS = set(["i", "i'm", "you", "you'd", "you're", "we", "some", "after", "before", "during", "when", "while"])
+
+STOPWORDS = set([
+    "a", "an", "the", "and", "or", "but", "of", "in", "on", "at", "to", "for",
+    "from", "by", "with", "as", "into", "about", "than", "that", "which", "who",
+    "whom", "whose", "is", "are", "was", "were", "be", "been", "being", "has",
+    "have", "had", "do", "does", "did", "also", "very", "many", "several", "some",
+    "other", "such", "not", "it", "its", "he", "she", "they", "his", "her",
+    "their", "this", "these", "those", "there", "can", "could", "may", "might",
+    "will", "would", "should", "one", "known", "well", "numerous", "various",
+])
+
+MAX_QUERY_WORDS = 12
+SUBJECT_WORDS = 3  # a pronoun among the first words of a statement is its subject
+
+_WORD_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9\-'.]*[A-Za-z0-9]|[A-Za-z0-9]")
+_QUOTED_RE = re.compile(r'"([^"]{2,80})"')
+_CAPITALIZED_RE = re.compile(r"\b[A-Z][\w\-']*(?:(?:\s+(?:of|the|de|van|von|and|&))*\s+(?:[A-Z][\w\-']*|\d+\b))*")
+_NUMBER_RE = re.compile(r"\b\d[\d,.]*\b")
+
 class QueryBuilder:
     """
-    The QueryBuilder uses an LLM to generate a query string. The query is then
-    used to retrieve results from Google Search, Wikipedia, ChromaDB.
+    The QueryBuilder generates a query string for an atom. The query is then
+    used to retrieve results from Google Search, Wikipedia, ChromaDB. The
+    query is either generated by an LLM, or by a rule based generator that
+    uses the named entities and noun phrases of the atom (and the topic). In
+    the `auto` mode the rule based query is escalated to the LLM when its
+    confidence is low.
     """
 
-    def __init__(self, model_id: str, prompt_version: str = "v1", backend: str = "rits"):
+    def __init__(
+            self,
+            model_id: str,
+            prompt_version: str = "v1",
+            backend: str = "rits",
+            generator: str = "llm",
+            min_confidence: float = 0.75,
+            spacy_model: Optional[str] = "en_core_web_sm"
+    ):
         """
         Initialize the QueryBuilder.
 
         Args:
             model_id: str
-                The name of the LLM used for query generation.
+                The name of the LLM used for query generation. If None, only the
+                rule based generator is available.
             prompt_version: str
                 The version of the prompt to use for query generation.
             backend: str
                 The model's backend.
+            generator: str
+                The default query generator: llm, rules or auto.
+            min_confidence: float
+                The minimum confidence of a rule based query (auto generator).
+            spacy_model: str
+                The spaCy model used by the rule based generator. If None, or if
+                the model cannot be loaded, simple patterns are used instead.
         """
 
         self.model_id = model_id
         self.prompt_version = prompt_version
         self.backend = backend
-        self.llm_handler = LLMHandler(model_id, backend)
+        self.generator = generator
+        self.min_confidence = min_confidence
+        self.llm_handler = None
+        self.spacy_model = spacy_model
+        self.nlp = None
+        self.nlp_loaded = False
+
+        if self.generator not in QUERY_GENERATORS:
+            raise ValueError(f"Unknown query generator: {self.generator}. "
+                             f"Supported generators are: {QUERY_GENERATORS}.")
 
-        self.prompt_begin = self.llm_handler.get_prompt_begin()
-        self.prompt_end = self.llm_handler.get_prompt_end()
+        if self.model_id is not None:
+            self.llm_handler = LLMHandler(model_id, backend)
+            self.prompt_begin = self.llm_handler.get_prompt_begin()
+            self.prompt_end = self.llm_handler.get_prompt_end()
+        else:
+            assert self.generator == "rules", \
+                f"The `{self.generator}` generator requires a `model_id`."
 
         print(f"[QueryBuilder] Using LLM on {self.backend}: {self.model_id}")
         print(f"[QueryBuilder] Using prompt version: {self.prompt_version}")
+        print(f"[QueryBuilder] Using query generator: {self.generator}")
     
     def make_prompt(self, statement: str, knowledge: str = "") -> str:
         """
@@ -86,7 +182,156 @@ class QueryBuilder:
 
         return prompt
 
-    def run(self, statement: str, knowledge: str = "") -> Dict[str, str]:
+    def load_nlp(self):
+        """
+        Load the spaCy model (once, on first use by the rule based generator).
+        """
+
+        if not self.nlp_loaded and self.spacy_model is not None:
+            try:
+                import spacy
+                self.nlp = spacy.load(self.spacy_model, disable=["lemmatizer"])
+            except (ImportError, OSError) as e:
+                print(f"[QueryBuilder] Cannot load spaCy model {self.spacy_model}: {e}")
+        self.nlp_loaded = True
+
+    def get_phrases(self, statement: str):
+        """
+        Return the named entities, the anchor entities (named entities that
+        are not dates or numbers), the noun phrases and the subject (the
+        words before the first verb) of the statement.
+        """
+
+        self.load_nlp()
+        if self.nlp is not None:
+            doc = self.nlp(statement)
+            entities = [ent.text for ent in doc.ents if ent.label_ in ENTITY_TYPES]
+            anchors = [ent.text for ent in doc.ents if ent.label_ in ANCHOR_TYPES]
+            phrases = [chunk.text for chunk in doc.noun_chunks]
+            verbs = [token.i for token in doc if token.pos_ in ["VERB", "AUX"]]
+            subject = doc[:verbs[0]].text if len(verbs) > 0 else ""
+            return entities, anchors, phrases, subject
+
+        # Patterns: quoted titles, capitalized word sequences and numbers
+        entities = _QUOTED_RE.findall(statement)
+        for match in _CAPITALIZED_RE.finditer(statement):
+            text = match.group(0)
+            if match.start() == 0:  # drop the sentence initial function word (if any)
+                first, _, rest = text.partition(" ")
+                if first.lower() in STOPWORDS | UNRESOLVED_PRONOUNS | INITIAL_WORDS:
+                    text = rest.strip()
+            if len(text) > 0 and not any(text in entity for entity in entities):
+                entities.append(text)
+        entities.extend([n for n in _NUMBER_RE.findall(statement) if not any(n in e for e in entities)])
+        anchors = [
+            e for e in entities
+            if any(w.isalpha() and w.lower() not in MONTHS for w in _WORD_RE.findall(e))
+        ]
+        words = _WORD_RE.findall(statement)
+        ends = [i for i, w in enumerate(words) if w.lower() in AUXILIARY_WORDS]
+        subject = " ".join(words[:ends[0]] if len(ends) > 0 else words[:SUBJECT_WORDS])
+        return entities, anchors, [], subject
+
+    def is_vague_subject(self, subject: str, anchors: List[str]) -> bool:
+        """
+        Return True if the subject is a bare definite description, e.g., "The
+        film" or "The company", that does not name what it refers to.
+        """
+
+        words = _WORD_RE.findall(subject)
+        if len(words) < 2 or words[0].lower() not in DEFINITE_DETERMINERS:
+            return False
+        if any(anchor in subject for anchor in anchors):
+            return False
+        return not any(w[0].isupper() or w[0].isdigit() for w in words[1:])
+
+    def make_rule_query(self, statement: str, topic: str = None) -> Dict[str, str]:
+        """
+        Generate a query without an LLM, from the named entities and noun
+        phrases of the statement (and the topic, if any). The confidence is
+        high when the statement has an anchor entity of its own (a named
+        entity, not a date or a number) and keeps the relation expressed by
+        the statement. It is lowered by the references the query cannot
+        resolve: any pronoun or demonstrative, except the subject's (e.g.,
+        "He ...", "Some of his ...") when a topic is given, as it refers to the
+        topic, and a subject that is a bare definite description (e.g., "The
+        film ..."), which may not be the topic.
+
+        Args:
+            statement: str
+                The input statement (e.g., an atomic unit).
+            topic: str
+                The topic of the statement (e.g., the entity of a biography).
+
+        Return:
+            A dict containg the `query`, the `response` and the `confidence`.
+        """
+
+        entities, anchors, phrases, subject = self.get_phrases(statement)
+        words = [w for w in _WORD_RE.findall(statement)]
+        lower_words = [w.lower() for w in words]
+        has_topic = topic is not None and len(topic) > 0
+        references = [i for i, w in enumerate(lower_words) if w in UNRESOLVED_PRONOUNS]
+        if has_topic and len(references) > 0 and references[0] < SUBJECT_WORDS:
+            references = references[1:]  # the subject, i.e., the topic
+        vague_subject = self.is_vague_subject(subject, anchors)
+
+        parts = []
+        if has_topic \
+                and not any(topic.lower() in e.lower() or e.lower() in topic.lower() for e in entities):
+            parts.append(topic)
+        parts.extend(entities)
+
+        # Keywords: the content words (from noun phrases and verbs) not covered yet
+        covered = set(w.lower() for part in parts for w in _WORD_RE.findall(part))
+        source = " ".join(phrases) + " " + statement if len(phrases) > 0 else statement
+        keywords = []
+        for w in _WORD_RE.findall(source):
+            lw = w.lower()
+            if lw in STOPWORDS or lw in covered or len(lw) < 3:
+                continue
+            covered.add(lw)
+            keywords.append(w)
+
+        query_words = " ".join(parts + keywords).split()[:MAX_QUERY_WORDS]
+        query = " ".join(query_words)
+
+        confidence = 0.0
+        if len(anchors) > 0:
+            confidence += 0.5
+        if len(keywords) > 0:
+            confidence += 0.25
+        if len(words) <= 2 * MAX_QUERY_WORDS:
+            confidence += 0.25
+        if len(references) > 0 or vague_subject:
+            confidence -= 0.5
+        confidence = max(0.0, min(1.0, confidence))
+
+        return dict(query=query, response=f"rules (confidence: {confidence:.2f})", confidence=confidence)
+
+    def needs_llm(self, statement: str, topic: str = None, generator: str = None) -> bool:
+        """
+        Return True if generating the query for the statement takes an LLM
+        call: always with the llm generator, never with the rules generator
+        (or without an LLM), and when the rule based query is not confident
+        enough with the auto generator.
+        """
+
+        generator = generator or self.generator
+        if generator == "rules" or self.llm_handler is None:
+            return False
+        if generator == "llm":
+            return True
+        result = self.make_rule_query(statement, topic)
+        return result["confidence"] < self.min_confidence or len(result["query"]) == 0
+
+    def run(
+            self,
+            statement: str,
+            knowledge: str = "",
+            topic: str = None,
+            generator: str = None
+    ) -> Dict[str, str]:
         """
         Generate the query for a given statement and knowledge (if any).
 
@@ -95,11 +340,26 @@ class QueryBuilder:
                 The input statement (e.g., an atomic unit).
             knowledge: str
                 The input knowledge, i.e., a list of previuos queries and results.
+            topic: str
+                The topic of the statement (used by the rule based generator).
+            generator: str
+                The query generator (llm, rules, auto). If None, the default one is used.
         
         Return:
             A dict containg the `query` and the verbose `response`.
         """
 
+        generator = generator or self.generator
+        if generator not in QUERY_GENERATORS:
+            raise ValueError(f"Unknown query generator: {generator}. "
+                             f"Supported generators are: {QUERY_GENERATORS}.")
+
+        if generator != "llm":
+            result = self.make_rule_query(statement, topic)
+            if generator == "rules" or self.llm_handler is None \
+                    or (result["confidence"] >= self.min_confidence and len(result["query"]) > 0):
+                return result
+
         prompt = self.make_prompt(statement, knowledge)
         response = self.llm_handler.completion(prompt)
         generated_text = response.choices[0].message.content
@@ -108,7 +368,13 @@ class QueryBuilder:
         assert query is not None and len(query) > 0, f"Could not generate the `query`."
         return dict(query=query, response=generated_text)
 
-    def runall(self, statements: List[str], knowledges: List[str]) -> List[Dict[str, str]]:
+    def runall(
+            self,
+            statements: List[str],
+            knowledges: List[str],
+            topics: List[str] = None,
+            generator: str = None
+    ) -> List[Dict[str, str]]:
         """
         Generate the queries for a list of statements and knowledges (if any).
 
@@ -117,6 +383,10 @@ class QueryBuilder:
                 The list of input statements (e.g., atomic units).
             knowledges: List[str]
                 The list of input knowledges (previuos queries and results).
+            topics: List[str]
+                The list of topics (used by the rule based generator).
+            generator: str
+                The query generator (llm, rules, auto). If None, the default one is used.
         
         Return:
             A list of dicts containg the `query` and the verbose `response`.
@@ -125,8 +395,28 @@ class QueryBuilder:
         # Safety checks
         assert len(statements) == len(knowledges), \
             f"Length of `statements` must be equal to the length of `knowledges`."
-        
-        prompts = [self.make_prompt(statements[i], knowledges[i]) for i in range(len(statements))]
+
+        generator = generator or self.generator
+        if generator not in QUERY_GENERATORS:
+            raise ValueError(f"Unknown query generator: {generator}. "
+                             f"Supported generators are: {QUERY_GENERATORS}.")
+
+        topics = topics if topics is not None else [None] * len(statements)
+        results = [None] * len(statements)
+        if generator != "llm":
+            for i in range(len(statements)):
+                result = self.make_rule_query(statements[i], topics[i])
+                if generator == "rules" or self.llm_handler is None \
+                        or (result["confidence"] >= self.min_confidence and len(result["query"]) > 0):
+                    results[i] = result
+
+        # Escalate the remaining statements to the LLM (in batch)
+        indices = [i for i in range(len(statements)) if results[i] is None]
+        print(f"[QueryBuilder] Rule based queries: {len(statements) - len(indices)}, LLM queries: {len(indices)}")
+        if len(indices) == 0:
+            return results
+
+        prompts = [self.make_prompt(statements[i], knowledges[i]) for i in indices]
         generated_texts = []
         for _, response in tqdm(
             enumerate(
@@ -138,13 +428,12 @@ class QueryBuilder:
             ):
                 generated_texts.append(response.choices[0].message.content)
 
-        result = []
-        for generated_text in generated_texts:
+        for i, generated_text in zip(indices, generated_texts):
             query = extract_last_square_brackets(generated_text)
             assert query is not None and len(query) > 0, f"Could not generate the `query`."
-            result.append(dict(query=query, response=generated_text))
+            results[i] = dict(query=query, response=generated_text)
 
-        return result
+        return results
 
 if __name__ == "__main__":
 
@@ -191,5 +480,12 @@ if __name__ == "__main__":
     #     print(f"Query: {query}")
     #     print("-------"*10)
 
+    # Rule based queries: an under-specified atom must be escalated to the LLM
+    rules = QueryBuilder(None, generator="rules")
+    for atom in ["The film was released in 1994.", "The company was founded in March 1998."]:
+        result = rules.run(atom)
+        print(f"Atom: {atom}")
+        print(f"Query: {result['query']} ({result['response']})")
+        assert result["confidence"] < qb.min_confidence, f"Under-specified atom not escalated: {atom}"
 
     print("Done.")
@@ -0,0 +1,189 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sampling based estimation of the factuality score (with confidence intervals)
+
+import math
+import random
+
+from statistics import NormalDist
+from typing import Dict, List, Tuple
+
+
+def get_z_value(confidence: float) -> float:
+    """
+    Return the two-sided standard normal critical value for the confidence level.
+    """
+
+    assert 0.0 < confidence < 1.0, f"The confidence level must be in (0, 1)."
+    return NormalDist().inv_cdf(0.5 + confidence / 2.0)
+
+
+def wilson_interval(
+        num_true: int,
+        num_sampled: int,
+        confidence: float = 0.95,
+        population: int = None
+) -> Tuple[float, float]:
+    """
+    Wilson score interval for a proportion estimated from a simple random
+    sample (without replacement). If the population size is given, the finite
+    population correction is applied, so the interval collapses to the exact
+    proportion once the whole population has been sampled.
+
+    Args:
+        num_true: int
+            The number of true atoms in the sample.
+        num_sampled: int
+            The sample size.
+        confidence: float
+            The confidence level (e.g., 0.95).
+        population: int
+            The population size, i.e., the total number of atoms.
+
+    Returns:
+        A tuple (lower, upper) with the interval bounds.
+    """
+
+    if num_sampled == 0:
+        return 0.0, 1.0
+
+    p = num_true / num_sampled
+    if population is not None:
+        if num_sampled >= population:
+            return p, p
+        # Effective sample size under the finite population correction
+        n = num_sampled * (population - 1) / (population - num_sampled)
+    else:
+        n = num_sampled
+
+    z = get_z_value(confidence)
+    denominator = 1.0 + z * z / n
+    center = (p + z * z / (2.0 * n)) / denominator
+    margin = z * math.sqrt(p * (1.0 - p) / n + z * z / (4.0 * n * n)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def stratified_interval(
+        strata: List[Dict[str, int]],
+        confidence: float = 0.95
+) -> Tuple[float, float, float]:
+    """
+    Estimate of a proportion (and its normal interval) from a stratified sample.
+    Each stratum is a dict with the keys `size` (number of atoms in the
+    stratum), `num_sampled` and `num_true`. The per-stratum variances use
+    add-one smoothing so that strata whose sampled atoms all agree still
+    contribute some uncertainty.
+
+    Args:
+        strata: List[dict]
+            The strata statistics.
+        confidence: float
+            The confidence level (e.g., 0.95).
+
+    Returns:
+        A tuple (estimate, lower, upper).
+    """
+
+    population = sum(s["size"] for s in strata)
+    assert population > 0, f"The strata cannot be empty."
+
+    estimate = 0.0
+    variance = 0.0
+    for s in strata:
+        if s["size"] == 0:
+            continue
+        if s["num_sampled"] == 0:
+            return 0.0, 0.0, 1.0  # no information about this stratum yet
+        weight = s["size"] / population
+        estimate += weight * s["num_true"] / s["num_sampled"]
+        if s["num_sampled"] < s["size"]:
+            fpc = 1.0 - s["num_sampled"] / s["size"]
+            p = (s["num_true"] + 1.0) / (s["num_sampled"] + 2.0)
+            variance += weight * weight * fpc * p * (1.0 - p) / s["num_sampled"]
+
+    margin = get_z_value(confidence) * math.sqrt(variance)
+    return estimate, max(0.0, estimate - margin), min(1.0, estimate + margin)
+
+
+def make_strata(atom_ids: List[str], num_strata: int) -> List[List[str]]:
+    """
+    Split the atoms into contiguous strata. The atoms are given in the order
+    in which they appear in the response, so each stratum corresponds to a
+    different part of the response.
+
+    Args:
+        atom_ids: List[str]
+            The atom ids (in response order).
+        num_strata: int
+            The number of strata.
+    """
+
+    num_strata = max(1, min(num_strata, len(atom_ids)))
+    strata = []
+    for i in range(num_strata):
+        start = (i * len(atom_ids)) // num_strata
+        end = ((i + 1) * len(atom_ids)) // num_strata
+        strata.append(atom_ids[start:end])
+    return strata
+
+
+def sample_order(
+        atom_ids: List[str],
+        strategy: str = "random",
+        num_strata: int = 4,
+        seed: int = 42
+) -> List[str]:
+    """
+    Return the order in which the atoms are verified. For the `random`
+    strategy this is a random permutation. For the `stratified` strategy,
+    the atoms are shuffled within each stratum and the strata are visited
+    proportionally to their sizes, so that every prefix of the order is
+    (approximately) a proportional stratified sample.
+
+    Args:
+        atom_ids: List[str]
+            The atom ids (in response order).
+        strategy: str
+            The sampling strategy (random, stratified).
+        num_strata: int
+            The number of strata (stratified sampling only).
+        seed: int
+            The random seed.
+    """
+
+    rng = random.Random(seed)
+    if strategy == "random":
+        order = list(atom_ids)
+        rng.shuffle(order)
+        return order
+    elif strategy == "stratified":
+        strata = make_strata(atom_ids, num_strata)
+        for stratum in strata:
+            rng.shuffle(stratum)
+        order = []
+        taken = [0] * len(strata)
+        while len(order) < len(atom_ids):
+            # pick the stratum that is most under-represented so far
+            i = min(
+                [j for j in range(len(strata)) if taken[j] < len(strata[j])],
+                key=lambda j: (taken[j] / len(strata[j]), j)
+            )
+            order.append(strata[i][taken[i]])
+            taken[i] += 1
+        return order
+    else:
+        raise ValueError(f"Unknown sampling strategy: {strategy}. "
+                         f"Supported strategies are: 'random', 'stratified'.")
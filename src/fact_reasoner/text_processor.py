@@ -0,0 +1,345 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# CPU-bound text processing (HTML/PDF extraction, cleaning, chunking) in a
+# pool of worker processes
+
+import multiprocessing
+import re
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable, List, Tuple
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from lxml import etree
+
+MAX_PDF_PAGES = 50  # pages extracted at most from a PDF
+PROCESS_TIMEOUT = 30  # seconds
+HTML_CHUNK_SIZE = 1 << 14  # 16 KB
+
+CHARACTER_SPLITTER = RecursiveCharacterTextSplitter(
+    separators=["\n\n", "\n", ". ", " ", ""],
+    #keep_separator=False,
+    chunk_size=1000,
+    chunk_overlap=0
+)
+
+
+def remove_citation(paragraph: str) -> str:
+    """Remove all citations (numbers in side square brackets) in paragraph"""
+    return re.sub(r'\[\d+\]', '', paragraph)
+
+
+def remove_new_line(paragraph: str) -> str:
+    return paragraph.replace("\n", "")
+
+
+def compose_fns(functions: List[Callable]) -> Callable:
+    def ret(input):
+        for fn in functions:
+            input = fn(input)
+
+        return input
+
+    return ret
+
+
+def stream_html_to_text(
+        chunks: Iterable[bytes],
+        max_size: int = None,
+        encoding: str = None
+) -> Tuple[str, bool]:
+    """
+    Extract the (cleaned) text of the <p> elements of an HTML document given
+    as a stream of byte chunks. The chunks are parsed incrementally (lxml) and
+    the extraction stops as soon as `max_size` characters are available, so
+    the rest of the document is neither parsed nor consumed.
+
+    Args:
+        chunks: Iterable[bytes]
+            The chunks of the HTML document (e.g., `response.iter_content()`).
+        max_size: int
+            The maximum size (characters) of the text (optional).
+        encoding: str
+            The encoding of the document. If None, it is detected by lxml.
+
+    Returns:
+        A tuple (text, truncated), where truncated is True if the extraction
+        stopped early because of `max_size`.
+    """
+
+    preprocess_fn = compose_fns([remove_citation, remove_new_line])
+    parser = etree.HTMLPullParser(events=("end",), tag="p", encoding=encoding)
+    paragraphs = []
+    size = -1  # no separator before the first paragraph
+
+    def collect() -> bool:
+        nonlocal size
+        for _, elem in parser.read_events():
+            paragraph = preprocess_fn("".join(elem.itertext()))
+            elem.clear(keep_tail=True)
+            paragraphs.append(paragraph)
+            size += len(paragraph) + 1
+            if max_size is not None and size >= max_size:
+                return True
+        return False
+
+    truncated = False
+    for chunk in chunks:
+        parser.feed(chunk)
+        if collect():
+            truncated = True
+            break
+
+    if not truncated:
+        try:
+            parser.close()
+        except etree.LxmlError:
+            pass  # empty or broken document
+        truncated = collect()
+
+    contents = "\n".join(paragraphs)
+    if max_size is not None and len(contents) > max_size:
+        contents = contents[:max_size]
+    return contents, truncated
+
+
+def html_to_text(html_text: str) -> str:
+    contents, _ = stream_html_to_text([html_text.encode("utf-8")], encoding="utf-8")
+    return contents
+
+
+def make_uniform(text: str) -> str:
+    """
+    Return a uniform representation of the text using the langchain textsplitter
+    and tokensplitter tools.
+    """
+
+    character_split_texts = CHARACTER_SPLITTER.split_text(text)
+    # torch.cuda.empty_cache()
+    return " ".join(character_split_texts)
+
+    # token_split_texts = []
+    # for text in character_split_texts:
+    #     token_split_texts += TOKEN_SPLITTER.split_text(text)
+    # torch.cuda.empty_cache()
+
+    # return " ".join(token_split_texts)
+
+
+def html_bytes_to_text(data: bytes, max_size: int = None, encoding: str = None) -> Tuple[str, bool]:
+    """
+    Extract the text of an HTML document given as raw bytes (see `stream_html_to_text`).
+    """
+
+    chunks = (data[i:i + HTML_CHUNK_SIZE] for i in range(0, len(data), HTML_CHUNK_SIZE))
+    return stream_html_to_text(chunks, max_size=max_size, encoding=encoding)
+
+
+def process_text(text: str, split: bool = False) -> Tuple[str, List[str]]:
+    """
+    Return the uniform representation of the text (see `make_uniform`) and,
+    if `split` is True, its chunks (CHARACTER_SPLITTER).
+    """
+
+    if len(text) == 0:
+        return "", []
+    uniform = make_uniform(text)
+    chunks = CHARACTER_SPLITTER.split_text(uniform) if split else []
+    return uniform, chunks
+
+
+def pdf_to_text(path: str, max_size: int = None, max_pages: int = MAX_PDF_PAGES) -> Tuple[str, bool]:
+    """
+    Extract the text of a PDF file page by page, stopping as soon as
+    `max_size` characters are available or after `max_pages` pages.
+
+    Args:
+        path: str
+            The path to the PDF file.
+        max_size: int
+            The maximum size (characters) of the text (optional).
+        max_pages: int
+            The maximum number of pages extracted.
+
+    Returns:
+        A tuple (text, truncated), where truncated is True if the extraction
+        stopped before the last page.
+    """
+
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    num_pages = len(reader.pages)
+    pdf_texts = []
+    size = -1  # no separator before the first page
+    truncated = False
+    for i in range(num_pages):
+        if i >= max_pages or (max_size is not None and size >= max_size):
+            truncated = True
+            break
+        text = reader.pages[i].extract_text().strip()
+        if text:  # filter the empty strings
+            pdf_texts.append(text)
+            size += len(text) + 1
+
+    contents = "\n".join(pdf_texts)
+    if max_size is not None and len(contents) > max_size:
+        contents = contents[:max_size]
+    return contents, truncated
+
+
+def process_page(
+        kind: str,
+        payload,
+        max_size: int = None,
+        encoding: str = None,
+        split: bool = False
+) -> Tuple[str, bool, str, List[str]]:
+    """
+    Extract the text of a page and post-process it (see `process_text`).
+
+    Args:
+        kind: str
+            The kind of payload: html (raw bytes), pdf (path to the file) or
+            text (already extracted, e.g., cached).
+        payload: [bytes|str]
+            The raw page, the path to the PDF file or the text.
+        max_size: int
+            The maximum size (characters) of the text (optional).
+        encoding: str
+            The encoding of an HTML page. If None, it is detected by lxml.
+        split: bool
+            Flag indicating that the text is also split into chunks.
+
+    Returns:
+        A tuple (text, truncated, uniform text, chunks), where text is the
+        extracted text and truncated is True if the extraction stopped early
+        because of `max_size`.
+    """
+
+    if kind == "html":
+        contents, truncated = html_bytes_to_text(payload, max_size, encoding)
+    elif kind == "pdf":
+        contents, truncated = pdf_to_text(payload, max_size, MAX_PDF_PAGES)
+    else:
+        contents, truncated = payload, False
+        if max_size is not None and len(contents) > max_size:
+            contents = contents[:max_size]
+    uniform, chunks = process_text(contents, split)
+    return contents, truncated, uniform, chunks
+
+
+class TextProcessor:
+    """
+    Run the CPU-bound post-processing of the retrieved pages (HTML and PDF
+    extraction, cleaning and chunking) in a pool of worker processes, so that
+    parsing scales across cores and does not hold the GIL of the threads
+    fetching pages. The workers are started (spawn, which is safe with
+    threads) with the processor and only import the text processing libraries.
+    A document is submitted only when a worker is free, so the timeout
+    covers the processing time and not the time spent waiting for a worker.
+    When a document times out (or a worker dies), the pool is restarted, as
+    a timed out task would otherwise keep its worker busy.
+    """
+
+    def __init__(self, num_workers: int = 2, timeout: float = PROCESS_TIMEOUT):
+        """
+        Initialize the processor.
+
+        Args:
+            num_workers: int
+                The number of worker processes. If 0, the text is extracted in
+                the calling thread.
+            timeout: float
+                The maximum time (seconds) to process a document.
+        """
+
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.executor = None
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(max(num_workers, 1))
+        if self.num_workers > 0:
+            self.executor = self._make_executor()
+
+        print(f"[TextProcessor] Using {num_workers} worker processes.")
+
+    def _make_executor(self) -> ProcessPoolExecutor:
+        """
+        Create a pool and wait for its workers to start, so that their start
+        up time is not counted in the timeout of the first documents.
+        """
+
+        executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        for future in [executor.submit(len, "") for _ in range(self.num_workers)]:
+            future.result()
+        return executor
+
+    def _restart(self, executor: ProcessPoolExecutor):
+        """
+        Replace the given pool by a new one (unless another thread did it
+        already), terminating its workers.
+        """
+
+        with self.lock:
+            if self.executor is not executor:
+                return
+            print(f"[TextProcessor] Restarting the worker processes.")
+            for process in list((getattr(executor, "_processes", None) or {}).values()):
+                process.terminate()
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._make_executor()
+
+    def _run(self, fn: Callable, *args):
+        if self.executor is None:
+            return fn(*args)
+        with self.slots:  # wait for a free worker
+            with self.lock:  # wait for a restart in progress
+                executor = self.executor
+            try:
+                return executor.submit(fn, *args).result(timeout=self.timeout)
+            except (FutureTimeoutError, BrokenProcessPool):
+                self._restart(executor)
+                raise
+
+    def process_page(
+            self,
+            kind: str,
+            payload,
+            max_size: int = None,
+            encoding: str = None,
+            split: bool = False
+    ) -> Tuple[str, bool, str, List[str]]:
+        """
+        Extract and post-process a page in a worker (see `process_page`).
+        Raises a TimeoutError if it takes more than the timeout.
+        """
+
+        return self._run(process_page, kind, payload, max_size, encoding, split)
+
+    def close(self):
+        """
+        Shut down the worker processes.
+        """
+
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
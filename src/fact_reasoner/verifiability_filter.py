@@ -0,0 +1,197 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Filter out subjective or unverifiable atoms before retrieval and NLI
+
+import re
+
+from typing import Dict, List, Optional, Tuple
+
+# The unit types (from the atom extractor) that are verified by default
+VERIFIABLE_UNIT_TYPES = ["fact", "claim", "data format"]
+
+# Strong cues: a single match marks the unit as subjective
+SUBJECTIVE_PATTERNS = [
+    r"\b(i|we)\s+(think|believe|feel|guess|suppose|hope|recommend|suggest)\b",
+    r"\bin my (opinion|view|experience)\b",
+    r"\b(it is|it's) (important|worth|crucial|essential|advisable|recommended) to\b",
+    r"\b(you|one) (should|must|ought to|might want to)\b",
+    r"\b(i'm|i am) (here|happy|glad) to\b",
+    r"\b(arguably|hopefully|personally|undoubtedly|unfortunately|fortunately)\b",
+]
+
+# Weak cues: evaluative words, the unit is subjective if several of them occur
+# and the unit contains no checkable details (numbers, dates, names).
+EVALUATIVE_WORDS = set([
+    "amazing", "awesome", "beautiful", "best", "brilliant", "excellent",
+    "fantastic", "great", "greatest", "good", "bad", "worst", "terrible",
+    "remarkable", "impressive", "memorable", "distinctive", "iconic",
+    "legendary", "renowned", "reputable", "prestigious", "leading",
+    "innovative", "invaluable", "significant", "important", "influential",
+    "talented", "gifted", "skilled", "successful", "popular", "beloved",
+    "interesting", "fascinating", "powerful", "high-quality", "unique",
+    "committed", "dedicated", "passionate", "inspiring", "outstanding",
+])
+
+_WORD_RE = re.compile(r"[A-Za-z][A-Za-z\-']*")
+_DIGIT_RE = re.compile(r"\d")
+
+
+class VerifiabilityFilter:
+    """
+    Decide which atoms are worth verifying. An atom is dropped if its unit
+    type (as labeled by the AtomExtractor) is not one of the verifiable types,
+    or if a cheap local classifier flags it as subjective. The classifier is
+    either rule based (`lexicon`) or a HuggingFace text classification model.
+    """
+
+    def __init__(
+            self,
+            unit_types: List[str] = VERIFIABLE_UNIT_TYPES,
+            classifier: Optional[str] = None,
+            classifier_model_id: str = None,
+            subjective_labels: List[str] = ["subjective", "opinion"],
+            threshold: float = 0.5,
+            min_evaluative_words: int = 2,
+    ):
+        """
+        Initialize the filter.
+
+        Args:
+            unit_types: List[str]
+                The unit types considered verifiable (case insensitive). Atoms
+                without a unit type (e.g., loaded from a file) are kept.
+            classifier: str
+                The subjectivity classifier: None (disabled), `lexicon` (rule
+                based) or `hf` (HuggingFace text classification model).
+            classifier_model_id: str
+                The HuggingFace model id (if the classifier is `hf`).
+            subjective_labels: List[str]
+                The model labels denoting subjective text (if the classifier is `hf`).
+            threshold: float
+                The minimum model score for a subjective label (if the classifier is `hf`).
+            min_evaluative_words: int
+                The minimum number of evaluative words (if the classifier is `lexicon`).
+        """
+
+        self.unit_types = [t.lower() for t in unit_types]
+        self.classifier = classifier
+        self.classifier_model_id = classifier_model_id
+        self.subjective_labels = [l.lower() for l in subjective_labels]
+        self.threshold = threshold
+        self.min_evaluative_words = min_evaluative_words
+        self.patterns = [re.compile(p, re.IGNORECASE) for p in SUBJECTIVE_PATTERNS]
+        self.pipeline = None
+
+        if self.classifier not in [None, "lexicon", "hf"]:
+            raise ValueError(f"Unknown classifier: {self.classifier}. "
+                             f"Supported classifiers are: None, 'lexicon', 'hf'.")
+
+        if self.classifier == "hf":
+            assert self.classifier_model_id is not None, \
+                f"The `hf` classifier requires a `classifier_model_id`."
+            from transformers import pipeline
+            self.pipeline = pipeline("text-classification", model=self.classifier_model_id)
+
+        print(f"[VerifiabilityFilter] Verifiable unit types: {self.unit_types}")
+        print(f"[VerifiabilityFilter] Using subjectivity classifier: {self.classifier}")
+
+    def is_subjective_lexicon(self, text: str) -> bool:
+        """
+        Rule based subjectivity detection.
+        """
+
+        if any(p.search(text) for p in self.patterns):
+            return True
+
+        words = [w.lower() for w in _WORD_RE.findall(text)]
+        num_evaluative = len([w for w in words if w in EVALUATIVE_WORDS])
+        if num_evaluative < self.min_evaluative_words:
+            return False
+
+        # Checkable details (numbers, dates, names other than the first word)
+        has_details = _DIGIT_RE.search(text) is not None \
+            or any(w[0].isupper() for w in _WORD_RE.findall(text)[1:])
+        return not has_details
+
+    def is_subjective_hf(self, texts: List[str]) -> List[bool]:
+        """
+        Model based subjectivity detection.
+        """
+
+        outputs = self.pipeline(texts, truncation=True)
+        return [
+            output["label"].lower() in self.subjective_labels and output["score"] >= self.threshold
+            for output in outputs
+        ]
+
+    def reasons(self, atoms: List) -> List[Optional[str]]:
+        """
+        Return the reason why each atom is unverifiable (None if verifiable).
+
+        Args:
+            atoms: List[Atom]
+                The list of atoms.
+        """
+
+        reasons = [None] * len(atoms)
+        for i, atom in enumerate(atoms):
+            unit_type = atom.get_unit_type()
+            if unit_type is not None and unit_type.lower() not in self.unit_types:
+                reasons[i] = f"unit type: {unit_type}"
+
+        candidates = [i for i in range(len(atoms)) if reasons[i] is None]
+        if self.classifier == "lexicon":
+            for i in candidates:
+                if self.is_subjective_lexicon(atoms[i].get_text()):
+                    reasons[i] = "subjective"
+        elif self.classifier == "hf" and len(candidates) > 0:
+            flags = self.is_subjective_hf([atoms[i].get_text() for i in candidates])
+            for i, flag in zip(candidates, flags):
+                if flag:
+                    reasons[i] = "subjective"
+
+        return reasons
+
+    def split(self, atoms: Dict[str, object]) -> Tuple[Dict[str, object], Dict[str, dict]]:
+        """
+        Split the atoms into verifiable and unverifiable ones.
+
+        Args:
+            atoms: dict
+                A dict containing the atoms of the response (indexed by id).
+
+        Returns:
+            A tuple containing the dict of verifiable atoms and a dict with the
+            unverifiable ones, i.e., {id: {"text", "unit_type", "reason"}}.
+        """
+
+        atom_ids = list(atoms.keys())
+        reasons = self.reasons([atoms[aid] for aid in atom_ids])
+
+        verifiable = {}
+        unverifiable = {}
+        for aid, reason in zip(atom_ids, reasons):
+            if reason is None:
+                verifiable[aid] = atoms[aid]
+            else:
+                unverifiable[aid] = dict(
+                    text=atoms[aid].get_text(),
+                    unit_type=atoms[aid].get_unit_type(),
+                    reason=reason
+                )
+
+        print(f"[VerifiabilityFilter] Verifiable atoms: {len(verifiable)}, unverifiable atoms: {len(unverifiable)}")
+        return verifiable, unverifiable
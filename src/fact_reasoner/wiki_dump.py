@@ -0,0 +1,442 @@
+# coding=utf-8
+# Copyright 2023-present the International Business Machines.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline Wikipedia: dump ingestion into a memory-mapped article store with a
+# title/redirect index, and passage retrieval
+
+import argparse
+import bz2
+import json
+import mmap
+import os
+import re
+import time
+import numpy as np
+
+from array import array
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from src.fact_reasoner.bm25_index import STOPWORDS, tokenize
+
+WIKIPEDIA_URL = "https://en.wikipedia.org/wiki/"
+MAX_TITLE_WORDS = 6  # longest word n-gram looked up in the title index
+MIN_PARAGRAPH_CHARS = 40
+
+# Single words never looked up as titles (e.g., "He", "The", "In" are
+# disambiguation pages)
+UNIGRAM_STOPWORDS = STOPWORDS | set([
+    "i", "you", "he", "she", "we", "they", "me", "him", "us", "them", "my",
+    "your", "his", "her", "our", "their", "also", "after", "before", "during",
+    "when", "while", "some", "many", "one", "not", "no", "if", "then", "so",
+])
+
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+_REF_RE = re.compile(r"<ref[^>/]*/>|<ref[^>]*>.*?</ref>", re.DOTALL | re.IGNORECASE)
+_TEMPLATE_RE = re.compile(r"\{\{[^{}]*\}\}")
+_TABLE_RE = re.compile(r"\{\|.*?\|\}", re.DOTALL)
+_LINK_RE = re.compile(r"\[\[([^\[\]|]*)(?:\|([^\[\]]*))?\]\]")
+_EXTERNAL_LINK_RE = re.compile(r"\[(?:https?:)?//[^\s\]]+\s?([^\]]*)\]")
+_HEADING_RE = re.compile(r"^=+.*?=+\s*$", re.MULTILINE)
+_TAG_RE = re.compile(r"<[^>]+>")
+_QUOTES_RE = re.compile(r"'{2,}")
+_LIST_RE = re.compile(r"^[*#:;]+\s*", re.MULTILINE)
+_SKIPPED_LINK_PREFIXES = ("file:", "image:", "category:", "media:")
+
+
+def normalize_title(title: str) -> str:
+    """
+    The lookup key of a title: lowercase, without commas, with single spaces
+    (e.g., `Pensacola,_Florida` -> `pensacola florida`).
+    """
+
+    return " ".join(title.replace("_", " ").replace(",", " ").split()).lower()
+
+
+def clean_wikitext(text: str) -> str:
+    """
+    Convert wikitext into plain text paragraphs (separated by blank lines).
+    This is a light-weight cleanup: templates, tables, references, files and
+    categories are removed and links are replaced by their label.
+    """
+
+    text = _COMMENT_RE.sub("", text)
+    text = _REF_RE.sub("", text)
+    prev = None
+    while prev != text:  # nested templates, innermost first
+        prev = text
+        text = _TEMPLATE_RE.sub("", text)
+    text = _TABLE_RE.sub("", text)
+
+    def replace_link(m: re.Match) -> str:
+        target, label = m.group(1), m.group(2)
+        if target.strip().lower().startswith(_SKIPPED_LINK_PREFIXES):
+            return ""
+        return label if label is not None else target
+
+    prev = None
+    while prev != text:  # nested links (e.g., in file captions)
+        prev = text
+        text = _LINK_RE.sub(replace_link, text)
+
+    text = _EXTERNAL_LINK_RE.sub(r"\1", text)
+    text = _HEADING_RE.sub("\n", text)
+    text = _TAG_RE.sub("", text)
+    text = _QUOTES_RE.sub("", text)
+    text = _LIST_RE.sub("", text)
+
+    paragraphs = [" ".join(p.split()) for p in re.split(r"\n\s*\n", text)]
+    return "\n\n".join(p for p in paragraphs if len(p) >= MIN_PARAGRAPH_CHARS)
+
+
+def read_xml_dump(dump_file: str) -> Iterator[Tuple[str, Optional[str], str]]:
+    """
+    Iterate over the main namespace pages of a MediaWiki XML dump (optionally
+    bz2 compressed), yielding (title, redirect target or None, wikitext).
+    """
+
+    from lxml import etree
+
+    opener = bz2.open if dump_file.endswith(".bz2") else open
+    with opener(dump_file, "rb") as f:
+        for _, elem in etree.iterparse(f, events=("end",)):
+            if etree.QName(elem).localname != "page":
+                continue
+            fields = {etree.QName(child).localname: child for child in elem}
+            ns = fields["ns"].text if "ns" in fields else "0"
+            if ns == "0":
+                title = fields["title"].text or ""
+                redirect = fields["redirect"].get("title") if "redirect" in fields else None
+                text = ""
+                if "revision" in fields:
+                    for child in fields["revision"]:
+                        if etree.QName(child).localname == "text":
+                            text = child.text or ""
+                yield title, redirect, text
+
+            # free the memory of the processed pages
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def read_jsonl_dump(dump_file: str) -> Iterator[Tuple[str, Optional[str], str]]:
+    """
+    Iterate over the articles of a JSONL dump (e.g., WikiExtractor output or
+    the `wikipedia` HF dataset), with a `title`, a plain `text` and,
+    optionally, a `redirect` target.
+    """
+
+    with open(dump_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                doc = json.loads(line)
+                yield doc["title"], doc.get("redirect", None), doc.get("text", "")
+
+
+def write_strings(strings: List[str], store_dir: str, data_file: str, offsets_file: str):
+    """
+    Write the strings (UTF-8) to `data_file` and their byte offsets to `offsets_file`.
+    """
+
+    offsets = array("Q", [0])
+    with open(os.path.join(store_dir, data_file), "wb") as f:
+        for string in strings:
+            data = string.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(store_dir, offsets_file), np.frombuffer(offsets, dtype=np.uint64))
+
+
+def ingest_wiki_dump(dump_file: str, store_dir: str, log_every: int = 100000):
+    """
+    Ingest a Wikipedia dump into an article store. The store directory contains:
+        - articles.bin, article_offsets.npy: the plain text of the articles,
+        - paragraph_offsets.npy, article_paragraphs.npy: the byte offsets of
+          the paragraphs and the range of paragraphs of each article,
+        - titles.bin, title_offsets.npy: the title of each article,
+        - title_keys.bin, title_key_offsets.npy, title_key_articles.npy: the
+          sorted normalized titles and redirects and their article ids.
+
+    Args:
+        dump_file: str
+            The MediaWiki XML dump (.xml or .xml.bz2) or a JSONL dump (.jsonl).
+        store_dir: str
+            The directory where the store is written.
+        log_every: int
+            Report progress every `log_every` articles.
+    """
+
+    os.makedirs(store_dir, exist_ok=True)
+    start = time.time()
+    is_jsonl = dump_file.endswith(".jsonl")
+    pages = read_jsonl_dump(dump_file) if is_jsonl else read_xml_dump(dump_file)
+
+    titles = []
+    title_index = {}
+    redirects = {}
+    article_offsets = array("Q", [0])
+    paragraph_offsets = array("Q", [0])
+    article_paragraphs = array("Q", [0])
+
+    with open(os.path.join(store_dir, "articles.bin"), "wb") as f:
+        for title, redirect, text in pages:
+            if redirect is not None:
+                redirects[normalize_title(title)] = normalize_title(redirect)
+                continue
+            text = text if is_jsonl else clean_wikitext(text)
+            paragraphs = [p for p in text.split("\n\n") if p.strip()]
+            if len(paragraphs) == 0:
+                continue
+
+            for paragraph in paragraphs:
+                data = (paragraph + "\n\n").encode("utf-8")
+                f.write(data)
+                paragraph_offsets.append(paragraph_offsets[-1] + len(data))
+            article_offsets.append(paragraph_offsets[-1])
+            article_paragraphs.append(len(paragraph_offsets) - 1)
+
+            title_index.setdefault(normalize_title(title), len(titles))
+            titles.append(title)
+            if len(titles) % log_every == 0:
+                print(f"[WikiDump] Ingested {len(titles)} articles ({time.time() - start:.1f}s)")
+
+    num_redirects = 0
+    for source, target in redirects.items():
+        for _ in range(3):  # follow (short) redirect chains
+            if target in title_index or target not in redirects:
+                break
+            target = redirects[target]
+        if target in title_index and source not in title_index:
+            title_index[source] = title_index[target]
+            num_redirects += 1
+
+    np.save(os.path.join(store_dir, "article_offsets.npy"), np.frombuffer(article_offsets, dtype=np.uint64))
+    np.save(os.path.join(store_dir, "paragraph_offsets.npy"), np.frombuffer(paragraph_offsets, dtype=np.uint64))
+    np.save(os.path.join(store_dir, "article_paragraphs.npy"), np.frombuffer(article_paragraphs, dtype=np.uint64))
+    write_strings(titles, store_dir, "titles.bin", "title_offsets.npy")
+
+    # The keys are sorted by code point, i.e., by their UTF-8 bytes
+    keys = sorted(title_index.keys())
+    write_strings(keys, store_dir, "title_keys.bin", "title_key_offsets.npy")
+    np.save(os.path.join(store_dir, "title_key_articles.npy"), np.array([title_index[key] for key in keys], dtype=np.uint32))
+
+    print(f"[WikiDump] Ingested {len(titles)} articles, {num_redirects} redirects in {time.time() - start:.1f}s")
+
+
+class WikiDump:
+    """
+    Offline Wikipedia built by `ingest_wiki_dump`. The article text, the
+    titles and the (sorted) title index are memory-mapped, so opening the
+    store is instant and only the pages touched by the binary searches and
+    the articles looked up are read. Articles are found by title (or
+    redirect) lookups of the word n-grams of the query (and of the topic),
+    and their paragraphs are ranked by overlap with the query.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        Open the article store.
+
+        Args:
+            store_dir: str
+                The directory of the store.
+        """
+
+        self.store_dir = store_dir
+        load = lambda name: np.load(os.path.join(store_dir, name), mmap_mode="r")
+        self.article_offsets = load("article_offsets.npy")
+        self.paragraph_offsets = load("paragraph_offsets.npy")
+        self.article_paragraphs = load("article_paragraphs.npy")
+        self.title_offsets = load("title_offsets.npy")
+        self.title_key_offsets = load("title_key_offsets.npy")
+        self.title_key_articles = load("title_key_articles.npy")
+        self.num_articles = len(self.article_offsets) - 1
+        self.num_keys = len(self.title_key_articles)
+
+        self.files = []
+        self.articles = self._map("articles.bin")
+        self.titles = self._map("titles.bin")
+        self.title_keys = self._map("title_keys.bin")
+
+        print(f"[WikiDump] Loaded {self.num_articles} articles from {store_dir}")
+
+    def _map(self, name: str) -> mmap.mmap:
+        f = open(os.path.join(self.store_dir, name), "rb")
+        self.files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""  # mmap cannot map an empty file
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_title(self, article_id: int) -> str:
+        start, end = int(self.title_offsets[article_id]), int(self.title_offsets[article_id + 1])
+        return self.titles[start:end].decode("utf-8")
+
+    def lookup(self, title: str) -> Optional[int]:
+        """
+        Return the id of the article with the given title (or redirect), or
+        None (binary search of the sorted title keys).
+        """
+
+        key = normalize_title(title).encode("utf-8")
+        lo, hi = 0, self.num_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self.title_keys[int(self.title_key_offsets[mid]):int(self.title_key_offsets[mid + 1])]
+            if mid_key < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_keys \
+                and self.title_keys[int(self.title_key_offsets[lo]):int(self.title_key_offsets[lo + 1])] == key:
+            return int(self.title_key_articles[lo])
+        return None
+
+    def get_paragraphs(self, article_id: int) -> List[str]:
+        """
+        Return the paragraphs of the article.
+        """
+
+        first, last = int(self.article_paragraphs[article_id]), int(self.article_paragraphs[article_id + 1])
+        return [
+            self.articles[int(self.paragraph_offsets[i]):int(self.paragraph_offsets[i + 1])].decode("utf-8").strip()
+            for i in range(first, last)
+        ]
+
+    def get_article(self, article_id: int) -> dict:
+        """
+        Return the article (dict with title, text and link).
+        """
+
+        start, end = int(self.article_offsets[article_id]), int(self.article_offsets[article_id + 1])
+        title = self.get_title(article_id)
+        return dict(
+            title=title,
+            text=self.articles[start:end].decode("utf-8").strip(),
+            link=WIKIPEDIA_URL + quote(title.replace(" ", "_")),
+        )
+
+    def find_articles(self, text: str, topic: str = None, k: int = 5) -> List[int]:
+        """
+        Return the ids of the (at most k) articles whose titles appear in the
+        text, longest matches first. The topic (if any) is looked up first.
+        """
+
+        found = []
+        if topic is not None and self.lookup(topic) is not None:
+            found.append(self.lookup(topic))
+
+        words = re.findall(r"[\w'\-.&]+", text)
+        words = [w.strip(".") for w in words]
+        matches = []
+        for n in range(min(MAX_TITLE_WORDS, len(words)), 0, -1):
+            for i in range(len(words) - n + 1):
+                ngram = words[i:i + n]
+                if n == 1 and (not ngram[0][:1].isupper() or ngram[0].lower() in UNIGRAM_STOPWORDS):
+                    continue  # single lowercase words and stopwords are too ambiguous
+                article_id = self.lookup(" ".join(ngram))
+                if article_id is not None:
+                    matches.append(article_id)
+
+        for article_id in matches:
+            if article_id not in found:
+                found.append(article_id)
+        return found[:k]
+
+    def search(self, text: str, k: int = 5, topic: str = None, max_chars: int = 4000) -> List[dict]:
+        """
+        Retrieve the passages relevant to the text: for each matching article,
+        its paragraphs that overlap most with the text (in their original
+        order), up to `max_chars` characters. The lead paragraph is the snippet.
+
+        Args:
+            text: str
+                The query text.
+            k: int
+                The number of articles (passages) retrieved.
+            topic: str
+                The topic of the text (optional).
+            max_chars: int
+                The maximum size (characters) of a passage.
+
+        Returns:
+            List[dict]: The passages (dicts with title, text, snippet and link).
+        """
+
+        query = set(tokenize(text))
+        passages = []
+        for article_id in self.find_articles(text, topic=topic, k=k):
+            paragraphs = self.get_paragraphs(article_id)
+            scores = [len(query.intersection(tokenize(p))) for p in paragraphs]
+            ranked = sorted(range(len(paragraphs)), key=lambda i: (-scores[i], i))
+            selected, size = [], 0
+            for i in ranked:
+                if size + len(paragraphs[i]) > max_chars and len(selected) > 0:
+                    break
+                selected.append(i)
+                size += len(paragraphs[i]) + 1
+
+            title = self.get_title(article_id)
+            passages.append(dict(
+                title=title,
+                text="\n".join(paragraphs[i] for i in sorted(selected))[:max_chars],
+                snippet=paragraphs[0],
+                link=WIKIPEDIA_URL + quote(title.replace(" ", "_")),
+            ))
+        return passages
+
+    def close(self):
+        for m in [self.articles, self.titles, self.title_keys]:
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self.files:
+            f.close()
+
+
+if __name__ == "__main__":
+
+    # CLI arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--dump_file',
+        type=str,
+        required=True,
+        help="Path to the Wikipedia dump (XML, XML.bz2 or JSONL with title and text)."
+    )
+
+    parser.add_argument(
+        '--store_dir',
+        type=str,
+        required=True,
+        help="Directory where the article store is written."
+    )
+
+    parser.add_argument(
+        '--query',
+        type=str,
+        default=None,
+        help="Run a test query against the store after ingesting the dump."
+    )
+
+    # Parse CLI arguments
+    args = parser.parse_args()
+
+    ingest_wiki_dump(args.dump_file, args.store_dir)
+    if args.query is not None:
+        wiki = WikiDump(args.store_dir)
+        for passage in wiki.search(args.query, k=3):
+            print(f"{passage['title']}: {passage['text'][:200]}")
+    print("Done.")
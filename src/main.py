@@ -81,7 +81,7 @@ if __name__ == "__main__":
         '--service_type',
         type=str,
         default="google",
-        help="Service type (langchain, chromadb, google)."
+        help="Service type (langchain, chromadb, google, bm25, hybrid, wikidump)."
     )
 
     parser.add_argument(
@@ -134,6 +134,27 @@ if __name__ == "__main__":
         help="Use the QueryBuilder to generate queries for Google search."
     )
 
+    parser.add_argument(
+        '--bm25_index_dir',
+        type=str,
+        default=None,
+        help="Path to the BM25 index of a local passage corpus (service type bm25 or hybrid)."
+    )
+
+    parser.add_argument(
+        '--wiki_store_dir',
+        type=str,
+        default=None,
+        help="Path to the local Wikipedia article store (service type wikidump)."
+    )
+
+    parser.add_argument(
+        '--query_generator',
+        type=str,
+        default="llm",
+        help="QueryBuilder generator: llm, rules (entities and noun phrases) or auto (rules, escalated to the LLM)"
+    )
+
     parser.add_argument(
         '--text_only', 
         default=False, 
@@ -155,6 +176,13 @@ if __name__ == "__main__":
         help="Atomizer prompt version: v1 (original) or v2 (newer)"
     )
 
+    parser.add_argument(
+        '--atomizer_chunk_size',
+        type=int,
+        default=None,
+        help="Extract the atoms of long responses from chunks of this many characters (in parallel)"
+    )
+
     parser.add_argument(
         '--reviser_prompt_version', 
         type=str, 
@@ -195,7 +223,8 @@ if __name__ == "__main__":
     atom_extractor = AtomExtractor(
         model_id=args.model_id, 
         prompt_version=args.atomizer_prompt_version,
-        backend=args.backend
+        backend=args.backend,
+        chunk_size=args.atomizer_chunk_size
     )
     
     # Create the atom reviser
@@ -214,7 +243,7 @@ if __name__ == "__main__":
 
     # Create the Query Builder
     if args.use_query_builder:
-        query_builder = QueryBuilder(model_id=args.model_id, backend=args.backend)
+        query_builder = QueryBuilder(model_id=args.model_id, backend=args.backend, generator=args.query_generator)
     else:
         query_builder = None
 
@@ -223,7 +252,9 @@ if __name__ == "__main__":
         service_type=args.service_type, 
         top_k=args.top_k, 
         cache_dir=args.cache_dir,
-        query_builder=query_builder
+        query_builder=query_builder,
+        bm25_index_dir=args.bm25_index_dir,
+        wiki_store_dir=args.wiki_store_dir
     )
 
     print(f"Processing input dataset: {args.input_file}")